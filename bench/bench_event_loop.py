@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""
+Compare CPU time and wakeups of the threaded gateway layout against the
+single event loop layout.
+
+Each layout runs in its own process with a pseudo-terminal standing in for
+the dongle. This process feeds it motion reports over the pty and fetches
+description.xml from its UPnP HTTP server, then the child reports the CPU
+time and context switches it used over the measurement window.
+
+    python bench/bench_event_loop.py [--seconds 10] [--rate 50]
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import pty
+import resource
+import subprocess
+import sys
+import threading
+import time
+import urllib2
+
+# the gateway modules live one level up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+HTTP_PORT = 18088
+
+
+def run_layout(layout, port, seconds):
+    """ Child process: bring up one layout and measure it """
+    import logging
+    logging.disable(logging.CRITICAL)
+    from event_loop import EventLoop
+    from ssdp import SSDPServer
+    from ssdp_web_server import UPNPHTTPServer
+    from xrf import XrfAPI, XrfCommsThread
+
+    http_server = UPNPHTTPServer(HTTP_PORT, friendly_name='bench', manufacturer='bench',
+                                 manufacturer_url='', model_description='', model_name='',
+                                 model_number='', model_url='', serial_number='',
+                                 uuid='bench', presentation_url='index.html')
+    ssdp_server = SSDPServer()
+    XrfCommsThread(port=port)
+
+    loop = None
+    if layout == 'loop':
+        loop = EventLoop()
+        http_server.attach(loop)
+        try:
+            ssdp_server.attach(loop)
+        except Exception as err:
+            print('SSDP unavailable: %s' % err, file=sys.stderr)
+        XrfAPI(loop=loop)
+        thread = threading.Thread(target=loop.run_forever)
+        thread.daemon = True
+        thread.start()
+    else:
+        http_server.start()
+        ssdp_server.start()
+        XrfAPI.getInstance().start()
+
+    time.sleep(1)       # settle before measuring
+    start_times = os.times()
+    start_usage = resource.getrusage(resource.RUSAGE_SELF)
+    start_wakeups = loop.wakeups if loop else 0
+    time.sleep(seconds)
+    end_times = os.times()
+    end_usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    result = {
+        'layout': layout,
+        'cpu': (end_times[0] + end_times[1]) - (start_times[0] + start_times[1]),
+        'voluntary_switches': end_usage.ru_nvcsw - start_usage.ru_nvcsw,
+        'involuntary_switches': end_usage.ru_nivcsw - start_usage.ru_nivcsw,
+        'devices': len(XrfAPI.getInstance().discoveredDevices),
+    }
+    if loop:
+        result['loop_wakeups'] = loop.wakeups - start_wakeups
+    print(json.dumps(result))
+    sys.stdout.flush()
+    os._exit(0)
+
+
+def report_packet(index):
+    """ An 'R' UART frame carrying a motion REPORTACK from a made-up fixture """
+    payload = bytearray([0, 0x70, 1, 1]) + bytearray([0, 0, 0, 0, 0, 0, index >> 8, index & 0xFF]) + bytearray([1])
+    payload[0] = len(payload) - 1
+    return bytearray(['R', len(payload) + 2]) + payload
+
+
+def drive(master, rate, stop):
+    """ Feed reports into the pty and poll the HTTP server until stopped """
+    interval = 1.0 / rate
+    index = 0
+    next_http = time.time()
+    while not stop.is_set():
+        os.write(master, bytes(report_packet(index % 1000)))
+        index += 1
+        if time.time() >= next_http:
+            try:
+                urllib2.urlopen('http://127.0.0.1:%d/description.xml' % HTTP_PORT, timeout=1).read()
+            except Exception:
+                pass
+            next_http += 0.2
+        time.sleep(interval)
+
+
+def measure(layout, seconds, rate):
+    master, slave = pty.openpty()
+    port = os.ttyname(slave)
+    child = subprocess.Popen([sys.executable, __file__, '--child', layout, '--port', port,
+                              '--seconds', str(seconds)], stdout=subprocess.PIPE)
+    stop = threading.Event()
+    driver = threading.Thread(target=drive, args=(master, rate, stop))
+    driver.daemon = True
+    time.sleep(1)
+    driver.start()
+    output = child.communicate()[0]
+    stop.set()
+    os.close(master)
+    os.close(slave)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--rate', type=float, default=50, help='RX packets per second')
+    parser.add_argument('--child', choices=['threaded', 'loop'], help=argparse.SUPPRESS)
+    parser.add_argument('--port', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_layout(args.child, args.port, args.seconds)
+        return
+
+    print('%-10s %10s %12s %12s %12s' % ('layout', 'cpu (s)', 'vol. csw', 'invol. csw', 'loop wakes'))
+    for layout in ('threaded', 'loop'):
+        result = measure(layout, args.seconds, args.rate)
+        print('%-10s %10.3f %12d %12d %12s' % (layout, result['cpu'], result['voluntary_switches'],
+                                               result['involuntary_switches'],
+                                               result.get('loop_wakeups', '-')))
+
+
+if __name__ == '__main__':
+    main()
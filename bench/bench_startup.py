@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""
+Measure how long the gateway takes to answer its first HTTP request and to
+become ready, with and without a dongle and a saved device registry.
+
+Each case starts xrf-api.py in a fresh process. The dongle is either a
+pseudo-terminal (present) or a path that doesn't exist (missing, so the
+gateway keeps retrying in the background). A warm start restores a saved
+registry of --devices fixtures. Times are from spawning the process.
+
+    python bench/bench_startup.py [--runs 3] [--devices 1000] [--event-loop]
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import pty
+import subprocess
+import sys
+import tempfile
+import time
+import urllib2
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+# the gateway lives one level up
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from xrf_statecache import STATE_FORMAT
+
+
+STATUS_URL = 'http://127.0.0.1:5000/xrf-api/v1.0/status'
+
+
+def write_state(path, count):
+    """ A saved registry of count made-up fixtures """
+    now = time.time()
+    devices = dict(('%016x' % i, {'model': 'Artemis', 'group': 1 + i % 8, 'channel': 1,
+                                  'hopcount': 1 + i % 3, 'fwversion': 20, 'lastseen': now,
+                                  'state': 'active'})
+                   for i in range(count))
+    with open(path, 'wb') as f:
+        pickle.dump({'format': STATE_FORMAT, 'saved': now, 'devices': devices, 'tombstones': []},
+                    f, pickle.HIGHEST_PROTOCOL)
+    return
+
+
+def get_status():
+    """ Gateway status, or None if it isn't answering yet """
+    try:
+        body = urllib2.urlopen(STATUS_URL, timeout=1).read()
+    except urllib2.HTTPError as err:
+        body = err.read()       # 503 while starting or degraded still counts as a response
+    except Exception:
+        return None
+    return json.loads(body)['status']
+
+
+def measure(dongle, devices, event_loop, timeout):
+    """ Start the gateway once and time its first response and readiness """
+    state_path = tempfile.mktemp(prefix='xrf-bench-state-')
+    if devices:
+        write_state(state_path, devices)
+    master = slave = None
+    if dongle:
+        master, slave = pty.openpty()
+        serial_port = os.ttyname(slave)
+    else:
+        serial_port = '/dev/xrf-bench-missing'
+    command = [sys.executable, 'xrf-api.py', '--serial-port', serial_port, '--state-file', state_path]
+    if event_loop:
+        command.append('--event-loop')
+
+    devnull = open(os.devnull, 'w')
+    spawned = time.time()
+    child = subprocess.Popen(command, stdout=devnull, stderr=devnull)
+    first = ready = status = None
+    try:
+        while time.time() - spawned < timeout:
+            status = get_status()
+            if status is not None:
+                if first is None:
+                    first = time.time() - spawned
+                    first_devices = status['devices']
+                if status['state'] == 'ready' or not dongle:
+                    ready = time.time() - spawned if status['state'] == 'ready' else None
+                    break
+            time.sleep(0.01)
+    finally:
+        child.kill()
+        child.wait()
+        devnull.close()
+        for fd in (master, slave):
+            if fd is not None:
+                os.close(fd)
+        for path in (state_path, state_path + '.tmp'):
+            if os.path.exists(path):
+                os.unlink(path)
+    if first is None:
+        return None
+    return {'first': first, 'ready': ready, 'devices': first_devices,
+            'state': status['state'], 'stages': status['startup']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--devices', type=int, default=1000, help='fixtures in the saved registry')
+    parser.add_argument('--event-loop', action='store_true', help='run the gateway with --event-loop')
+    parser.add_argument('--timeout', type=float, default=30)
+    args = parser.parse_args()
+    os.chdir(ROOT)
+
+    print('%-8s %-6s %10s %10s %8s %10s' % ('dongle', 'state', 'first (s)', 'ready (s)', 'devices', 'status'))
+    for dongle in (True, False):
+        for devices in (0, args.devices):
+            for run in range(args.runs):
+                result = measure(dongle, devices, args.event_loop, args.timeout)
+                if result is None:
+                    print('%-8s %-6s %10s' % ('present' if dongle else 'missing', 'warm' if devices else 'cold',
+                                              'timeout'))
+                    continue
+                print('%-8s %-6s %10.3f %10s %8d %10s' % ('present' if dongle else 'missing',
+                                                          'warm' if devices else 'cold', result['first'],
+                                                          '%.3f' % result['ready'] if result['ready'] else '-',
+                                                          result['devices'], result['state']))
+                sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
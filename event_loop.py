@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Single-threaded I/O event loop
+
+Hosts the SSDP socket, the UPnP HTTP listener and the dongle's serial port
+on one thread instead of one thread (and one timeout/busy loop) each.
+"""
+import errno
+import fcntl
+import heapq
+import itertools
+import logging
+import os
+import select
+import threading
+import time
+from collections import deque
+
+
+log = logging.getLogger(__name__)
+
+def _fileno(fileobj):
+    if isinstance(fileobj, int):
+        return fileobj
+    return fileobj.fileno()
+
+
+class EventLoop(object):
+    """ A minimal reactor built on select.poll (or select.select).
+
+    Readers and timers must only be added from the loop thread; other
+    threads hand work to the loop with call_soon_threadsafe().
+    """
+
+    def __init__(self):
+        self.readers = dict()
+        self.timers = list()
+        self.ready = deque()
+        self.sequence = itertools.count()
+        self.running = False
+        self.wakeups = 0
+        self.thread = None
+        self.wakeupRead, self.wakeupWrite = os.pipe()
+        for fd in (self.wakeupRead, self.wakeupWrite):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.poller = select.poll() if hasattr(select, 'poll') else None
+        self.add_reader(self.wakeupRead, self._drain_wakeup)
+
+    def add_reader(self, fileobj, callback, *args):
+        """ Call callback(*args) whenever fileobj is readable """
+        fd = _fileno(fileobj)
+        self.readers[fd] = (callback, args)
+        if self.poller is not None:
+            self.poller.register(fd, select.POLLIN)
+        return
+
+    def remove_reader(self, fileobj):
+        fd = _fileno(fileobj)
+        if self.readers.pop(fd, None) is not None and self.poller is not None:
+            self.poller.unregister(fd)
+        return
+
+    def call_later(self, delay, callback, *args):
+        """ Call callback(*args) after delay seconds """
+        heapq.heappush(self.timers, (time.time() + delay, next(self.sequence), callback, args))
+        return
+
+    def call_soon_threadsafe(self, callback, *args):
+        """ Call callback(*args) on the loop thread; safe from any thread """
+        self.ready.append((callback, args))
+        if threading.current_thread() is not self.thread:
+            try:
+                os.write(self.wakeupWrite, b'x')
+            except OSError as err:
+                if err.errno != errno.EAGAIN:
+                    raise
+        return
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self.wakeupRead, 4096):
+                pass
+        except OSError as err:
+            if err.errno != errno.EAGAIN:
+                raise
+        return
+
+    def _poll(self, timeout):
+        if self.poller is not None:
+            ms = None if timeout is None else int(timeout * 1000 + 0.999)
+            try:
+                return [fd for fd, mask in self.poller.poll(ms)]
+            except select.error as err:
+                if err.args[0] != errno.EINTR:
+                    raise
+                return []
+        try:
+            return select.select(list(self.readers.keys()), [], [], timeout)[0]
+        except select.error as err:
+            if err.args[0] != errno.EINTR:
+                raise
+            return []
+
+    def _dispatch(self, callback, args):
+        """ Run one callback; an exception is logged rather than ending the loop,
+        which would stop every other source it serves """
+        try:
+            callback(*args)
+        except Exception:
+            log.exception('event loop callback %r failed', callback)
+        return
+
+    def run_forever(self):
+        """ Run callbacks until stop() is called """
+        self.thread = threading.current_thread()
+        self.running = True
+        while self.running:
+            timeout = None
+            if self.ready:
+                timeout = 0
+            elif self.timers:
+                timeout = max(0, self.timers[0][0] - time.time())
+
+            fds = self._poll(timeout)
+            self.wakeups += 1
+            for fd in fds:
+                reader = self.readers.get(fd)
+                if reader is not None:
+                    self._dispatch(*reader)
+
+            now = time.time()
+            while self.timers and self.timers[0][0] <= now:
+                when, seq, callback, args = heapq.heappop(self.timers)
+                self._dispatch(callback, args)
+
+            for i in range(len(self.ready)):
+                callback, args = self.ready.popleft()
+                self._dispatch(callback, args)
+        return
+
+    def stop(self):
+        self.running = False
+        self.call_soon_threadsafe(lambda: None)
+        return
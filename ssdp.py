@@ -14,6 +14,7 @@ import random
 import time
 import socket
 import logging
+import math
 from email.utils import formatdate
 from errno import ENOPROTOOPT
 import threading
@@ -23,10 +24,64 @@ SSDP_ADDR = '239.255.255.250'
 SERVER_ID = 'Xeleum SSDP Server'
 
 
+MX_MAX = 5                  # UDA 1.1: treat larger MX values as 5 seconds
+SEARCH_RATE = 5.0           # M-SEARCHes per second allowed from one source...
+SEARCH_BURST = 10.0         # ...with bursts up to this many
+
+
 logging_enabled = False     # Change to True to see logging
 logger = logging.getLogger()
 
 
+class TimerWheel(object):
+    """A hashed timer wheel.  Callbacks are bucketed by tick, so scheduling
+    and expiry are O(1) however many responses are pending.  Not thread
+    safe; the caller provides locking."""
+
+    def __init__(self, tick=0.05, slots=128):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.origin = time.time()
+        self.current = 0
+        self.count = 0
+
+    def _tick_at(self, when):
+        return int(math.ceil((when - self.origin) / self.tick))
+
+    def schedule(self, delay, callback, *args):
+        if not self.count:
+            self.current = self._tick_at(time.time())   # skip ticks spent idle
+        target = max(self._tick_at(time.time() + delay), self.current)
+        self.slots[target % len(self.slots)].append((target, callback, args))
+        self.count += 1
+
+    def expire(self, now=None):
+        """Remove and return the (callback, args) entries that are due."""
+        if now is None:
+            now = time.time()
+        due = []
+        last = self._tick_at(now)
+        while self.current <= last and self.count:
+            slot = self.slots[self.current % len(self.slots)]
+            if slot:
+                keep = []
+                for entry in slot:
+                    if entry[0] <= self.current:
+                        due.append(entry[1:])
+                    else:
+                        keep.append(entry)
+                slot[:] = keep
+            self.current += 1
+        self.count -= len(due)
+        return due
+
+    def next_timeout(self):
+        """Seconds until the next tick that may have work, or None if idle."""
+        if not self.count:
+            return None
+        return max(0, self.origin + self.current * self.tick - time.time())
+
+
 class SSDPServer(threading.Thread):
     """A class implementing a SSDP server.  The notify_received and
     searchReceived methods are called when the appropriate type of
@@ -34,10 +89,48 @@ class SSDPServer(threading.Thread):
     known = {}
 
     def __init__(self):
-        threading.Thread.__init__(self)
+        threading.Thread.__init__(self, name='SSDP')
         self.sock = None
+        self.loop = None
+        self.templates = {}
+        self.pending = set()
+        self.buckets = {}
+        self.stats = {'searches': 0, 'responses': 0, 'rate_limited': 0, 'coalesced': 0}
+        self.wheel = TimerWheel()
+        self.wheel_cond = threading.Condition()
+        self.date_cache = (None, None)
+        self.timer_thread = threading.Thread(target=self.run_timers, name='SSDPTimers')
+        self.timer_thread.daemon = True
 
     def run(self):
+        self.open_socket()
+        self.sock.settimeout(1)
+        self.timer_thread.start()
+
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(1024)
+                self.datagram_received(data, addr)
+            except socket.timeout:
+                continue
+        self.shutdown()
+
+    def attach(self, loop):
+        """Serve SSDP from an event loop instead of running the thread."""
+        self.loop = loop
+        self.open_socket()
+        self.sock.setblocking(0)
+        loop.add_reader(self.sock, self.read_datagram)
+
+    def read_datagram(self):
+        """Event loop callback: the SSDP socket is readable."""
+        try:
+            data, addr = self.sock.recvfrom(1024)
+        except socket.error:
+            return
+        self.datagram_received(data, addr)
+
+    def open_socket(self):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         if hasattr(socket, "SO_REUSEPORT"):
@@ -55,15 +148,6 @@ class SSDPServer(threading.Thread):
         cmd = socket.IP_ADD_MEMBERSHIP
         self.sock.setsockopt(socket.IPPROTO_IP, cmd, addr + interface)
         self.sock.bind(('0.0.0.0', SSDP_PORT))
-        self.sock.settimeout(1)
-
-        while True:
-            try:
-                data, addr = self.sock.recvfrom(1024)
-                self.datagram_received(data, addr)
-            except socket.timeout:
-                continue
-        self.shutdown()
 
     def shutdown(self):
         for st in self.known:
@@ -124,6 +208,8 @@ class SSDPServer(threading.Thread):
         self.known[usn]['HOST'] = host
         self.known[usn]['last-seen'] = time.time()
 
+        self.templates[usn] = self.render_template(usn)
+
         if manifestation == 'local' and self.sock:
             self.do_notify(usn)
 
@@ -131,6 +217,70 @@ class SSDPServer(threading.Thread):
         if logging_enabled:
             logger.info("Un-registering %s" % usn)
         del self.known[usn]
+        self.templates.pop(usn, None)
+
+    def render_template(self, usn):
+        """Pre-render the search response for a service, up to the DATE
+        value which is the only part that varies."""
+        response = ['HTTP/1.1 200 OK']
+        for k, v in self.known[usn].items():
+            if k not in ('MANIFESTATION', 'SILENT', 'HOST', 'last-seen'):
+                response.append('%s: %s' % (k, v))
+        response.append('DATE: ')
+        return '\r\n'.join(response)
+
+    def http_date(self):
+        """RFC 1123 date, formatted at most once per second."""
+        now = int(time.time())
+        if self.date_cache[0] != now:
+            self.date_cache = (now, formatdate(timeval=now, localtime=False, usegmt=True))
+        return self.date_cache[1]
+
+    def allow_search(self, host):
+        """Token bucket rate limit on M-SEARCHes from one source address."""
+        now = time.time()
+        tokens, last = self.buckets.get(host, (SEARCH_BURST, now))
+        tokens = min(SEARCH_BURST, tokens + (now - last) * SEARCH_RATE)
+        if tokens < 1:
+            self.buckets[host] = (tokens, now)
+            return False
+        self.buckets[host] = (tokens - 1, now)
+        if len(self.buckets) > 1024:
+            # forget sources whose buckets have refilled
+            full = SEARCH_BURST / SEARCH_RATE
+            for h in [h for h, (t, l) in self.buckets.items() if now - l > full]:
+                del self.buckets[h]
+        return True
+
+    def schedule(self, delay, callback, *args):
+        """Run callback after delay seconds on the timer thread (or the
+        event loop, if attached to one)."""
+        if self.loop is not None:
+            self.loop.call_later(delay, callback, *args)
+            return
+        with self.wheel_cond:
+            self.wheel.schedule(delay, callback, *args)
+            self.wheel_cond.notify()
+
+    def run_timers(self):
+        """Timer thread: sends delayed responses so the receive loop never waits."""
+        while True:
+            with self.wheel_cond:
+                timeout = self.wheel.next_timeout()
+                while timeout is None:
+                    self.wheel_cond.wait()
+                    timeout = self.wheel.next_timeout()
+                if timeout > 0:
+                    self.wheel_cond.wait(timeout)
+                due = self.wheel.expire()
+            for callback, args in due:
+                try:
+                    callback(*args)
+                except Exception as err:
+                    logger.error('SSDP timer callback failed: %r' % err)
+
+    def get_stats(self):
+        return dict(self.stats, pending=len(self.pending))
 
     def is_known(self, usn):
         return usn in self.known
@@ -146,37 +296,55 @@ class SSDPServer(threading.Thread):
 
     def discovery_request(self, headers, host_port):
         """Process a discovery request.  The response must be sent to
-        the address specified by (host, port)."""
+        the address specified by (host, port) after a random delay of up
+        to MX seconds."""
 
         (host, port) = host_port
+        st = headers.get('st')
+        self.stats['searches'] += 1
 
         if logging_enabled:
-            logger.info('Discovery request from (%s,%d) for %s' % (host, port, headers['st']))
-            logger.info('Discovery request for %s' % headers['st'])
+            logger.info('Discovery request from (%s,%d) for %s' % (host, port, st))
+
+        if st is None:
+            return
+        if not self.allow_search(host):
+            self.stats['rate_limited'] += 1
+            return
+
+        # Identical searches from the same source while one is pending
+        # would get identical answers; answer once.
+        key = (host, port, st)
+        with self.wheel_cond:
+            if key in self.pending:
+                self.stats['coalesced'] += 1
+                return
+            self.pending.add(key)
 
-        # Do we know about this service?
-        for i in self.known.values():
+        try:
+            mx = min(max(int(headers.get('mx', 1)), 0), MX_MAX)
+        except ValueError:
+            mx = 1
+        self.schedule(random.uniform(0, mx), self.send_responses, key)
+
+    def send_responses(self, key):
+        """Send the responses for a search whose MX delay has elapsed."""
+        (host, port, st) = key
+        with self.wheel_cond:
+            self.pending.discard(key)
+
+        date = self.http_date()
+        for usn, i in list(self.known.items()):
             if i['MANIFESTATION'] == 'remote':
                 continue
-            if headers['st'] == 'ssdp:all' and i['SILENT']:
+            if st == 'ssdp:all' and i['SILENT']:
                 continue
-            if i['ST'] == headers['st'] or headers['st'] == 'ssdp:all':
-                response = ['HTTP/1.1 200 OK']
-
-                usn = None
-                for k, v in i.items():
-                    if k == 'USN':
-                        usn = v
-                    if k not in ('MANIFESTATION', 'SILENT', 'HOST'):
-                        response.append('%s: %s' % (k, v))
-
-                if usn:
-                    response.append('DATE: %s' % formatdate(timeval=None, localtime=False, usegmt=True))
-
-                    response.extend(('', ''))
-                    delay = random.randint(0, int(headers['mx']))
-
-                    self.send_it('\r\n'.join(response), (host, port), delay, usn)
+            if i['ST'] == st or st == 'ssdp:all':
+                template = self.templates.get(usn)
+                if template is None:
+                    continue
+                self.stats['responses'] += 1
+                self.send_it(template + date + '\r\n\r\n', (host, port), 0, usn)
 
     def do_notify(self, usn):
         """Do notification"""
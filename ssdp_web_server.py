@@ -1,48 +1,158 @@
 from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import gzip
+import hashlib
 import threading
 import mimetypes
 import os
+import shutil
+from io import BytesIO
 
 
 PORT_NUMBER = 8088
+STATIC_DIRS = ('img', 'css', 'js', 'fonts')
+SENDFILE_THRESHOLD = 1024 * 1024    # larger files are served from disk, not cached
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/xml', 'image/svg+xml',
+                      'application/vnd.ms-fontobject', 'application/x-font-ttf', 'font/ttf')
+
+
+class StaticAsset(object):
+    """
+    A static file held in memory, with its gzip variant and ETag.
+    """
+
+    def __init__(self, path, mimetype, body=None, size=None):
+        self.path = path
+        self.mimetype = mimetype or 'application/octet-stream'
+        self.body = body
+        self.gzipped = None
+        self.size = len(body) if body is not None else size
+        if body is not None:
+            self.etag = '"%s"' % hashlib.md5(body).hexdigest()
+            if self.mimetype.startswith(COMPRESSIBLE_TYPES):
+                buff = BytesIO()
+                with gzip.GzipFile(fileobj=buff, mode='wb', mtime=0) as gz:
+                    gz.write(body)
+                if buff.tell() < len(body):
+                    self.gzipped = buff.getvalue()
+        else:
+            stat = os.stat(path)
+            self.etag = '"%x-%x"' % (int(stat.st_mtime), stat.st_size)
+
+
+def load_static_assets(root):
+    """
+    Load the web UI's static files into memory, keyed by URL path.
+    """
+    assets = {}
+    guess = mimetypes.MimeTypes().guess_type
+    paths = [name for name in os.listdir(root) if name.endswith('.html')]
+    for directory in STATIC_DIRS:
+        for dirpath, dirnames, filenames in os.walk(os.path.join(root, directory)):
+            for name in filenames:
+                paths.append(os.path.relpath(os.path.join(dirpath, name), root))
+    for relpath in paths:
+        path = os.path.join(root, relpath)
+        url = '/' + relpath.replace(os.sep, '/')
+        mimetype = guess(path)[0]
+        size = os.path.getsize(path)
+        if size > SENDFILE_THRESHOLD:
+            assets[url] = StaticAsset(path, mimetype, size=size)
+        else:
+            with open(path, 'rb') as f:
+                assets[url] = StaticAsset(path, mimetype, body=f.read())
+    return assets
 
 
 class UPNPHTTPServerHandler(BaseHTTPRequestHandler):
     """
-    A HTTP handler that serves the UPnP XML files.
+    A HTTP handler that serves the UPnP XML files and the web UI from memory.
     """
+    protocol_version = 'HTTP/1.1'   # keep-alive
 
     # Handler for the GET requests
     def do_GET(self):
+        self.send_asset(head=False)
 
-        if self.path == '/description.xml':
-            self.send_response(200)
-            self.send_header('Content-type', 'application/xml')
-            self.end_headers()
-            self.wfile.write(self.get_device_xml().encode())
-            return
+    def do_HEAD(self):
+        self.send_asset(head=True)
 
-        mimetype = mimetypes.MimeTypes().guess_type(self.path)[0]
-        cwd = os.getcwd()
-        try:
-            file = open(cwd + self.path)
-            self.send_response(200)
-            self.send_header('Content-type', mimetype)
-            self.end_headers()
-            self.wfile.write(file.read())
-            file.close()
-        except:
+    def send_asset(self, head):
+        path = self.path.split('?', 1)[0]
+        if path == '/':
+            path = '/' + self.server.presentation_url
+        if path == '/description.xml':
+            asset = self.server.device_xml
+        else:
+            asset = self.server.assets.get(path)
+
+        if asset is None:
+            body = b"Not found."
             self.send_response(404)
             self.send_header('Content-type', 'text/html')
+            self.send_header('Content-Length', str(len(body)))
             self.end_headers()
-            self.wfile.write(b"Not found.")
-        return
+            if not head:
+                self.wfile.write(body)
+            return
 
+        if asset.etag in [t.strip() for t in self.headers.get('If-None-Match', '').split(',')]:
+            self.send_response(304)
+            self.send_header('ETag', asset.etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body = asset.body
+        encoding = None
+        if asset.gzipped is not None and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = asset.gzipped
+            encoding = 'gzip'
+
+        self.send_response(200)
+        self.send_header('Content-type', asset.mimetype)
+        self.send_header('Content-Length', str(len(body) if body is not None else asset.size))
+        self.send_header('ETag', asset.etag)
+        if asset.gzipped is not None:
+            self.send_header('Vary', 'Accept-Encoding')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.end_headers()
+        if head:
+            return
+        if body is not None:
+            self.wfile.write(body)
+        else:
+            self.send_file(asset.path)
+
+    def send_file(self, path):
+        """
+        Send a large file straight from disk, with sendfile where available.
+        """
+        self.wfile.flush()
+        with open(path, 'rb') as f:
+            if hasattr(os, 'sendfile'):
+                offset = 0
+                size = os.fstat(f.fileno()).st_size
+                while offset < size:
+                    sent = os.sendfile(self.connection.fileno(), f.fileno(), offset, size - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+            else:
+                shutil.copyfileobj(f, self.wfile, 64 * 1024)
 
     def get_device_xml(self):
         """
         Get the main device descriptor xml file.
         """
+        return self.server.device_xml.body
+
+    @staticmethod
+    def render_device_xml(server):
+        """
+        Render the main device descriptor xml file.
+        """
         xml = """<root xmlns="urn:schemas-upnp-org:device-1-0">
                 <specVersion>
                     <major>1</major>
@@ -79,16 +189,16 @@ class UPNPHTTPServerHandler(BaseHTTPRequestHandler):
                 </device>
             </root>"""
 
-        return xml.format(friendly_name=self.server.friendly_name,
-                          manufacturer=self.server.manufacturer,
-                          manufacturer_url=self.server.manufacturer_url,
-                          model_description=self.server.model_description,
-                          model_name=self.server.model_name,
-                          model_number=self.server.model_number,
-                          model_url=self.server.model_url,
-                          serial_number=self.server.serial_number,
-                          uuid=self.server.uuid,
-                          presentation_url=self.server.presentation_url)
+        return xml.format(friendly_name=server.friendly_name,
+                          manufacturer=server.manufacturer,
+                          manufacturer_url=server.manufacturer_url,
+                          model_description=server.model_description,
+                          model_name=server.model_name,
+                          model_number=server.model_number,
+                          model_url=server.model_url,
+                          serial_number=server.serial_number,
+                          uuid=server.uuid,
+                          presentation_url=server.presentation_url)
 
     @staticmethod
     def get_wsd_xml():
@@ -103,12 +213,17 @@ class UPNPHTTPServerHandler(BaseHTTPRequestHandler):
                 </scpd>"""
 
 
-class UPNPHTTPServerBase(HTTPServer):
+class UPNPHTTPServerBase(ThreadingMixIn, HTTPServer):
     """
-    A simple HTTP server that knows the information about a UPnP device.
+    A threaded HTTP server that knows the information about a UPnP device.
     """
+    daemon_threads = True
+    synchronous = False     # handle requests on the calling thread (set when on an event loop)
+
     def __init__(self, server_address, request_handler_class):
         HTTPServer.__init__(self, server_address, request_handler_class)
+        self.assets = load_static_assets(os.getcwd())
+        self.device_xml = None
         self.port = None
         self.friendly_name = None
         self.manufacturer = None
@@ -120,6 +235,12 @@ class UPNPHTTPServerBase(HTTPServer):
         self.uuid = None
         self.presentation_url = None
 
+    def process_request(self, request, client_address):
+        if self.synchronous:
+            HTTPServer.process_request(self, request, client_address)
+        else:
+            ThreadingMixIn.process_request(self, request, client_address)
+
 
 class UPNPHTTPServer(threading.Thread):
     """
@@ -128,7 +249,7 @@ class UPNPHTTPServer(threading.Thread):
 
     def __init__(self, port, friendly_name, manufacturer, manufacturer_url, model_description, model_name,
                  model_number, model_url, serial_number, uuid, presentation_url):
-        threading.Thread.__init__(self)#, daemon=True)
+        threading.Thread.__init__(self, name='UPnPHTTP')#, daemon=True)
         self.server = UPNPHTTPServerBase(('', port), UPNPHTTPServerHandler)
         self.server.port = port
         self.server.friendly_name = friendly_name
@@ -141,6 +262,16 @@ class UPNPHTTPServer(threading.Thread):
         self.server.serial_number = serial_number
         self.server.uuid = uuid
         self.server.presentation_url = presentation_url
+        self.server.device_xml = StaticAsset(None, 'application/xml',
+                                             body=UPNPHTTPServerHandler.render_device_xml(self.server).encode())
 
     def run(self):
-        self.server.serve_forever()
\ No newline at end of file
+        self.server.serve_forever()
+
+    def attach(self, loop):
+        """
+        Serve requests from an event loop instead of running the thread.
+        Requests are handled on the loop thread rather than a thread each.
+        """
+        self.server.synchronous = True
+        loop.add_reader(self.server.fileno(), self.server._handle_request_noblock)
\ No newline at end of file
@@ -1,9 +1,36 @@
 #!flask/bin/python
 from flask import Flask, request, jsonify
 from flask import abort
+from flask import g
+from flask import json
 from flask import make_response
 from flask import url_for
-from xrf import XrfAPI
+from xrf import XrfAPI, XrfCommsThread
+from event_loop import EventLoop
+from xrf_gateway import GatewayClient, RadioOwner, default_ipc_address, default_table_path, make_ipc_dir
+from xrf_channels import ChannelScheduler
+from xrf_dali import DaliGateway
+from xrf_poller import TelemetryPoller
+from xrf_queue import QueueOverload
+from xrf_scenes import SceneEngine
+from xrf_shadow import DeviceShadow
+from xrf_statecache import StateCache, default_state_path
+from xrf_timesync import TimeSync, TimeSyncBusy
+from xrf_utilization import ChannelMonitor
+from xrf_encoding import MIMETYPE_JSON, ResponseCache, compress, encodeBinary, mimetypes
+from xrf_energy import COLUMNS
+from xrf_packetlog import setLogLevels
+from xrf_profiler import ProfilerBusy, collapse, installThreadNames
+from xrf_timeseries import METRICS
+import argparse
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import sys
+import threading
+import time
 import uuid
 from ssdp import SSDPServer
 from ssdp_web_server import UPNPHTTPServer
@@ -12,12 +39,81 @@ from netifaces import AF_INET, AF_INET6, AF_LINK, AF_PACKET, AF_BRIDGE
 import netifaces as ni
 
 
+log = logging.getLogger(__name__)
+
 # Create web API instance.
 app = Flask(__name__)
 port = 5000
 
+# Set in API worker processes, which talk to the radio-owner process instead
+# of owning an XrfAPI themselves.
+backend = None
+
+
+def get_api():
+    if backend is not None:
+        return backend
+    return XrfAPI.getInstance()
+
+
+# Encoded /devices bodies for the current registry version
+response_cache = ResponseCache()
+MIN_COMPRESS = 1024     # bodies smaller than this aren't worth compressing
+
+
+def response_type():
+    """ Negotiated (mimetype, content encoding) of the response to this request """
+    negotiated = getattr(g, 'response_type', None)
+    if negotiated is None:
+        mimetype = request.accept_mimetypes.best_match(mimetypes()) or MIMETYPE_JSON
+        encoding = request.accept_encodings.best_match(['gzip', 'deflate'])
+        negotiated = g.response_type = (mimetype, encoding)
+    return negotiated
+
+
+def encode_response(obj):
+    """ (body, mimetype, content encoding) of obj in the negotiated format """
+    mimetype, encoding = response_type()
+    if mimetype == MIMETYPE_JSON:
+        body = json.dumps(obj)
+    else:
+        body = encodeBinary(obj, mimetype)
+    if encoding and len(body) >= MIN_COMPRESS:
+        body = compress(body, encoding)
+    else:
+        encoding = None
+    return body, mimetype, encoding
+
+
+def make_encoded_response(body, mimetype, encoding):
+    response = make_response(body)
+    response.mimetype = mimetype
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept, Accept-Encoding'
+    return response
+
+
+def respond(obj):
+    """ Like jsonify(obj), but in the format and encoding the client asked for """
+    return make_encoded_response(*encode_response(obj))
+
+
+def respond_cached(build):
+    """ respond(build()), reusing the encoded body until the device registry
+    changes; build must depend only on the request URL and the registry """
+    version = get_api().getVersion()
+    key = (request.url,) + response_type()
+    encoded = response_cache.get(version, key)
+    if encoded is None:
+        encoded = encode_response(build())
+        response_cache.put(version, key, encoded)
+    return make_encoded_response(*encoded)
+
 
 def make_public_device(device):
+    if response_type()[0] != MIMETYPE_JSON:
+        return device     # binary clients know the URI scheme; skip the per-device strings
     new_device = dict()
     for field in device:
         if field == 'uid':
@@ -33,26 +129,107 @@ def not_found(error):
     return make_response(jsonify({'error': 'Not found'}), 404)
 
 
+@app.errorhandler(QueueOverload)
+def overloaded(error):
+    response = make_response(jsonify({'error': 'Overloaded', 'class': error.packetClass}), 503)
+    response.headers['Retry-After'] = '1'
+    return response
+
+
+@app.errorhandler(ProfilerBusy)
+def profiler_busy(error):
+    return make_response(jsonify({'error': 'A profile is already running'}), 409)
+
+
+@app.errorhandler(TimeSyncBusy)
+def timesync_busy(error):
+    return make_response(jsonify({'error': 'A time sync is already running'}), 409)
+
+
+@app.before_request
+def begin_trace():
+    # REST stages can only be traced where the radio lives
+    if backend is None:
+        get_api().markStartup('firstRequest')
+        get_api().beginTrace(request.endpoint)
+
+
+@app.teardown_request
+def end_trace(exception):
+    if backend is None:
+        get_api().endTrace()
+
+
+# query parameters of GET /devices: indexed field -> type of its values
+DEVICE_FILTERS = {'model': str, 'group': int, 'channel': int, 'hopcount': int, 'state': str}
+
+
+def parse_device_query(args):
+    """ Registry query from the request's query string """
+    equals = dict()
+    ranges = dict()
+    for field, kind in DEVICE_FILTERS.items():
+        if field in args:
+            equals[field] = [kind(value) for value in args[field].split(',')]
+        low = args.get(field + '_min', type=kind)
+        high = args.get(field + '_max', type=kind)
+        if low is not None or high is not None:
+            ranges[field] = (low, high)
+    motion = None
+    since = args.get('motion_since', type=float)
+    until = args.get('motion_until', type=float)
+    within = args.get('motion_within', type=float)
+    if within is not None:
+        since = time.time() - within if since is None else max(since, time.time() - within)
+    if since is not None or until is not None:
+        motion = (since, until)
+    return equals, ranges, motion
+
+
 @app.route('/xrf-api/v1.0/devices', methods=['GET'])
 def get_devices():
-    devices = XrfAPI.getInstance().getDevices()
-    return jsonify({'devices': [make_public_device(device) for device in devices]})
+    if not request.args:
+        return respond_cached(lambda: {'devices': [make_public_device(device)
+                                                   for device in get_api().getDevices()]})
+    try:
+        equals, ranges, motion = parse_device_query(request.args)
+    except ValueError:
+        abort(400)
+    limit = request.args.get('limit', type=int)
+    if 'limit' in request.args and (limit is None or limit < 1):
+        abort(400)
+    if 'motion_within' in request.args:
+        # relative to now, so the result can change without the registry changing
+        return respond(query_devices(equals, ranges, motion, limit))
+    return respond_cached(lambda: query_devices(equals, ranges, motion, limit))
+
+
+def query_devices(equals, ranges, motion, limit):
+    fields = request.args['fields'].split(',') if 'fields' in request.args else None
+    devices, cursor = get_api().queryDevices(equals, ranges, motion, fields,
+                                             request.args.get('cursor'), limit)
+    response = {'devices': [make_public_device(device) for device in devices]}
+    if cursor is not None:
+        args = request.args.to_dict()
+        args['cursor'] = cursor
+        response['cursor'] = cursor
+        response['next'] = url_for('get_devices', _external=True, **args)
+    return response
 
 
 @app.route('/xrf-api/v1.0/device/<uid>', methods=['GET'])
 def get_device(uid):
-    devices = XrfAPI.getInstance().getDevices()
-    device = [device for device in devices if device['uid'] == uid]
-    if len(device) == 0:
+    device = get_api().getDevice(uid)
+    if device is None:
         abort(404)
-    return jsonify({'device': make_public_device(device[0])})
+    return respond({'device': make_public_device(device)})
 
 
 @app.route('/xrf-api/v1.0/setpwm/<uid>', methods=['PUT'])
 def device_setpwm(uid):
     if len(uid) == 0:
         abort(404)
-    devices = XrfAPI.getInstance().getDevices()
+    devices = get_api().getDevices()
     device = [device for device in devices if device['uid'] == uid]
     if len(device) == 0:
         abort(404)
@@ -63,35 +240,275 @@ def device_setpwm(uid):
     unoccMains = request.json.get('unoccMains', 255)
     unoccBatt = request.json.get('unoccBatt', 255)
     levels = bytearray([occMains, occBatt, unoccMains, unoccBatt])
-    XrfAPI.getInstance().setPWMLevels(0, uid, levels)
-    return jsonify({'result': 'success'})
+    get_api().setPWMLevels(0, uid, levels)
+    return respond({'result': 'success'})
 
 
 @app.route('/xrf-api/v1.0/getpwm/<uid>', methods=['GET'])
 def device_getpwm(uid):
     if len(uid) == 0:
         abort(404)
-    devices = XrfAPI.getInstance().getDevices()
+    devices = get_api().getDevices()
     device = [device for device in devices if device['uid'] == uid]
     if len(device) == 0:
         abort(404)
     #if not request.json:
     #    abort(400)
-    levels = XrfAPI.getInstance().getPWMLevels(0, uid)
-    return jsonify({'pwmlevels': levels})
+    levels = get_api().getPWMLevels(0, uid)
+    return respond({'pwmlevels': levels})
+
+
+@app.route('/xrf-api/v1.0/snapshot/<uid>', methods=['GET'])
+def device_snapshot(uid):
+    if len(uid) == 0:
+        abort(404)
+    devices = get_api().getDevices()
+    device = [device for device in devices if device['uid'] == uid]
+    if len(device) == 0:
+        abort(404)
+    snapshot = get_api().getSnapshot(uid)
+    return respond({'device': make_public_device(snapshot)})
+
+
+@app.route('/xrf-api/v1.0/shadow/<uid>', methods=['GET'])
+def get_shadow(uid):
+    devices = get_api().getDevices()
+    device = [device for device in devices if device['uid'] == uid]
+    if len(device) == 0:
+        abort(404)
+    return respond({'uid': uid, 'shadow': get_api().getShadow(uid)})
+
+
+@app.route('/xrf-api/v1.0/shadow/<uid>', methods=['PUT'])
+def set_shadow(uid):
+    devices = get_api().getDevices()
+    device = [device for device in devices if device['uid'] == uid]
+    if len(device) == 0:
+        abort(404)
+    if not request.json or 'parameters' not in request.json:
+        abort(400)
+    try:
+        for desired in request.json['parameters']:
+            xparam = desired.get('xparam')
+            get_api().setDesired(uid, int(desired['param']), int(xparam) if xparam is not None else None,
+                                 bytearray(desired['values']))
+    except (KeyError, TypeError, ValueError):
+        abort(400)
+    return respond({'uid': uid, 'shadow': get_api().getShadow(uid)})
+
+
+@app.route('/xrf-api/v1.0/scenes', methods=['GET'])
+def get_scenes():
+    return respond({'scenes': get_api().getScenes()})
+
+
+@app.route('/xrf-api/v1.0/scene/<name>', methods=['GET'])
+def get_scene(name):
+    scene = get_api().getScene(name)
+    if scene is None:
+        abort(404)
+    return respond({'scene': scene})
+
+
+@app.route('/xrf-api/v1.0/scene/<name>', methods=['PUT'])
+def set_scene(name):
+    if not request.json or not isinstance(request.json.get('levels'), dict):
+        abort(400)
+    try:
+        get_api().setScene(name, request.json['levels'], request.json.get('fade'), request.json.get('groups'))
+    except (AttributeError, TypeError, ValueError):
+        abort(400)
+    return respond({'scene': get_api().getScene(name)})
+
+
+@app.route('/xrf-api/v1.0/scene/<name>', methods=['DELETE'])
+def delete_scene(name):
+    if not get_api().deleteScene(name):
+        abort(404)
+    return respond({'result': 'success'})
+
+
+@app.route('/xrf-api/v1.0/scene/<name>/recall', methods=['POST'])
+def recall_scene(name):
+    result = get_api().recallScene(name)
+    if result is None:
+        abort(404)
+    return respond({'result': 'success', 'frames': result['frames'], 'elapsed': result['elapsed']})
+
+
+@app.route('/xrf-api/v1.0/timesync', methods=['POST'])
+def start_timesync():
+    options = request.json or dict()
+    try:
+        group = int(options.get('group', 0xFF))
+        rtcOn = options.get('rtcon')
+        rtcOff = options.get('rtcoff')
+        status = get_api().startTimeSync(group, bool(options.get('time', True)),
+                                         bytearray(rtcOn) if rtcOn is not None else None,
+                                         bytearray(rtcOff) if rtcOff is not None else None)
+    except (TypeError, ValueError):
+        abort(400)
+    return respond({'timesync': status})
+
+
+@app.route('/xrf-api/v1.0/timesync', methods=['GET'])
+def get_timesync():
+    status = get_api().getTimeSync()
+    if status is None:
+        abort(404)
+    return respond({'timesync': status})
+
+
+@app.route('/xrf-api/v1.0/dali/<uid>', methods=['POST'])
+def dali_transact(uid):
+    devices = get_api().getDevices()
+    device = [device for device in devices if device['uid'] == uid]
+    if len(device) == 0:
+        abort(404)
+    if not request.json or not isinstance(request.json.get('commands'), list):
+        abort(400)
+    try:
+        commands = [(int(address), int(opcode)) for address, opcode in request.json['commands']]
+        timeout = float(request.json.get('timeout', 30.0))
+    except (TypeError, ValueError):
+        abort(400)
+    results = get_api().daliTransact(uid, commands, timeout)
+    return respond({'uid': uid, 'results': results})
 
 
 @app.route('/xrf-api/v1.0/discover/<int:channel>', methods=['GET'])
 def discover_devices(channel):
-    XrfAPI.getInstance().setChannel(channel)
-    devices = XrfAPI.getInstance().IDRequestAll(0xFF)
-    return jsonify({'devices':  [make_public_device(device) for device in devices]})
+    get_api().setChannel(channel)
+    devices = get_api().IDRequestAll(0xFF)
+    return respond({'devices':  [make_public_device(device) for device in devices]})
 
 
 @app.route('/xrf-api/v1.0/setchannel/<int:channel>', methods=['GET'])
 def set_channel(channel):
-    XrfAPI.getInstance().setChannel(channel)
-    return jsonify({'result': 'success'})
+    get_api().setChannel(channel)
+    return respond({'result': 'success'})
+
+
+@app.route('/xrf-api/v1.0/utilization', methods=['GET'])
+def get_utilization():
+    return respond({'channels': get_api().getUtilization()})
+
+
+@app.route('/xrf-api/v1.0/status', methods=['GET'])
+def get_status():
+    status = get_api().getStatus()
+    response = respond({'status': status})
+    if status['state'] != 'ready':
+        response.status_code = 503
+    return response
+
+
+@app.route('/xrf-api/v1.0/traces', methods=['GET'])
+def get_traces():
+    limit = request.args.get('limit', 50, type=int)
+    return respond({'traces': get_api().getTraces(limit, request.args.get('name'))})
+
+
+@app.route('/xrf-api/v1.0/logging', methods=['GET'])
+def get_logging():
+    return respond(get_api().getLogging())
+
+
+@app.route('/xrf-api/v1.0/logging', methods=['PUT'])
+def set_logging():
+    if not request.json:
+        abort(400)
+    try:
+        config = get_api().setLogging(request.json.get('levels'), request.json.get('packets'))
+    except (TypeError, ValueError):
+        abort(400)
+    return respond(config)
+
+
+@app.route('/xrf-api/v1.0/packets', methods=['GET'])
+def get_packets():
+    limit = request.args.get('limit', 100, type=int)
+    return respond({'packets': get_api().getPacketLog(limit)})
+
+
+@app.route('/xrf-api/v1.0/profile', methods=['GET'])
+def get_profile():
+    seconds = request.args.get('seconds', 5.0, type=float)
+    interval = request.args.get('interval', 0.01, type=float)
+    try:
+        profile = get_api().profile(seconds, interval)
+    except ValueError:
+        abort(400)
+    if request.args.get('format', 'collapsed') == 'collapsed':
+        response = make_response(collapse(profile['stacks']))
+        response.mimetype = 'text/plain'
+        return response
+    return respond({'profile': profile})
+
+
+@app.route('/xrf-api/v1.0/threads', methods=['GET'])
+def get_threads():
+    return respond(get_api().getThreadStats())
+
+
+@app.route('/xrf-api/v1.0/metrics', methods=['GET'])
+def get_metrics():
+    return respond({'metrics': get_api().getMetrics()})
+
+
+def time_range():
+    """ start/end (epoch seconds) from the query string, defaulting to the last hour """
+    end = request.args.get('end', time.time(), type=float)
+    start = request.args.get('start', end - 3600, type=float)
+    return start, end
+
+
+@app.route('/xrf-api/v1.0/timeseries/<metric>/<uid>', methods=['GET'])
+def device_timeseries(metric, uid):
+    if metric not in METRICS:
+        abort(404)
+    start, end = time_range()
+    window = request.args.get('window', type=float)
+    if window is not None and window <= 0:
+        abort(400)
+    series = get_api().getTimeSeries(metric, uid, start, end, window)
+    return respond({'metric': metric, 'uid': uid, 'start': start, 'end': end,
+                    'window': window, 'series': series})
+
+
+@app.route('/xrf-api/v1.0/timeseries/<metric>', methods=['GET'])
+def fleet_timeseries(metric):
+    if metric not in METRICS:
+        abort(404)
+    start, end = time_range()
+    window = request.args.get('window', 300, type=float)
+    if window <= 0:
+        abort(400)
+    series = get_api().getFleetTimeSeries(metric, start, end, window)
+    return respond({'metric': metric, 'start': start, 'end': end, 'window': window,
+                    'series': series})
+
+
+@app.route('/xrf-api/v1.0/energy', methods=['GET'])
+def fleet_energy():
+    by = request.args.get('by', 'group')
+    if by not in ('group', 'model'):
+        abort(400)
+    return respond({'energy': get_api().getEnergy(by)})
+
+
+@app.route('/xrf-api/v1.0/lifetime', methods=['GET'])
+def fleet_lifetime():
+    column = request.args.get('column', 'lamphours')
+    if column not in COLUMNS:
+        abort(400)
+    threshold = request.args.get('threshold', 3.5, type=float)
+    try:
+        percentiles = [float(pct) for pct in request.args.get('percentiles', '50,90,99').split(',')]
+        lifetime = get_api().getLifetime(column, percentiles, threshold)
+    except ValueError:
+        abort(400)
+    return respond({'lifetime': lifetime})
 
 
 def get_ip_address():
@@ -108,33 +525,169 @@ def get_ip_address():
     return adapter_addr
 
 
+def run_worker(fd, address, authkey, table_path):
+    """ API worker process: serve HTTP on the shared listening socket """
+    from werkzeug.serving import make_server
+    global backend
+    backend = GatewayClient(address, authkey, table_path)
+    server = make_server('0.0.0.0', port, app, threaded=True, fd=fd)
+    server.serve_forever()
+
+
+def start_workers(count, address, authkey, table_path):
+    """ Fork API worker processes sharing one listening socket """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('0.0.0.0', port))
+    listener.listen(128)
+    workers = list()
+    for i in range(count):
+        worker = multiprocessing.Process(target=run_worker, name='XrfWorker-%d' % i,
+                                         args=(listener.fileno(), address, authkey, table_path))
+        worker.daemon = True
+        workers.append(worker)
+    return workers
+
+
+def start_discovery(loop=None):
+    """ Start the UPnP description server and SSDP announcements """
+    try:
+        device_uuid = uuid.uuid4()
+        local_ip_address = get_ip_address()
+        web_server_port = 8088
+        http_server = UPNPHTTPServer(web_server_port,
+                                     friendly_name="Xeleum Xi-Fi Gateway",
+                                     manufacturer="Xeleum Lighting",
+                                     manufacturer_url='http://www.xeleum.com/',
+                                     model_description='Xi-Fi Gateway',
+                                     model_name="Xi-F Gateway",
+                                     model_number="XRF001",
+                                     model_url="http://www.xeleum.com",
+                                     serial_number="XRF1234",
+                                     uuid=device_uuid,
+                                     presentation_url="index.html")
+
+        ssdp_server = SSDPServer()
+        ssdp_server.register('local',
+                      'uuid:{}::upnp:rootdevice'.format(device_uuid),
+                      'upnp:rootdevice',
+                      'http://{}:{}/description.xml'.format(local_ip_address,web_server_port))
+
+        if loop:
+            loop.call_soon_threadsafe(http_server.attach, loop)
+            loop.call_soon_threadsafe(ssdp_server.attach, loop)
+        else:
+            http_server.start()
+            ssdp_server.start()
+        XrfAPI.getInstance().markStartup('discovery')
+    except Exception:
+        log.exception('UPnP/SSDP discovery failed to start')
+    return
+
+
+def handle_sigterm(signum, frame):
+    """ Unwind main() on SIGTERM as on Ctrl-C, so the registry is saved on the way out """
+    sys.exit(0)
+
+
+def parse_log_levels(value):
+    """ 'INFO,xrf_shadow=DEBUG' -> {'root': 'INFO', 'xrf_shadow': 'DEBUG'} """
+    levels = dict()
+    for level in value.split(','):
+        name, _, level = level.rpartition('=')
+        levels[name or 'root'] = level
+    return levels
+
+
 def main():
-    device_uuid = uuid.uuid4()
-    local_ip_address = get_ip_address()
-    web_server_port = 8088
-    http_server = UPNPHTTPServer(web_server_port,
-                                 friendly_name="Xeleum Xi-Fi Gateway",
-                                 manufacturer="Xeleum Lighting",
-                                 manufacturer_url='http://www.xeleum.com/',
-                                 model_description='Xi-Fi Gateway',
-                                 model_name="Xi-F Gateway",
-                                 model_number="XRF001",
-                                 model_url="http://www.xeleum.com",
-                                 serial_number="XRF1234",
-                                 uuid=device_uuid,
-                                 presentation_url="index.html")
-    http_server.start()
-
-    ssdp_server = SSDPServer()
-    ssdp_server.register('local',
-                  'uuid:{}::upnp:rootdevice'.format(device_uuid),
-                  'upnp:rootdevice',
-                  'http://{}:{}/description.xml'.format(local_ip_address,web_server_port))
-    ssdp_server.start()
-
-    XrfAPI.getInstance().start()
-    app.run(debug=True, host='0.0.0.0', port=port, use_reloader=False)
+    started = time.time()
+    parser = argparse.ArgumentParser(description='Xi-Fi RESTful API gateway')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='number of API worker processes (0 serves the API in this process)')
+    parser.add_argument('--event-loop', action='store_true',
+                        help='serve SSDP, UPnP HTTP and the dongle from one event loop thread')
+    parser.add_argument('--channels', type=lambda value: [int(c) for c in value.split(',')],
+                        help='comma separated RF channels to monitor, hopping between them')
+    parser.add_argument('--poll-interval', type=int, default=0,
+                        help='seconds between telemetry polls of each fixture (0 disables polling)')
+    parser.add_argument('--log-level', type=parse_log_levels, default={},
+                        help='comma separated log levels, e.g. INFO,xrf_shadow=DEBUG (default INFO)')
+    parser.add_argument('--serial-port',
+                        help='serial device of the dongle (default: search USB ports for it)')
+    parser.add_argument('--state-file', default=default_state_path(),
+                        help='where the device registry is saved between runs (default %(default)s)')
+    args = parser.parse_args()
+    setLogLevels(args.log_level)
+    installThreadNames()
+
+    # Workers are forked before any threads start so they don't inherit the
+    # serial port or any held locks; they wait for the radio owner to appear.
+    workers = list()
+    if args.workers > 0:
+        ipc_dir = make_ipc_dir()
+        address = default_ipc_address(ipc_dir)
+        authkey = os.urandom(16)
+        table_path = default_table_path(ipc_dir)
+        workers = start_workers(args.workers, address, authkey, table_path)
+        for worker in workers:
+            worker.start()
+
+    # Everything up to serving HTTP must be quick: the dongle is attached by
+    # the comms thread in the background, and UPnP/SSDP start in a thread.
+    XrfCommsThread(port=args.serial_port)
+    loop = None
+    if args.event_loop:
+        loop = EventLoop()
+        api = XrfAPI(loop=loop)
+        loop_thread = threading.Thread(target=loop.run_forever, name='EventLoop')
+        loop_thread.daemon = True
+        loop_thread.start()
+    else:
+        api = XrfAPI.getInstance()
+        api.start()
+    api.markStartup('process', started)
+
+    # The saved registry is loaded in the background; /status reports
+    # 'starting' until it is, and SIGTERM saves it again on the way out.
+    state_cache = StateCache(api, args.state_file)
+    state_cache.start()
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+    discovery = threading.Thread(target=start_discovery, args=(loop,), name='XrfDiscovery')
+    discovery.daemon = True
+    discovery.start()
+
+    ChannelMonitor(api).install()
+    if args.channels and len(args.channels) > 1:
+        ChannelScheduler(api, args.channels).start()
+    elif args.channels:
+        api.setChannel(args.channels[0])
+
+    DeviceShadow(api).start()
+    SceneEngine(api).install()
+    TimeSync(api).install()
+    DaliGateway(api).start()
+    if args.poll_interval > 0:
+        TelemetryPoller(api, args.poll_interval).start()
+
+    if not workers:
+        api.registerMetrics('responseCache', response_cache.getStats)
+        api.markStartup('serving')
+        try:
+            app.run(debug=True, host='0.0.0.0', port=port, use_reloader=False)
+        finally:
+            state_cache.stop()
+        return
 
+    radio = RadioOwner(api, address, authkey, table_path)
+    radio.start()
+    api.markStartup('serving')
+    try:
+        for worker in workers:
+            worker.join()
+    finally:
+        state_cache.stop()
+        shutil.rmtree(ipc_dir, ignore_errors=True)
 
 if __name__ == '__main__':
     main()
@@ -5,18 +5,31 @@ XRF Protocol Driver
 from __future__ import print_function
 
 import Queue
+import copy
 import logging
 import threading
 import time
 import serial
 import serial.tools.list_ports
+from xrf_dedup import DuplicateCache
+from xrf_energy import EnergyColumns
+from xrf_packetlog import PacketLog, getLogLevels, setLogLevels
+from xrf_profiler import StackSampler, ThreadAccounting
+from xrf_queue import BoundedPacketQueue, QueueOverload, RX_QUEUE_CLASSES, TX_QUEUE_CLASSES
+from xrf_registry import DeviceRegistry
+from xrf_retry import RttTable
+from xrf_timeseries import TimeSeriesStore
+from xrf_trace import Tracer
 
 
-logging.basicConfig(level=logging.DEBUG, format='(%(asctime)-15s %(threadName)-10s) %(message)s')
+logging.basicConfig(level=logging.INFO, format='(%(asctime)-15s %(threadName)-10s) %(message)s')
+log = logging.getLogger(__name__)
 
 XRF_VERSION = 2     # version of XRF specification to be used
 XRF_MAXLEN = 61     # maximum total packet length (limited by CC430)
 XRF_HOPS = 5        # max number of hops
+XRF_BITRATE = 38400.0   # RF data rate (bits/s)
+XRF_FRAME_OVERHEAD = 12 # preamble, sync word, length and CRC bytes per frame
 
 # xrf packet header bits
 XRF_UNICAST = 0x80
@@ -196,11 +209,234 @@ class UartPacket(object):
     type = 0
     length = 0
     payload = None
+    sentAt = None
+    txClass = None          # overload class in the TX queue ('command', 'set' or 'get')
+    coalesceKey = None      # queued packets with equal keys may be merged
+    ackKey = None           # (uid, param, xparam) of the fixture ack that answers it
+    trace = None            # TraceSpan if this packet is being traced
+    onSend = None           # onSend(pkt), called just before the packet is written
+    onDrop = None           # onDrop(pkt), called if the packet is discarded unsent
+    background = False      # poll or verify traffic that may give way under load
 
     def __init__(self):
         pass
 
 
+def frameAirtime(length, hopcount=1):
+    """ Estimated seconds of airtime for a frame of length bytes, including relays """
+    return (length + XRF_FRAME_OVERHEAD) * 8 / XRF_BITRATE * max(1, hopcount or 1)
+
+
+def decodeUint8(data):
+    """ Decode a single unsigned byte """
+    return data[0]
+
+
+def decodeUint16(data):
+    """ Decode a big-endian 16-bit value """
+    return (data[0] << 8) | data[1]
+
+
+def decodeUint32(data):
+    """ Decode a big-endian 32-bit value """
+    return (data[0] << 24) | (data[1] << 16) | (data[2] << 8) | data[3]
+
+
+def decodeUint8List(data):
+    """ Decode a list of unsigned bytes """
+    return [b for b in data]
+
+
+def decodeInt8List(data):
+    """ Decode a list of signed bytes (e.g. temperatures in degrees C) """
+    return [b - 256 if b > 127 else b for b in data]
+
+
+def decodeUint16List(data):
+    """ Decode a list of big-endian 16-bit values """
+    return [(data[i] << 8) | data[i + 1] for i in range(0, len(data) - 1, 2)]
+
+
+def decodeUint32List(data):
+    """ Decode a list of big-endian 32-bit values """
+    return [decodeUint32(data[i:i + 4]) for i in range(0, len(data) - 3, 4)]
+
+
+def decodeString(data):
+    """ Decode a NUL-terminated ASCII string """
+    return bytes(data).split(b'\0')[0].decode('ascii', 'replace')
+
+
+def decodePWMLevels(data):
+    """ Decode PWM levels (occupied/unoccupied, mains/battery) """
+    pwmlevels = dict()
+    pwmlevels['occMains'] = data[0]
+    pwmlevels['occBatt'] = data[1]
+    pwmlevels['unoccMains'] = data[2]
+    pwmlevels['unoccBatt'] = data[3]
+    return pwmlevels
+
+
+def decodePowerStatus(data):
+    """ Decode power status byte(s) """
+    pwrstat = dict()
+    pwrstat['status'] = data[0]
+    if len(data) >= 3:
+        pwrstat['battery'] = decodeUint16(data[1:3])
+    return pwrstat
+
+
+def decodeGroup(data):
+    """ Decode group/channel settings """
+    groupinfo = dict()
+    groupinfo['group'] = data[0]
+    if len(data) >= 2:
+        groupinfo['channel'] = data[1]
+    return groupinfo
+
+
+def decodeFadeTimes(data):
+    """ Decode fade up/down times """
+    fadetimes = dict()
+    fadetimes['up'] = decodeUint16(data[0:2])
+    fadetimes['down'] = decodeUint16(data[2:4])
+    return fadetimes
+
+
+def decodeDaliReplies(data):
+    """ Decode a DALI batch reply: sequence, count, then (flags, backward frame) per command """
+    count = data[1]
+    if len(data) < 2 + 2 * count:
+        raise IndexError('short DALI reply')
+    daliReplies = dict()
+    daliReplies['sequence'] = data[0]
+    daliReplies['replies'] = [[data[i], data[i + 1]] for i in range(2, 2 + 2 * count, 2)]
+    return daliReplies
+
+
+# (device field, decoder) for each basic parameter that can be read back
+XRF_PARAM_DECODERS = {
+    XRF_PARAM_LIGHT: ('light', decodeUint16),
+    XRF_PARAM_TEMP: ('temperatures', decodeInt8List),
+    XRF_PARAM_PWRSTAT: ('pwrstat', decodePowerStatus),
+    XRF_PARAM_PWM: ('pwmlevels', decodePWMLevels),
+    XRF_PARAM_IPWMD: ('ipwmlevels', decodeUint8List),
+    XRF_PARAM_SWITCH: ('switches', decodeUint8),
+    XRF_PARAM_MOTIONTIME: ('motiontime', decodeUint16),
+    XRF_PARAM_SELFTEST: ('selftest', decodeUint8),
+    XRF_PARAM_GROUP: ('groupinfo', decodeGroup),
+    XRF_PARAM_SVC_TIMES: ('svctimes', decodeUint32List),
+    XRF_PARAM_FADER: ('fader', decodeUint8),
+    XRF_PARAM_LOCALEN: ('localenables', decodeUint16),
+    XRF_PARAM_REPORTEN: ('reportenables', decodeUint16),
+}
+
+# (device field, decoder) for each extended parameter that can be read back
+XRF_X_DECODERS = {
+    XRF_X_BBDIM_EN: ('bbdim', decodeUint8),
+    XRF_X_CT: ('colortemps', decodeUint16List),
+    XRF_X_LIGHTLEVELS: ('lightlevels', decodeUint16List),
+    XRF_X_TEMPLEVELS: ('templevels', decodeInt8List),
+    XRF_X_RELAY: ('relay', decodeUint8),
+    XRF_X_UNOCC_DIM: ('unoccdim', decodeUint8),
+    XRF_X_MINMAX_PWM: ('minmaxpwm', decodeUint8List),
+    XRF_X_NBATT_DIM: ('battdim', decodeUint8List),
+    XRF_X_MINMAX_FADER: ('minmaxfader', decodeUint8List),
+    XRF_X_RTC_TIME: ('rtctime', decodeUint32),
+    XRF_X_RTC_ON: ('rtcon', decodeUint8List),
+    XRF_X_RTC_OFF: ('rtcoff', decodeUint8List),
+    XRF_X_PROD_STR: ('product', decodeString),
+    XRF_X_HOPCNT: ('hopsetting', decodeUint8),
+    XRF_X_FADETIMES: ('fadetimes', decodeFadeTimes),
+    XRF_X_REPORTTIME: ('reporttime', decodeUint16),
+    XRF_X_HWSWITCHES: ('hwswitches', decodeUint8),
+    XRF_X_FW_VER: ('fwversions', decodeUint16List),
+    XRF_X_LOGLEVEL: ('loglevel', decodeUint8),
+    XRF_X_PWRFAIL_SW: ('pwrfailsw', decodeUint8),
+    XRF_X_PRODUCT_ID: ('productid', decodeUint16),
+    XRF_X_STACKTUNE: ('stacktune', decodeUint8List),
+    XRF_X_PWMAVG: ('pwmavg', decodeUint8List),
+    XRF_X_DALI: ('dali', decodeDaliReplies),
+}
+
+# Parameters read by a device snapshot, as (param, extended param) pairs.
+# Identity first so a partial snapshot is still useful, then configuration,
+# then the volatile telemetry which is cheapest to re-read later.
+XRF_SNAPSHOT_PARAMS = [
+    (XRF_PARAM_EXTENDED, XRF_X_PRODUCT_ID),
+    (XRF_PARAM_EXTENDED, XRF_X_PROD_STR),
+    (XRF_PARAM_EXTENDED, XRF_X_FW_VER),
+    (XRF_PARAM_GROUP, None),
+    (XRF_PARAM_LOCALEN, None),
+    (XRF_PARAM_REPORTEN, None),
+    (XRF_PARAM_MOTIONTIME, None),
+    (XRF_PARAM_EXTENDED, XRF_X_CT),
+    (XRF_PARAM_EXTENDED, XRF_X_FADETIMES),
+    (XRF_PARAM_EXTENDED, XRF_X_MINMAX_PWM),
+    (XRF_PARAM_EXTENDED, XRF_X_UNOCC_DIM),
+    (XRF_PARAM_EXTENDED, XRF_X_NBATT_DIM),
+    (XRF_PARAM_EXTENDED, XRF_X_REPORTTIME),
+    (XRF_PARAM_EXTENDED, XRF_X_RTC_ON),
+    (XRF_PARAM_EXTENDED, XRF_X_RTC_OFF),
+    (XRF_PARAM_PWM, None),
+    (XRF_PARAM_LIGHT, None),
+    (XRF_PARAM_TEMP, None),
+    (XRF_PARAM_PWRSTAT, None),
+    (XRF_PARAM_SVC_TIMES, None),
+    (XRF_PARAM_EXTENDED, XRF_X_PWMAVG),
+]
+
+
+def decodeParameter(param, data):
+    """ Decode a parameter value, returning (device field, value) or (None, None) """
+    if param == XRF_PARAM_EXTENDED:
+        if len(data) < 1:
+            return (None, None)
+        decoder = XRF_X_DECODERS.get(data[0])
+        data = data[1:]
+    else:
+        decoder = XRF_PARAM_DECODERS.get(param)
+    if decoder is None:
+        return (None, None)
+    field, func = decoder
+    try:
+        return (field, func(data))
+    except IndexError:
+        log.debug('Short payload for param %d', param)
+        return (None, None)
+
+
+class PendingRequest(object):
+    """ Outstanding GET awaiting its GETACK """
+    pollInterval = 0.05     # seconds between checks that the frame has been written
+
+    def __init__(self, attempt):
+        self.event = threading.Event()
+        self.packet = None
+        self.attempt = attempt
+        self.dropped = False
+
+    def fail(self, pkt=None):
+        """ The GET was discarded before it was sent; stop waiting for it """
+        self.dropped = True
+        self.event.set()
+        return
+
+    def wait(self, timeout, sendTimeout):
+        """ Wait up to timeout for the GETACK, counted from when the frame was
+        written to the dongle rather than from when it was queued, so time
+        spent behind TX pacing and other traffic doesn't count against the
+        round trip. Gives up if the frame isn't written within sendTimeout.
+        Returns True if the GETACK arrived. """
+        queued = time.time()
+        while self.packet.sentAt is None:
+            if self.event.wait(self.pollInterval):
+                return not self.dropped
+            if time.time() - queued > sendTimeout:
+                return False
+        return self.event.wait(max(0, self.packet.sentAt + timeout - time.time())) and not self.dropped
+
+
 def get_serial_port():
     """ Get name of the serial port device to use """
     comports = serial.tools.list_ports.comports()
@@ -214,6 +450,8 @@ class XrfCommsThread(threading.Thread):
     """ XRF Protocol Thread """
     defaultHops = 1
     channel = 2
+    maxHeld = 256           # packets held per channel while the dongle is tuned elsewhere
+    hotplugInterval = 2.0   # seconds between attempts to find the dongle while it's missing
 
     # Here will be the instance stored.
     __instance = None
@@ -226,7 +464,7 @@ class XrfCommsThread(threading.Thread):
         return XrfCommsThread.__instance
 
     def __init__(self, group=None, target=None, name="XrfComms",
-                 args=(), kwargs=None, verbose=None):
+                 args=(), kwargs=None, verbose=None, port=None):
         """ Constructor for XrfCommsThread object """
         if XrfCommsThread.__instance != None:
             raise Exception("This class is a singleton!")
@@ -237,28 +475,82 @@ class XrfCommsThread(threading.Thread):
                                   verbose=verbose)
         self.args = args
         self.kwargs = kwargs
-        self.txQueue = Queue.Queue()
-        self.rxQueue = Queue.Queue()
+        self.txQueue = BoundedPacketQueue(TX_QUEUE_CLASSES)
+        self.rxQueue = BoundedPacketQueue(RX_QUEUE_CLASSES)
         self.state = XRF_IDLE
         self.rxPkt = None
+        self.loop = None
+        self.rxHandler = None
+        self.txBusy = False
+        self.channelResolver = None
+        self.channelLock = threading.RLock()
+        self.heldPackets = dict()
+        self.heldDropped = 0
+        self.tracer = None
+        self.packetLog = None
+
+        # The dongle is found and opened by run() (or attach()), retrying
+        # until it appears, so nothing here waits on USB enumeration.
+        self.port = port            # fixed serial port, or None to search for the dongle
+        self.serial = None
+        self.link = {'attached': False, 'port': None, 'since': None, 'firstAttached': None,
+                     'attempts': 0, 'detaches': 0, 'lastError': None}
+        return
 
-        port = get_serial_port()
-        if port:
-            logging.debug('opening serial port %s', port)
+    def openSerial(self):
+        """ Try once to find and open the dongle; True if it is now attached """
+        self.link['attempts'] += 1
+        try:
+            port = self.port or get_serial_port()
+            if port is None:
+                raise serial.SerialException('no Xi-Fi dongle detected')
+            log.debug('opening serial port %s', port)
             self.serial = serial.Serial(port, 115200, timeout=0.1)
-        else:
-            logging.error('no Xi-Fi dongle detected')
-            assert port != None
+        except (serial.SerialException, OSError) as err:
+            if self.link['lastError'] != str(err):
+                log.warning('dongle unavailable: %s', err)
+            self.link['lastError'] = str(err)
+            return False
+
+        log.info('dongle attached on %s', port)
+        now = time.time()
+        self.state = UMSGST_IDLE
+        self.link.update(attached=True, port=port, since=now, lastError=None)
+        if self.link['firstAttached'] is None:
+            self.link['firstAttached'] = now
+        elif self.link['detaches']:
+            self.dongleSetChannel(self.channel)     # a replugged dongle comes back on its default channel
+        return True
+
+    def closeSerial(self, err):
+        """ Forget a dongle that has gone away; it is searched for again """
+        log.warning('dongle detached: %s', err)
+        try:
+            self.serial.close()
+        except Exception:
+            pass
+        self.serial = None
+        self.link['detaches'] += 1
+        self.link.update(attached=False, since=time.time(), lastError=str(err))
         return
 
+    def getLink(self):
+        """ State of the serial link to the dongle """
+        return dict(self.link)
+
     def transmit_packet(self, pkt):
         """ Transmit an XRF TX command to the dongle """
         assert pkt.__class__.__name__ == 'UartPacket'
+        if pkt.onSend:
+            pkt.onSend(pkt)
         buff = bytearray([pkt.type, pkt.length])
         buff += pkt.payload
-        #debugstr = "".join("%02x " % b for b in buff)
-        #logging.debug(' TX: len=%d, %s' % (len(buff), debugStr))
         self.serial.write(buff)
+        pkt.sentAt = time.time()
+        if self.packetLog:
+            self.packetLog.record('W', pkt.payload)
+        if pkt.trace:
+            self.tracer.packetWritten(pkt)
         return
 
     def new_packet(self, pkt_type):
@@ -286,32 +578,177 @@ class XrfCommsThread(threading.Thread):
             elif self.state == UMSGST_DATA:
                 self.rxPkt.payload.append(ch)
                 if len(self.rxPkt.payload) >= self.rxPkt.length - 2:
-                    self.rxQueue.put(self.rxPkt)
+                    if self.rxHandler:
+                        self.rxHandler(self.rxPkt)
+                    else:
+                        self.rxQueue.put(self.rxPkt)
                     self.state = UMSGST_IDLE
             else:
-                logging.debug('Invalid state')
+                log.debug('Invalid state')
         return
 
     def run(self):
-        logging.debug('running with %s and %s', self.args, self.kwargs)
+        log.debug('running with %s and %s', self.args, self.kwargs)
         # pdb.set_trace()
 
         while True:
-            while self.serial.inWaiting() > 0:
-                try:
+            if self.serial is None and not self.openSerial():
+                time.sleep(self.hotplugInterval)
+                continue
+
+            try:
+                while self.serial.inWaiting() > 0:
                     buff = self.serial.read(256)
-                    #logging.debug('RX:%s', buff.encode('hex'))
-                    self.parse_buff(buff)
-                except:
-                    pass
+                    try:
+                        #logging.debug('RX:%s', buff.encode('hex'))
+                        self.parse_buff(buff)
+                    except:
+                        pass
+
+                while not self.txQueue.empty():
+                    pkt = self.txQueue.get()
+                    self.transmit_packet(pkt)
+                    if not self.txQueue.empty():
+                        time.sleep(0.1)     # short time delay if we're going to send multiple packets
+            except (serial.SerialException, OSError, IOError) as err:
+                self.closeSerial(err)
+
+        log.debug('exiting thread')
+        return
+
+    def attach(self, loop, rxHandler):
+        """ Serve the serial port from an event loop instead of running the thread """
+        self.loop = loop
+        self.rxHandler = rxHandler
+        loop.call_soon_threadsafe(self.attachSerial)
+        return
+
+    def attachSerial(self):
+        """ Event loop callback: open the dongle and start reading it, retrying until it appears """
+        if not self.openSerial():
+            self.loop.call_later(self.hotplugInterval, self.attachSerial)
+            return
+        self.loop.add_reader(self.serial.fileno(), self.readSerial)
+        self.startTx()
+        return
+
+    def detachSerial(self, err):
+        """ Event loop callback: stop reading a dongle that has gone away and look for it again """
+        self.loop.remove_reader(self.serial.fileno())
+        self.closeSerial(err)
+        self.loop.call_later(self.hotplugInterval, self.attachSerial)
+        return
+
+    def readSerial(self):
+        """ Event loop callback: the serial port is readable """
+        try:
+            buff = self.serial.read(max(1, self.serial.inWaiting()))
+        except (serial.SerialException, OSError, IOError) as err:
+            self.detachSerial(err)
+            return
+        try:
+            self.parse_buff(buff)
+        except Exception:
+            log.exception('failed to parse data from the dongle')
+        return
+
+    def queuePacket(self, pkt):
+        """ Queue a packet for transmission to the dongle (raises QueueOverload if full).
+
+        If a channel resolver is installed, RF packets are pinned to the
+        channel(s) of their targets and held until the dongle is tuned there.
+        """
+        if pkt.txClass is None:
+            pkt.txClass = 'command' if pkt.type == UMSG_CMD else 'get'
+        if self.tracer:
+            self.tracer.packetQueued(pkt)
+        channels = None
+        if self.channelResolver and pkt.type == UMSG_TXPKT:
+            channels = self.channelResolver(pkt)
+        if not channels:
+            self.enqueuePacket(pkt)
+            return
+
+        self.channelLock.acquire()
+        try:
+            for i, channel in enumerate(channels):
+                channelPkt = pkt if i == 0 else copy.copy(pkt)
+                if channel == self.channel:
+                    self.enqueuePacket(channelPkt)
+                else:
+                    held = self.heldPackets.setdefault(channel, list())
+                    if len(held) >= self.maxHeld:
+                        dropped = held.pop(0)
+                        self.heldDropped += 1
+                        if dropped.onDrop:
+                            dropped.onDrop(dropped)
+                    held.append(channelPkt)
+        finally:
+            self.channelLock.release()
+        return
+
+    def enqueuePacket(self, pkt):
+        """ Put a packet on the TX queue for the current channel """
+        self.txQueue.put(pkt)
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.startTx)
+        return
+
+    def switchChannel(self, channel, onSend=None):
+        """ Retune the dongle and release the packets held for that channel.
+
+        The channel command goes through the TX FIFO, so anything queued
+        before it is still sent on the old channel. onSend(pkt) is called as
+        the command is written, which is when the dongle actually retunes.
+        """
+        self.channelLock.acquire()
+        try:
+            self.dongleSetChannel(channel, onSend)
+            for pkt in self.heldPackets.pop(channel, list()):
+                try:
+                    self.enqueuePacket(pkt)
+                except QueueOverload:
+                    self.heldDropped += 1
+                    if pkt.onDrop:
+                        pkt.onDrop(pkt)
+        finally:
+            self.channelLock.release()
+        return
 
-            while not self.txQueue.empty():
-                pkt = self.txQueue.get()
-                self.transmit_packet(pkt)
-                if not self.txQueue.empty():
-                    time.sleep(0.1)         # short time delay if we're going to send multiple packets
+    def getHeldCounts(self):
+        """ Number of packets held for each channel """
+        self.channelLock.acquire()
+        counts = dict((channel, len(held)) for channel, held in self.heldPackets.items())
+        self.channelLock.release()
+        return counts
+
+    def startTx(self):
+        """ Event loop callback: start sending queued packets if not already doing so """
+        if not self.txBusy:
+            self.txBusy = True
+            self.pumpTx()
+        return
 
-        logging.debug('exiting thread')
+    def pumpTx(self):
+        """ Event loop callback: send one packet, pacing any that follow as run() does """
+        if self.serial is None:
+            self.txBusy = False         # attachSerial() restarts sending
+            return
+        try:
+            pkt = self.txQueue.get_nowait()
+        except Queue.Empty:
+            self.txBusy = False
+            return
+        try:
+            self.transmit_packet(pkt)
+        except (serial.SerialException, OSError, IOError) as err:
+            self.txBusy = False
+            self.detachSerial(err)
+            return
+        if self.txQueue.empty():
+            self.txBusy = False
+        else:
+            self.loop.call_later(0.1, self.pumpTx)
         return
 
     def setHopCount(self, hops):
@@ -324,7 +761,7 @@ class XrfCommsThread(threading.Thread):
         uart_pkt.type = UMSG_CMD
         uart_pkt.length = len(buff) + 2
         uart_pkt.payload = buff
-        self.txQueue.put(uart_pkt)
+        self.queuePacket(uart_pkt)
         return
 
     def dongleGetInfo(self):
@@ -334,17 +771,18 @@ class XrfCommsThread(threading.Thread):
         uart_pkt.type = UMSG_CMD
         uart_pkt.length = len(buff) + 2
         uart_pkt.payload = buff
-        self.txQueue.put(uart_pkt)
+        self.queuePacket(uart_pkt)
         return
 
-    def dongleSetChannel(self, channel):
+    def dongleSetChannel(self, channel, onSend=None):
         """ Set the radio channel (stairwell #) on the dongle """
         buff = bytearray([UCMD_CHANNEL, channel])
         uart_pkt = UartPacket()
         uart_pkt.type = UMSG_CMD
         uart_pkt.length = len(buff) + 2
         uart_pkt.payload = buff
-        self.txQueue.put(uart_pkt)
+        uart_pkt.onSend = onSend
+        self.queuePacket(uart_pkt)
         self.channel = channel
         return
 
@@ -355,7 +793,7 @@ class XrfCommsThread(threading.Thread):
         uart_pkt.type = UMSG_CMD
         uart_pkt.length = len(buff) + 2
         uart_pkt.payload = buff
-        self.txQueue.put(uart_pkt)
+        self.queuePacket(uart_pkt)
         return
 
     def dongleEnableMesh(self, enableMesh):
@@ -365,7 +803,7 @@ class XrfCommsThread(threading.Thread):
         uart_pkt.type = UMSG_CMD
         uart_pkt.length = len(buff) + 2
         uart_pkt.payload = buff
-        self.txQueue.put(uart_pkt)
+        self.queuePacket(uart_pkt)
         return
 
     def dongleEnableReport(self, enableReport):
@@ -375,7 +813,7 @@ class XrfCommsThread(threading.Thread):
         uart_pkt.type = UMSG_CMD
         uart_pkt.length = len(buff) + 2
         uart_pkt.payload = buff
-        self.txQueue.put(uart_pkt)
+        self.queuePacket(uart_pkt)
         return
 
     def dongleSetLogLevel(self, logLevel):
@@ -385,7 +823,7 @@ class XrfCommsThread(threading.Thread):
         uart_pkt.type = UMSG_CMD
         uart_pkt.length = len(buff) + 2
         uart_pkt.payload = buff
-        self.txQueue.put(uart_pkt)
+        self.queuePacket(uart_pkt)
         return
 
     def dongleTestMode(self, testMode):
@@ -395,10 +833,10 @@ class XrfCommsThread(threading.Thread):
         uart_pkt.type = UMSG_CMD
         uart_pkt.length = len(buff) + 2
         uart_pkt.payload = buff
-        self.txQueue.put(uart_pkt)
+        self.queuePacket(uart_pkt)
         return
 
-    def rfIDRequestAll(self, group):
+    def rfIDRequestAll(self, group, hops=None):
         """ Request ID from all devices on current channel and specified group """
         pkttype = XRF_TYPE_ID
         unicast = 0
@@ -406,16 +844,17 @@ class XrfCommsThread(threading.Thread):
         header = pkttype << XRF_TYPE_SHIFT
         header |= param & XRF_PARAM_SHIFT
         header |= unicast << 7
-        hops = self.defaultHops
+        if hops is None:
+            hops = self.defaultHops
         buff = bytearray([3, header, hops, group])
         uart_pkt = UartPacket()
         uart_pkt.type = UMSG_TXPKT
         uart_pkt.length = len(buff) + 2
         uart_pkt.payload = buff
-        self.txQueue.put(uart_pkt)
+        self.queuePacket(uart_pkt)
         return
 
-    def rfGetParameter(self, param, group, uid):
+    def rfGetParameter(self, param, group, uid, values=None, hops=None, background=False, onDrop=None):
         """ Request specified parameter from group of specific fixture """
         pkttype = XRF_TYPE_GET
         unicast = 0
@@ -424,22 +863,30 @@ class XrfCommsThread(threading.Thread):
         header = pkttype << XRF_TYPE_SHIFT
         header |= param & XRF_PARAM_SHIFT
         header |= unicast << 7
-        hops = self.defaultHops
+        if hops is None:
+            hops = self.defaultHops
         buff = bytearray([0, header, hops])
         if uid != None:
             buff += bytearray.fromhex(uid)
         else:
             buff += chr(group)
+        if values != None:
+            buff += values
         buff[0] = len(buff) - 1
         uart_pkt = UartPacket()
         uart_pkt.type = UMSG_TXPKT
         uart_pkt.length = len(buff) + 2
         uart_pkt.payload = buff
-        self.txQueue.put(uart_pkt)
-        return
+        uart_pkt.background = background
+        uart_pkt.onDrop = onDrop
+        if uid != None:
+            uart_pkt.ackKey = (uid, param, values[0] if param == XRF_PARAM_EXTENDED and values else None)
+        self.queuePacket(uart_pkt)
+        return uart_pkt
 
-    def rfSetParameter(self, param, group, uid, values):
-        """ Set parameter(s) on group or specified fixture """
+    def rfSetParameter(self, param, group, uid, values, hops=None, onSend=None):
+        """ Set parameter(s) on group or specified fixture.
+        onSend(pkt) may rewrite the values as the frame is written. """
         pkttype = XRF_TYPE_SET
         unicast = 0
         if uid != None:
@@ -447,7 +894,8 @@ class XrfCommsThread(threading.Thread):
         header = pkttype << XRF_TYPE_SHIFT
         header |= param & XRF_PARAM_SHIFT
         header |= unicast << 7
-        hops = self.defaultHops
+        if hops is None:
+            hops = self.defaultHops
         buff = bytearray([0, header, hops])
         if uid != None:
             buff += bytearray.fromhex(uid)
@@ -457,25 +905,42 @@ class XrfCommsThread(threading.Thread):
             buff += values
         buff[0] = len(buff) - 1
 
-        debugStr = ''.join('%02x ' % b for b in buff)
-        print('setParam: ' + debugStr)
-
         uart_pkt = UartPacket()
         uart_pkt.type = UMSG_TXPKT
         uart_pkt.length = len(buff) + 2
         uart_pkt.payload = buff
-        self.txQueue.put(uart_pkt)
-        return
+        uart_pkt.txClass = 'set'
+        uart_pkt.onSend = onSend
+        xparam = values[0] if param == XRF_PARAM_EXTENDED and values else None
+        if uid != None:
+            uart_pkt.ackKey = (uid, param, xparam)
+        # the hop limit is part of the key: a broadcast limited to fewer hops
+        # reaches a different set of fixtures, so it can't supersede another.
+        # DALI batches are commands rather than values and never coalesce.
+        if xparam != XRF_X_DALI:
+            uart_pkt.coalesceKey = (param, xparam, uid if uid != None else group, hops)
+        self.queuePacket(uart_pkt)
+        return uart_pkt
+
+    def rfGetExtParameter(self, xparam, group, uid, hops=None, background=False, onDrop=None):
+        """ Request specified extended parameter from group or specific fixture """
+        return self.rfGetParameter(XRF_PARAM_EXTENDED, group, uid, bytearray([xparam]), hops,
+                                   background, onDrop)
+
+    def rfSetExtParameter(self, xparam, group, uid, values, hops=None, onSend=None):
+        """ Set extended parameter on group or specified fixture """
+        buff = bytearray([xparam])
+        if values != None:
+            buff += values
+        return self.rfSetParameter(XRF_PARAM_EXTENDED, group, uid, buff, hops, onSend)
 
-    def rfSetPWMLevel(self, group, uid, pwmLevels):
+    def rfSetPWMLevel(self, group, uid, pwmLevels, hops=None):
         """ Set PWM levels on group or specified fixture """
-        self.rfSetParameter(XRF_PARAM_PWM, group, uid, pwmLevels)
-        return
+        return self.rfSetParameter(XRF_PARAM_PWM, group, uid, pwmLevels, hops)
 
-    def rfGetPWMLevel(self, group, uid):
+    def rfGetPWMLevel(self, group, uid, hops=None):
         """ Get PWN levels from group or specified fixture """
-        self.rfGetParameter(XRF_PARAM_IPWM, group, uid)
-        return
+        return self.rfGetParameter(XRF_PARAM_IPWM, group, uid, None, hops)
 
 
 class XrfAPI(threading.Thread):
@@ -483,8 +948,13 @@ class XrfAPI(threading.Thread):
     # Here will be the instance stored.
     __instance = None
     discoveredDevices = None
+    startupGrace = 30.0     # seconds to wait for the dongle before reporting 'degraded'
     deviceLock = None
     currentChannel = 1
+    hopMargin = 1           # extra hops allowed beyond a fixture's observed hopcount
+    maxRetries = 3          # retransmissions of a GET before giving up
+    sendTimeout = 30.0      # seconds a queued GET may wait to be written before it counts as lost
+    retuneSettle = 0.05     # seconds after a channel command is written before RX is trusted again
 
 
     @staticmethod
@@ -495,7 +965,7 @@ class XrfAPI(threading.Thread):
         return XrfAPI.__instance
 
     def __init__(self, group=None, target=None, name="XrfAPI",
-                 args=(), kwargs=None, verbose=None):
+                 args=(), kwargs=None, verbose=None, loop=None):
         """ Constructor for XrfAPI object """
         if XrfAPI.__instance != None:
             raise Exception("This class is a singleton!")
@@ -506,11 +976,50 @@ class XrfAPI(threading.Thread):
                                   verbose=verbose)
         self.args = args
         self.xrfThread = XrfCommsThread.getInstance()
-        self.xrfThread.start()
-        self.discoveredDevices = dict()
+        self.tracer = Tracer()
+        self.xrfThread.tracer = self.tracer
+        self.packetLog = PacketLog(describe=self.describePacket)
+        self.xrfThread.packetLog = self.packetLog
+        self.sampler = StackSampler()
+        self.threadAccounting = ThreadAccounting()
+        self.loop = loop
+        if loop:
+            self.xrfThread.attach(loop, self.handlePacket)
+        else:
+            self.xrfThread.start()
+        self.discoveredDevices = DeviceRegistry(onEvict=self.forgetDevice, onRestore=self.recallDevice,
+                                                onCreate=self.discoverDevice)
         self.deviceLock = threading.Lock()
         self.currentChannel = 1
         self.ack_event = threading.Event()
+        self.pendingGets = dict()      # (uid, param, xparam) -> list of PendingRequest
+        self.hopBoost = dict()
+        self.rtt = RttTable()
+        self.metrics = {'successes': 0, 'retries': 0, 'failures': 0, 'retuneDropped': 0}
+        self.retuneUntil = 0
+        self.restoring = False      # True while a saved registry is being loaded
+        self.duplicates = DuplicateCache()
+        self.version = 0
+        self.channelRx = dict()
+        self.paramTimes = dict()
+        self.metricSources = dict()
+        self.shadow = None
+        self.scenes = None
+        self.timeSync = None
+        self.dali = None
+        self.utilization = None
+        self.fieldListeners = list()
+        self.radioListeners = list()
+        self.timeSeries = TimeSeriesStore()
+        self.addFieldListener(self.timeSeries.recordField)
+        self.registerMetrics('timeseries', self.timeSeries.getStats)
+        self.energy = EnergyColumns()
+        self.addFieldListener(self.energy.recordField)
+        self.registerMetrics('energy', self.energy.getStats)
+        self.registerMetrics('traces', self.tracer.getStats)
+        self.registerMetrics('registry', self.discoveredDevices.getStats)
+        self.registerMetrics('profiler', self.sampler.getStats)
+        self.startup = {'api': time.time()}
         return
 
     def run(self):
@@ -518,25 +1027,31 @@ class XrfAPI(threading.Thread):
         while True:
             if not self.xrfThread.rxQueue.empty():
                 pkt = self.xrfThread.rxQueue.get()
-                #debugStr = 'RX packet: '.join('%02x ' % b for b in pkt.payload)
-                #print(debugStr)
-                if pkt.type == 'L':
-                    try:
-                        dbgstr = pkt.payload.decode('ascii')
-                        dbgstr = dbgstr.rstrip('\r\n')
-                        logging.debug('DBG: ' + dbgstr)
-                    except:
-                        pass
-                elif pkt.type == 'R':
-                    self.parseRxPacket(pkt.payload)
-                elif pkt.type == 'T':
-                    debugStr = ''.join('%02x' % b for b in pkt.payload)
-                    print('TX packet ' + debugStr)
-                elif pkt.type == 'C':
-                    debugStr = ''.join('%02x' % b for b in pkt.payload)
-                    print('Dongle command ' + debugStr)
-                else:
-                    print('unknown type %c' % pkt.type)
+                try:
+                    self.handlePacket(pkt)
+                except Exception:
+                    log.exception('failed to handle packet %r', pkt.payload)
+        return
+
+    def handlePacket(self, pkt):
+        """ Dispatch a packet received from the dongle """
+        if pkt.type == 'L':
+            if log.isEnabledFor(logging.DEBUG):
+                try:
+                    log.debug('DBG: %s', pkt.payload.decode('ascii').rstrip('\r\n'))
+                except:
+                    pass
+        elif pkt.type == 'R':
+            self.packetLog.record('R', pkt.payload)
+            self.parseRxPacket(pkt.payload)
+        elif pkt.type == 'T':
+            self.packetLog.record('T', pkt.payload)
+            self.notifyRadio('T', pkt.payload, False)
+            self.tracer.echoed(pkt.payload)
+        elif pkt.type == 'C':
+            self.packetLog.record('C', pkt.payload)
+        else:
+            log.warning('unknown packet type %r', pkt.type)
         return
 
     def typeToName(self, type):
@@ -595,6 +1110,21 @@ class XrfAPI(threading.Thread):
             return "Extended Parameter"
         return str(param)
 
+    def describePacket(self, kind, data):
+        """ Decoded header fields of a logged frame (see PacketLog) """
+        if len(data) < 4:
+            return {}
+        packet = {'type': self.typeToName((data[1] & 0x70) >> 4),
+                  'param': self.paramToName(data[1] & 0x0F), 'hops': data[2]}
+        if kind == 'R':
+            packet['group'] = data[3]
+            packet['uid'] = ''.join('%02x' % b for b in data[4:12])
+        elif data[1] & XRF_UNICAST:
+            packet['uid'] = ''.join('%02x' % b for b in data[3:11])
+        else:
+            packet['group'] = data[3]
+        return packet
+
     def modelToString(self, model):
         """ Convert model number to a string """
         if model == 0:
@@ -611,8 +1141,6 @@ class XrfAPI(threading.Thread):
 
     def parseRxPacket(self, payload):
         """ Parse a received packet, updating the device database as necessary """
-        #debugStr = "".join("%02x " % b for b in payload)
-        #logging.debug(debugStr)
         length = payload[0]
         msgheader = payload[1]
         unicast = msgheader | 0x80
@@ -620,105 +1148,310 @@ class XrfAPI(threading.Thread):
         msgparam = (msgheader & 0x0F)
         hopcount = payload[2]
         group = payload[3]
-        typename = self.typeToName(msgtype)
-        paramName = self.paramToName(msgparam)
-        logging.debug('RX: type=%s, param=%s, hop=%d, group=%d' % (typename, paramName, hopcount, group))
 
+        # heard while the dongle was switching, so there's no telling which channel it came from
+        if time.time() < self.retuneUntil:
+            self.metrics['retuneDropped'] += 1
+            return
+
+        # Relayed copies of the same report differ only in hop count, so drop
+        # them before they cost a lock, a log line and a device update.
+        if msgtype == XRF_TYPE_IDACK or msgtype == XRF_TYPE_REPORTACK:
+            key = (bytes(payload[4:12]), msgheader, hash(bytes(payload[12:])))
+            if self.duplicates.seen(key):
+                self.notifyRadio('R', payload, True)
+                return
+        self.notifyRadio('R', payload, False)
+
+        self.channelRx[self.currentChannel] = self.channelRx.get(self.currentChannel, 0) + 1
+
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('RX: type=%s, param=%s, hop=%d, group=%d',
+                      self.typeToName(msgtype), self.paramToName(msgparam), hopcount, group)
+
+        # a malformed frame must not leave the lock held and hang every API call
         self.deviceLock.acquire()
+        try:
+            if msgtype == XRF_TYPE_ID:
+                log.debug('XRF_TYPE_ID')
+
+            elif msgtype == XRF_TYPE_IDACK:
+                #logging.debug('XRF_TYPE_IDACK')
+                uid = bytearray([payload[4], payload[5], payload[6], payload[7], payload[8], payload[9], payload[10], payload[11]])
+                uidStr = "".join("%02x" % b for b in uid)
+                model = payload[13]
+                modelStr = self.modelToString(model)
+                version = payload[12] * 10
+
+                device = self.discoveredDevices.observe(uidStr, confirmed=True)
+                if device.get('model') != modelStr:
+                    self.notifyField(uidStr, 'model', modelStr)
+                if device.get('group') != group:
+                    self.notifyField(uidStr, 'group', group)
+                registry = self.discoveredDevices
+                registry.setField(uidStr, device, 'model', modelStr)
+                registry.setField(uidStr, device, 'group', group)
+                registry.setField(uidStr, device, 'hopcount', hopcount)
+                registry.setField(uidStr, device, 'channel', self.currentChannel)
+                device['fwversion'] = version
+
+
+            elif msgtype == XRF_TYPE_GETACK:
+                log.debug('XRF_TYPE_GETACK')
+
+                uid = bytearray([payload[4], payload[5], payload[6], payload[7], payload[8], payload[9], payload[10], payload[11]])
+                uidStr = "".join("%02x" % b for b in uid)
+
+                device = self.discoveredDevices.observe(uidStr, confirmed=True)
+
+                data = payload[12:]
+                field, value = decodeParameter(msgparam, data)
+                if field:
+                    self.updateField(uidStr, device, field, value)
+                device['ackPending'] = False
+
+                xparam = None
+                if msgparam == XRF_PARAM_EXTENDED and len(data) > 0:
+                    xparam = data[0]
+                self.hopBoost.pop(uidStr, None)
+                self.tracer.acked((uidStr, msgparam, xparam))
+                waiters = self.pendingGets.pop((uidStr, msgparam, xparam), ())
+                if len(waiters) == 1:
+                    # Karn's rule: only a lone first attempt gives an unambiguous RTT
+                    pending = waiters[0]
+                    if pending.attempt == 0 and pending.packet and pending.packet.sentAt:
+                        self.rtt.sample(uidStr, hopcount, time.time() - pending.packet.sentAt)
+                for pending in waiters:
+                    pending.event.set()
+
+                self.ack_event.set()
+
+
+            elif msgtype == XRF_TYPE_SETACK:
+                uid = bytearray([payload[4], payload[5], payload[6], payload[7], payload[8], payload[9], payload[10], payload[11]])
+                uidStr = "".join("%02x" % b for b in uid)
+
+                device = self.discoveredDevices.observe(uidStr, confirmed=True)
+
+                # the ack echoes the value now in effect; if it doesn't decode,
+                # listeners still learn which parameter was acknowledged
+                data = payload[12:]
+                xparam = data[0] if msgparam == XRF_PARAM_EXTENDED and len(data) > 0 else None
+                field, value = decodeParameter(msgparam, data)
+                if field:
+                    self.updateField(uidStr, device, field, value)
+                else:
+                    self.notifyField(uidStr, 'setack', (msgparam, xparam))
+                self.hopBoost.pop(uidStr, None)
+                self.tracer.acked((uidStr, msgparam, xparam))
+
+
+            elif msgtype == XRF_TYPE_REPORTACK:
+                #logging.debug('XRF_TYPE_REPORTACK')
+                uid = bytearray([payload[4], payload[5], payload[6], payload[7], payload[8], payload[9], payload[10], payload[11]])
+                uidStr = "".join("%02x" % b for b in uid)
+
+                # Get/create device object
+                device = self.discoveredDevices.observe(uidStr)
+
+                if device.get('group') != group:
+                    self.notifyField(uidStr, 'group', group)
+                registry = self.discoveredDevices
+                registry.setField(uidStr, device, 'group', group)
+                registry.setField(uidStr, device, 'hopcount', hopcount)
+                registry.setField(uidStr, device, 'channel', self.currentChannel)
+
+                if msgparam == XRF_PARAM_MOTIONSIMPLE:
+                    timestamp = time.ctime()
+                    device['lastmotion'] = timestamp
+                    device['lastmotiontype'] = 'simple'
+                    registry.motionAt(uidStr, time.time())
+                    self.notifyField(uidStr, 'motion', 'simple')
+
+                elif msgparam == XRF_PARAM_MOTIONFANCY:
+                    timestamp = time.ctime()
+                    device['lastmotion'] = timestamp
+                    device['lastmotiontype'] = 'fancy'
+                    registry.motionAt(uidStr, time.time())
+                    self.notifyField(uidStr, 'motion', 'fancy')
 
-        if msgtype == XRF_TYPE_ID:
-            logging.debug('XRF_TYPE_ID')
+                else:
+                    field, value = decodeParameter(msgparam, payload[12:])
+                    if field:
+                        self.updateField(uidStr, device, field, value)
 
-        elif msgtype == XRF_TYPE_IDACK:
-            #logging.debug('XRF_TYPE_IDACK')
-            uid = bytearray([payload[4], payload[5], payload[6], payload[7], payload[8], payload[9], payload[10], payload[11]])
-            uidStr = "".join("%02x" % b for b in uid)
-            model = payload[13]
-            modelStr = self.modelToString(model)
-            version = payload[12] * 10
+                self.ack_event.set()
 
-            device = self.discoveredDevices.get(uidStr)
-            if not device:
-                logging.debug('Discovered new device ' + uidStr)
-                device = dict()
-                self.discoveredDevices[uidStr] = device
             else:
-                logging.debug('Discovered existing device ' + uidStr)
-            device['model'] = modelStr
-            device['group'] = group
-            device['hopcount'] = hopcount
-            device['channel'] = self.currentChannel
-            device['fwversion'] = version
+                log.debug('Unsupported (yet!) msg type %d (%s)', msgtype, self.typeToName(msgtype))
 
+            if msgtype in (XRF_TYPE_IDACK, XRF_TYPE_GETACK, XRF_TYPE_SETACK, XRF_TYPE_REPORTACK):
+                self.version += 1
+        finally:
+            self.deviceLock.release()
+        return
 
-        elif msgtype == XRF_TYPE_GETACK:
-            logging.debug('XRF_TYPE_GETACK')
-            debugStr = "".join("%02x " % b for b in payload)
-            print(debugStr)
 
-            uid = bytearray([payload[4], payload[5], payload[6], payload[7], payload[8], payload[9], payload[10], payload[11]])
-            uidStr = "".join("%02x" % b for b in uid)
+    def forgetDevice(self, uidStr, device):
+        """ Drop per-fixture state of a device evicted from the registry (deviceLock held) """
+        for field in device:
+            self.paramTimes.pop((uidStr, field), None)
+        self.hopBoost.pop(uidStr, None)
+        self.rtt.forget(uidStr)
+        self.timeSeries.forget(uidStr)
+        self.energy.forget(uidStr)
+        if self.shadow:
+            self.shadow.forget(uidStr)
+        return
 
-            device = self.discoveredDevices.get(uidStr)
-            if not device:
-                logging.debug('Discovered new device ' + uidStr)
-                device = dict()
-                self.discoveredDevices[uidStr] = device
-            else:
-                logging.debug('Discovered existing device ' + uidStr)
-
-            if msgparam == XRF_PARAM_PWM:
-                pwmlevels = dict()
-                pwmlevels['occMains'] = payload[12]
-                pwmlevels['occBatt'] = payload[13]
-                pwmlevels['unoccMains'] = payload[14]
-                pwmlevels['unoccBatt'] = payload[15]
-                device['pwmlevels'] = pwmlevels
-                device['ackPending'] = False
 
-            self.ack_event.set()
+    def recallDevice(self, uidStr, device):
+        """ Tell field listeners the addressing of a device reinstated from a
+        tombstone or restored from the state cache, which won't be notified
+        again when it is heard from unless it has changed (deviceLock held) """
+        for field in ('model', 'group'):
+            if field in device:
+                self.notifyField(uidStr, field, device[field])
+        return
 
 
-        elif msgtype == XRF_TYPE_REPORTACK:
-            #logging.debug('XRF_TYPE_REPORTACK')
-            uid = bytearray([payload[4], payload[5], payload[6], payload[7], payload[8], payload[9], payload[10], payload[11]])
-            uidStr = "".join("%02x" % b for b in uid)
+    def discoverDevice(self, uidStr, device):
+        """ Tell field listeners about a fixture heard from for the first time,
+        whichever kind of frame it was (deviceLock held) """
+        self.notifyField(uidStr, 'discovered', True)
+        return
 
-            # Get/create device object
-            device = self.discoveredDevices.get(uidStr)
-            if not device:
-                logging.debug('Discovered new device ' + uidStr)
-                device = dict()
-                self.discoveredDevices[uidStr] = device
-            else:
-                logging.debug('Discovered existing device ' + uidStr)
 
-            device['group'] = group
-            device['hopcount'] = hopcount
+    def updateField(self, uidStr, device, field, value):
+        """ Store a decoded field on a device and notify field listeners (deviceLock held) """
+        if field == 'dali':
+            # replies to DALI batches aren't device state; only their sender wants them
+            if self.dali:
+                self.dali.reply(uidStr, value)
+            return
+        self.discoveredDevices.setField(uidStr, device, field, value)
+        self.paramTimes[(uidStr, field)] = time.time()
+        self.notifyField(uidStr, field, value)
+        return
+
+
+    def notifyField(self, uidStr, field, value):
+        """ Pass a received field to each listener as (uid, field, value, timestamp) """
+        now = time.time()
+        for listener in self.fieldListeners:
+            try:
+                listener(uidStr, field, value, now)
+            except Exception:
+                log.exception('field listener failed for %s', field)
+        return
 
-            if msgparam == XRF_PARAM_MOTIONSIMPLE:
-                timestamp = time.ctime()
-                device['lastmotion'] = timestamp
-                device['lastmotiontype'] = 'simple'
 
-            elif msgparam == XRF_PARAM_MOTIONFANCY:
-                timestamp = time.ctime()
-                device['lastmotion'] = timestamp
-                device['lastmotiontype'] = 'fancy'
+    def addFieldListener(self, listener):
+        """ Call listener(uid, field, value, timestamp) for every field received.
+        Listeners run on the RX path with deviceLock held, so must be quick. """
+        self.fieldListeners.append(listener)
+        return
+
+
+    def setChannel(self, channel):
+        """ Set the radio channel.
+
+        The retune is queued behind whatever is already in the TX FIFO, so
+        currentChannel only changes once the command is written; until then
+        the dongle is still listening on the old channel.
+        """
+        def retuned(pkt):
+            self.retuneUntil = time.time() + self.retuneSettle
+            self.currentChannel = channel
+            self.notifyRadio('channel', None, False)
+            return
+        self.xrfThread.switchChannel(channel, onSend=retuned)
+        return
+
+
+    def notifyRadio(self, kind, payload, duplicate):
+        """ Pass radio activity to each listener as (kind, payload, channel, duplicate).
+        kind is 'R' (received frame), 'T' (dongle TX echo) or 'channel' (switched). """
+        for listener in self.radioListeners:
+            try:
+                listener(kind, payload, self.currentChannel, duplicate)
+            except Exception:
+                log.exception('radio listener failed for %s', kind)
+        return
+
+
+    def addRadioListener(self, listener):
+        """ Call listener(kind, payload, channel, duplicate) for radio activity """
+        self.radioListeners.append(listener)
+        return
 
-            self.ack_event.set()
 
+    def channelLoad(self, channel=None):
+        """ Estimated airtime utilization (0.0 - 1.0) of a channel, 0.0 if unmonitored """
+        if self.utilization is None:
+            return 0.0
+        if channel is None:
+            channel = self.currentChannel
+        return self.utilization.load(channel)
+
+
+    def packetChannels(self, pkt):
+        """ Channels an outgoing RF packet must be sent on, from its target(s) """
+        header = pkt.payload[1]
+        self.deviceLock.acquire()
+        if header & XRF_UNICAST:
+            uidStr = "".join("%02x" % b for b in pkt.payload[3:11])
+            device = self.discoveredDevices.get(uidStr)
+            channels = [device['channel']] if device and 'channel' in device else []
         else:
-            logging.debug('Unsupported (yet!) msg type %d (%s)' % (msgtype, typename))
+            group = pkt.payload[3]
+            channels = sorted(set(device['channel'] for device in self.discoveredDevices.values()
+                                  if 'channel' in device and
+                                  (group == XRF_UNIVERSAL_GROUP or device.get('group') == group)))
+        self.deviceLock.release()
+        return channels
+
 
+    def pendingByChannel(self):
+        """ Number of outstanding GETs per channel """
+        counts = dict()
+        self.deviceLock.acquire()
+        for key, waiters in self.pendingGets.items():
+            channel = self.discoveredDevices.get(key[0], {}).get('channel')
+            if channel is not None:
+                counts[channel] = counts.get(channel, 0) + len(waiters)
         self.deviceLock.release()
-        return
+        return counts
 
 
-    def setChannel(self, channel):
-        """ Set the radio channel """
-        self.currentChannel = channel
-        self.xrfThread.dongleSetChannel(channel)
+    def hopsForTarget(self, group, uid):
+        """ Choose the hop limit for a packet from the fixtures' observed hopcounts.
+
+        Unicast packets use the target's last observed hopcount plus a safety
+        margin and any escalation from earlier timeouts. Group packets use the
+        largest hopcount seen in the group. Unknown targets use the default.
+        """
+        self.deviceLock.acquire()
+        if uid:
+            device = self.discoveredDevices.get(uid)
+            hopcounts = [device['hopcount']] if device and 'hopcount' in device else []
+        else:
+            hopcounts = [device['hopcount'] for device in self.discoveredDevices.values()
+                         if 'hopcount' in device and
+                         (group == XRF_UNIVERSAL_GROUP or device.get('group') == group)]
+        boost = self.hopBoost.get(uid, 0) if uid else 0
+        self.deviceLock.release()
+
+        if not hopcounts:
+            return min(self.xrfThread.defaultHops + boost, XRF_HOPS)
+        return max(1, min(max(hopcounts) + self.hopMargin + boost, XRF_HOPS))
+
+
+    def escalateHops(self, uid):
+        """ Allow one more hop to a fixture after a request to it timed out """
+        self.deviceLock.acquire()
+        self.hopBoost[uid] = min(self.hopBoost.get(uid, 0) + 1, XRF_HOPS)
+        self.deviceLock.release()
         return
 
 
@@ -731,32 +1464,399 @@ class XrfAPI(threading.Thread):
 
 
     def setPWMLevels(self, group, uid, levels):
+        if uid and self.shadow:
+            self.shadow.setDesired(uid, XRF_PARAM_PWM, None, levels)
+            return
         self.ack_event.clear()
-        debugStr = "".join("%02x " % b for b in levels)
-        logging.debug("levels=" + debugStr)
-        self.xrfThread.rfSetPWMLevel(group, uid, levels)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('levels=%s', ' '.join('%02x' % b for b in levels))
+        self.xrfThread.rfSetPWMLevel(group, uid, levels, self.hopsForTarget(group, uid))
         return
 
 
+    def setDesired(self, uid, param, xparam, values):
+        """ Record a desired parameter value for the shadow to reconcile """
+        if self.shadow is None:
+            raise ValueError('device shadow not running')
+        self.shadow.setDesired(uid, param, xparam, values)
+        return
+
+
+    def getShadow(self, uid):
+        """ Desired and reported values of a fixture's shadowed parameters """
+        if self.shadow is None:
+            return dict()
+        return self.shadow.getShadow(uid)
+
+
     def getPWMLevels(self, group, uid):
-        self.ack_event.clear()
-        if uid:
-            device = self.discoveredDevices.get(uid)
-            if device:
-                device['ackData'] = None
+        if not uid:
+            self.ack_event.clear()
+            self.xrfThread.rfGetPWMLevel(group, uid, self.hopsForTarget(group, uid))
+            self.ack_event.wait(timeout=self.rtt.maxTimeout)
+            return None
+        return self.getParameter(uid, XRF_PARAM_IPWM)
+
+
+    def deviceHopcount(self, uid):
+        """ Last observed hopcount of a fixture (None if never heard) """
+        self.deviceLock.acquire()
+        hopcount = self.discoveredDevices.get(uid, {}).get('hopcount')
+        self.deviceLock.release()
+        return hopcount
+
+
+    def requestParameter(self, uid, param, xparam=None, attempt=0):
+        """ Queue a GET for a parameter, returning its PendingRequest """
+        hops = self.hopsForTarget(0, uid)
+        pending = PendingRequest(attempt)
+        self.deviceLock.acquire()
+        self.pendingGets.setdefault((uid, param, xparam), list()).append(pending)
+        self.deviceLock.release()
+        try:
+            if xparam is None:
+                pending.packet = self.xrfThread.rfGetParameter(param, 0, uid, None, hops, onDrop=pending.fail)
+            else:
+                pending.packet = self.xrfThread.rfGetExtParameter(xparam, 0, uid, hops, onDrop=pending.fail)
+        except QueueOverload:
+            self.cancelRequests(uid, [((param, xparam), pending)])
+            raise
+        return pending
+
+
+    def cancelRequests(self, uid, requests):
+        """ Stop waiting for GETACKs; requests is a list of ((param, xparam), PendingRequest) """
+        self.deviceLock.acquire()
+        for (param, xparam), pending in requests:
+            key = (uid, param, xparam)
+            waiters = self.pendingGets.get(key)
+            if waiters and pending in waiters:
+                waiters.remove(pending)
+                if not waiters:
+                    del self.pendingGets[key]
+        self.deviceLock.release()
+        return
+
+
+    def getParameter(self, uid, param, xparam=None, retries=None):
+        """ Read a single (possibly extended) parameter from a fixture, retrying on timeout """
+        if retries is None:
+            retries = self.maxRetries
+        hopcount = self.deviceHopcount(uid)
+        requests = list()
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                self.metrics['retries'] += 1
+            pending = self.requestParameter(uid, param, xparam, attempt)
+            requests.append(((param, xparam), pending))
+            if pending.wait(self.rtt.timeout(uid, hopcount, attempt), self.sendTimeout):
+                break
+            self.escalateHops(uid)
         else:
-            for device in self.discoveredDevices:
-                device['ackData'] = None
+            self.cancelRequests(uid, requests)
+            self.metrics['failures'] += 1
+            return None
 
-        lvls = self.xrfThread.rfGetPWMLevel(group, uid)
-        self.ack_event.wait(timeout=5)
+        self.metrics['successes'] += 1
+        if xparam is None:
+            field = XRF_PARAM_DECODERS.get(param, (None, None))[0]
+        else:
+            field = XRF_X_DECODERS.get(xparam, (None, None))[0]
+        self.deviceLock.acquire()
+        device = self.discoveredDevices.get(uid, {})
+        value = device.get(field)
+        self.deviceLock.release()
+        return value
+
+
+    def getSnapshot(self, uid, passes=None):
+        """ Read the full state of a fixture, pipelining all of the GETs.
+
+        Every GET is queued back to back so the dongle's TX pacing is the only
+        serialisation, and each reply is awaited for the RTT timeout after its
+        own frame was written. Anything still missing is re-requested on the
+        next pass.
+        """
+        if passes is None:
+            passes = self.maxRetries + 1
+        hopcount = self.deviceHopcount(uid)
+        outstanding = list(XRF_SNAPSHOT_PARAMS)
+        unanswered = list()
+        for attempt in range(passes):
+            if attempt > 0:
+                self.metrics['retries'] += len(outstanding)
+            requests = list()
+            try:
+                for key in outstanding:
+                    requests.append((key, self.requestParameter(uid, key[0], key[1], attempt)))
+            except QueueOverload:
+                self.cancelRequests(uid, unanswered + requests)
+                raise
+            timeout = self.rtt.timeout(uid, hopcount, attempt)
+            missing = list()
+            for key, pending in requests:
+                if not pending.wait(timeout, self.sendTimeout):
+                    missing.append(key)
+                    unanswered.append((key, pending))
+            self.metrics['successes'] += len(outstanding) - len(missing)
+            outstanding = missing
+            if not outstanding:
+                break
+            self.escalateHops(uid)
+        self.metrics['failures'] += len(outstanding)
+        self.cancelRequests(uid, unanswered)
 
-        levels = None
-        if uid:
-            device = self.discoveredDevices.get(uid)
-            if device:
-                levels = device['pwmlevels']
-        return levels
+        self.deviceLock.acquire()
+        device = self.discoveredDevices.get(uid)
+        snapshot = None
+        if device is not None:
+            snapshot = dict(device)
+            snapshot['uid'] = uid
+            snapshot['missing'] = [self.paramToName(param) if xparam is None else 'Extended %d' % xparam
+                                   for param, xparam in outstanding]
+        self.deviceLock.release()
+        return snapshot
+
+
+    def registerMetrics(self, name, source):
+        """ Include source() in getMetrics() under the given name """
+        self.metricSources[name] = source
+        return
+
+
+    def lastUpdate(self, uid, field):
+        """ Time a decoded device field was last received from a fixture (0 if never) """
+        return self.paramTimes.get((uid, field), 0)
+
+
+    def getMetrics(self):
+        """ Return request/retry counters and RTT estimates as a dictionary """
+        metrics = dict(self.metrics)
+        metrics['rtt'] = self.rtt.getStats()
+        metrics['dedup'] = self.duplicates.getStats()
+        metrics['txQueue'] = self.xrfThread.txQueue.getStats()
+        metrics['rxQueue'] = self.xrfThread.rxQueue.getStats()
+        for name, source in self.metricSources.items():
+            metrics[name] = source()
+        return metrics
+
+
+    def getTimeSeries(self, metric, uid, start, end, window=None):
+        """ Samples of a metric for one fixture, or per-window aggregates if window is given """
+        if window:
+            return self.timeSeries.aggregate(metric, uid, start, end, window)
+        return self.timeSeries.query(metric, uid, start, end)
+
+
+    def getFleetTimeSeries(self, metric, start, end, window):
+        """ Per-window aggregates of a metric across all fixtures """
+        return self.timeSeries.rollup(metric, start, end, window)
+
+
+    def setScene(self, name, levels, fade=None, groups=None):
+        """ Store (or replace) a lighting scene """
+        self.scenes.setScene(name, levels, fade, groups)
+        return
+
+
+    def getScene(self, name):
+        """ A scene and its compiled frame plan, or None """
+        return self.scenes.getScene(name)
+
+
+    def getScenes(self):
+        """ Names of the stored scenes """
+        return self.scenes.getScenes()
+
+
+    def deleteScene(self, name):
+        return self.scenes.deleteScene(name)
+
+
+    def recallScene(self, name):
+        """ Send a scene's compiled frames; None if there is no such scene """
+        return self.scenes.recall(name)
+
+
+    def startTimeSync(self, group, syncTime=True, rtcOn=None, rtcOff=None):
+        """ Push RTC time and/or on/off calendar to a group (or every fixture) """
+        return self.timeSync.start(group, syncTime, rtcOn, rtcOff)
+
+
+    def getTimeSync(self):
+        """ Status of the latest time sync job, or None """
+        return self.timeSync.getStatus()
+
+
+    def daliTransact(self, uid, commands, timeout=30.0):
+        """ Send (address, opcode) DALI commands to a fixture, returning per-command results """
+        if self.dali is None:
+            raise ValueError('DALI gateway not running')
+        return self.dali.transact(uid, commands, timeout)
+
+
+    def getUtilization(self):
+        """ Per-channel airtime utilization, packet rates and duplicate ratio """
+        if self.utilization is None:
+            return dict()
+        return self.utilization.getStats()
+
+
+    def getLogging(self):
+        """ Logger levels and packet log filters """
+        return {'levels': getLogLevels(), 'packets': self.packetLog.getConfig()}
+
+
+    def setLogging(self, levels=None, packets=None):
+        """ Change logger levels ({name: level}) and/or packet log filters """
+        if packets:
+            self.packetLog.configure(**packets)
+        if levels:
+            setLogLevels(levels)
+        return self.getLogging()
+
+
+    def getPacketLog(self, limit=100):
+        """ Most recently logged packets, oldest first """
+        return self.packetLog.dump(limit)
+
+
+    def beginTrace(self, name):
+        """ Possibly start tracing the calling thread's request """
+        return self.tracer.begin(name)
+
+
+    def endTrace(self):
+        """ Finish the calling thread's trace, if any """
+        self.tracer.end()
+        return
+
+
+    def getTraces(self, limit=50, name=None):
+        """ Recent sampled latency traces, newest first """
+        return self.tracer.getTraces(limit, name)
+
+
+    def profile(self, seconds=5.0, interval=0.01):
+        """ Sample every thread's stack for seconds.
+
+        Returns the StackSampler profile, plus each thread's CPU time and
+        wakeups over the same period. Raises ProfilerBusy if a profile is
+        already running.
+        """
+        before = self.threadAccounting.read()
+        profile = self.sampler.profile(seconds, interval)
+        after = self.threadAccounting.read()
+        profile['threads'] = self.threadAccounting.compare(before, after, profile['seconds'])
+        return profile
+
+
+    def getThreadStats(self):
+        """ CPU time and wakeups of each thread, and of the event loop if there is one """
+        stats = self.threadAccounting.getStats()
+        if self.loop:
+            stats['eventLoop'] = {'wakeups': self.loop.wakeups}
+        return stats
+
+
+    def getEnergy(self, by):
+        """ Estimated kWh per group or model from PWM averages and lamp hours """
+        return self.energy.energyBy(by)
+
+
+    def getLifetime(self, column, percentiles, threshold):
+        """ Fleet percentiles and outlying fixtures for a lifetime column """
+        return {'column': column,
+                'percentiles': self.energy.percentiles(column, percentiles),
+                'outliers': self.energy.outliers(column, threshold)}
+
+
+    def queryDevices(self, equals=None, ranges=None, motion=None, fields=None, cursor=None, limit=None):
+        """ Devices matching a registry query, one page at a time.
+
+        See DeviceRegistry.query() for equals, ranges and motion. fields
+        projects each device onto those fields (uid is always included).
+        Returns (devices, cursor of the next page or None).
+        """
+        self.deviceLock.acquire()
+        uids = self.discoveredDevices.query(equals, ranges, motion)
+        uids, nextCursor = self.discoveredDevices.page(uids, cursor, limit)
+        device_list = list()
+        for uidStr in uids:
+            device = self.discoveredDevices.get(uidStr)
+            if fields:
+                new_device = dict((field, device[field]) for field in fields if field in device)
+            else:
+                new_device = dict(device)
+            new_device['uid'] = uidStr
+            device_list.append(new_device)
+        self.deviceLock.release()
+        return device_list, nextCursor
+
+
+    def snapshotDevices(self):
+        """ Copy of the device registry for saving, as (devices, tombstones, motion) """
+        self.deviceLock.acquire()
+        snapshot = self.discoveredDevices.snapshot()
+        self.deviceLock.release()
+        return snapshot
+
+
+    def restoreDevices(self, devices, tombstones, motion=()):
+        """ Load a saved device registry; returns the number of devices restored """
+        self.deviceLock.acquire()
+        restored = self.discoveredDevices.restore(devices, tombstones, motion)
+        self.version += 1
+        self.deviceLock.release()
+        return restored
+
+
+    def markStartup(self, stage, when=None):
+        """ Record when a startup stage finished (first time only) """
+        self.startup.setdefault(stage, when or time.time())
+        return
+
+
+    def getStatus(self):
+        """ Readiness of the gateway.
+
+        'starting' until the dongle first attaches and any saved registry
+        has been restored, 'ready' while the dongle is attached and
+        'degraded' if it has gone away or hasn't turned up within
+        startupGrace seconds. startup gives the seconds from process start
+        to each stage.
+        """
+        link = self.xrfThread.getLink()
+        origin = self.startup.get('process', self.startup['api'])
+        if self.restoring:
+            state = 'starting'
+        elif link['attached']:
+            state = 'ready'
+        elif link['detaches'] or time.time() - origin > self.startupGrace:
+            state = 'degraded'
+        else:
+            state = 'starting'
+        startup = dict((stage, when - origin) for stage, when in self.startup.items())
+        if link['firstAttached']:
+            startup['dongle'] = link['firstAttached'] - origin
+        return {'state': state, 'dongle': link, 'devices': len(self.discoveredDevices),
+                'startup': startup, 'uptime': time.time() - origin}
+
+
+    def getVersion(self):
+        """ Counter bumped whenever a fixture's entry may have changed """
+        return self.version
+
+
+    def getDevice(self, uid):
+        """ Copy of one device, or None """
+        self.deviceLock.acquire()
+        device = self.discoveredDevices.get(uid)
+        if device is not None:
+            device = dict(device)
+            device['uid'] = uid
+        self.deviceLock.release()
+        return device
 
 
     def getDevices(self):
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Time-sliced channel hopping for monitoring several RF channels with one dongle
+"""
+import logging
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+class ChannelScheduler(threading.Thread):
+    """ Rotates the dongle across a set of channels.
+
+    Each visit lasts between minDwell and maxDwell seconds, weighted by the
+    channel's share of received traffic and by the requests waiting on it.
+    The next channel is the one with the highest score of time since its
+    last visit multiplied by its weight, so busy channels are visited more
+    often but quiet ones are never starved. Outgoing packets are pinned to
+    their target's channel by XrfCommsThread while this is running.
+    """
+    minDwell = 0.5          # seconds on a channel per visit
+    maxDwell = 5.0
+    rateSmoothing = 0.3     # EWMA weight of the latest visit's packet rate
+
+    def __init__(self, api, channels, name="XrfChannels"):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.api = api
+        self.channels = list(channels)
+        self.rates = dict((channel, 0.0) for channel in self.channels)
+        self.lastVisit = dict((channel, 0.0) for channel in self.channels)
+        self.visits = dict((channel, 0) for channel in self.channels)
+        self.dwells = dict((channel, 0.0) for channel in self.channels)
+        self.running = False
+
+    def weight(self, channel, held, pending):
+        """ Relative importance of a channel: traffic share plus waiting work """
+        total = sum(self.rates.values())
+        share = self.rates[channel] / total if total > 0 else 1.0 / len(self.channels)
+        return share * len(self.channels) + held.get(channel, 0) + pending.get(channel, 0)
+
+    def nextChannel(self, now, held, pending):
+        """ Pick the channel that has waited longest relative to its weight """
+        def score(channel):
+            return (now - self.lastVisit[channel]) * (1 + self.weight(channel, held, pending))
+        return max(self.channels, key=score)
+
+    def dwellFor(self, channel, held, pending):
+        """ How long to stay on a channel this visit """
+        weight = self.weight(channel, held, pending)
+        share = weight / (weight + len(self.channels))
+        return self.minDwell + (self.maxDwell - self.minDwell) * share
+
+    def run(self):
+        self.running = True
+        xrfThread = self.api.xrfThread
+        xrfThread.channelResolver = self.api.packetChannels
+        self.api.registerMetrics('channels', self.getStats)
+        log.debug('channel hopping across %s', self.channels)
+
+        try:
+            while self.running:
+                now = time.time()
+                held = xrfThread.getHeldCounts()
+                pending = self.api.pendingByChannel()
+                channel = self.nextChannel(now, held, pending)
+                dwell = self.dwellFor(channel, held, pending)
+
+                before = self.api.channelRx.get(channel, 0)
+                self.api.setChannel(channel)
+                time.sleep(dwell)
+                received = self.api.channelRx.get(channel, 0) - before
+
+                rate = received / dwell
+                self.rates[channel] = (1 - self.rateSmoothing) * self.rates[channel] + self.rateSmoothing * rate
+                self.lastVisit[channel] = time.time()
+                self.visits[channel] += 1
+                self.dwells[channel] = dwell
+        finally:
+            xrfThread.channelResolver = None
+        return
+
+    def stop(self):
+        self.running = False
+        return
+
+    def getStats(self):
+        """ Per-channel packet rate, visits, last dwell and held packets """
+        held = self.api.xrfThread.getHeldCounts()
+        stats = dict()
+        for channel in self.channels:
+            stats[str(channel)] = {'rate': self.rates[channel],
+                                   'visits': self.visits[channel],
+                                   'dwell': self.dwells[channel],
+                                   'held': held.get(channel, 0)}
+        return stats
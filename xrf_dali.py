@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+Batched, pipelined DALI passthrough to DALI-bridged fixtures
+
+DALI forward frames (address, opcode) are tunnelled in XRF_X_DALI SETs.
+A frame carries a batch: [XRF_X_DALI, sequence, count, address, opcode, ...].
+The fixture answers with [XRF_X_DALI, sequence, count, flags, value, ...],
+one (flags, backward frame) pair per command in the same order.
+"""
+import logging
+import threading
+import time
+from collections import deque
+
+from xrf import XRF_MAXLEN, XRF_X_DALI
+
+
+log = logging.getLogger(__name__)
+
+
+DALI_REPLY_ANSWERED = 0x01  # a backward frame was received
+DALI_REPLY_ERROR = 0x02     # bus collision or framing error
+
+UNICAST_SET_OVERHEAD = 11   # length, header, hops, uid
+RX_OVERHEAD = 12            # length, header, hops, group, uid
+BATCH_HEADER = 3            # xparam, sequence, count
+
+# commands per frame, limited by whichever of the request and reply is larger
+BATCH_CAPACITY = min((XRF_MAXLEN - UNICAST_SET_OVERHEAD - BATCH_HEADER) // 2,
+                     (XRF_MAXLEN - RX_OVERHEAD - BATCH_HEADER) // 2)
+
+
+class DaliCommand(object):
+    """ One DALI forward frame and, once done, its result """
+
+    def __init__(self, address, opcode):
+        self.address = address & 0xFF
+        self.opcode = opcode & 0xFF
+        self.event = threading.Event()
+        self.result = None
+
+    def complete(self, result):
+        self.result = result
+        self.event.set()
+        return
+
+
+class DaliBatch(object):
+    """ Commands sent to one fixture together, over one or more attempts """
+
+    def __init__(self, uid, commands):
+        self.uid = uid
+        self.commands = commands
+        self.sequences = list()     # sequence of every attempt still awaiting its reply
+        self.sent = None            # (sequence, commands) of the latest attempt
+        self.attempts = 0
+        self.due = 0
+
+    def unanswered(self):
+        return [command for command in self.commands if not command.event.is_set()]
+
+    def payload(self):
+        sequence, commands = self.sent
+        data = bytearray([sequence, len(commands)])
+        for command in commands:
+            data += bytearray([command.address, command.opcode])
+        return data
+
+
+class DaliGateway(threading.Thread):
+    """ Queues DALI commands per fixture and sends them in full frames.
+
+    Up to BATCH_CAPACITY queued commands for a fixture share one frame, and
+    up to window batches per fixture are in flight at once. Replies are
+    matched to batches by sequence number and handed back per command. A
+    batch that isn't fully answered within the fixture's RTT timeout is
+    resent up to maxRetries times, then its commands fail. Each resend
+    carries only the commands still unanswered, under a new sequence, so a
+    partial reply isn't run again; a late reply to an earlier attempt still
+    counts. A command whose reply is lost altogether may run twice.
+    """
+    window = 4              # batches in flight per fixture
+    maxRetries = 3
+
+    def __init__(self, api, name="XrfDali"):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.api = api
+        self.queues = dict()        # uid -> deque of DaliCommand
+        self.batches = set()        # DaliBatch in flight
+        self.inflight = dict()      # (uid, sequence) -> (DaliBatch, commands sent under that sequence)
+        self.sequences = dict()     # uid -> next sequence number
+        self.cond = threading.Condition()
+        self.running = False
+        self.stats = {'commands': 0, 'frames': 0, 'retries': 0, 'answered': 0,
+                      'failed': 0, 'unmatched': 0}
+
+    def submit(self, uid, commands):
+        """ Queue (address, opcode) pairs for a fixture, returning DaliCommands """
+        queued = [DaliCommand(address, opcode) for address, opcode in commands]
+        self.cond.acquire()
+        self.queues.setdefault(uid, deque()).extend(queued)
+        self.stats['commands'] += len(queued)
+        self.cond.notify()
+        self.cond.release()
+        return queued
+
+    def transact(self, uid, commands, timeout=30.0):
+        """ Send commands and wait for their results, in order.
+
+        Each result is {'answered': bool, 'value': backward frame or None,
+        'error': bool}, or None if the fixture never acknowledged it.
+        """
+        queued = self.submit(uid, commands)
+        deadline = time.time() + timeout
+        for command in queued:
+            command.event.wait(max(0, deadline - time.time()))
+        return [command.result for command in queued]
+
+    def reply(self, uid, replies):
+        """ Hand a decoded XRF_X_DALI reply back to its commands (called by XrfAPI) """
+        self.cond.acquire()
+        sequence = replies['sequence']
+        entry = self.inflight.pop((uid, sequence), None)
+        if entry is None:
+            self.stats['unmatched'] += 1
+            self.cond.release()
+            return
+        batch, sent = entry
+        batch.sequences.remove(sequence)
+        for (flags, backward), command in zip(replies['replies'], sent):
+            if command.event.is_set():
+                continue        # already answered by a reply to another attempt
+            answered = bool(flags & DALI_REPLY_ANSWERED)
+            command.complete({'answered': answered, 'value': backward if answered else None,
+                              'error': bool(flags & DALI_REPLY_ERROR)})
+            self.stats['answered'] += 1
+        if not batch.unanswered():
+            self.finish(batch)
+        elif not batch.sequences:
+            batch.due = 0       # the fixture skipped some; resend them now
+        self.cond.notify()
+        self.cond.release()
+        return
+
+    def finish(self, batch):
+        """ Stop tracking a batch and any attempts still unanswered (cond held) """
+        self.batches.discard(batch)
+        for sequence in batch.sequences:
+            self.inflight.pop((batch.uid, sequence), None)
+        batch.sequences = list()
+        return
+
+    def nextSequence(self, uid):
+        """ Next batch sequence number for a fixture that isn't in flight (cond held) """
+        sequence = self.sequences.get(uid, 0)
+        while (uid, sequence) in self.inflight:
+            sequence = (sequence + 1) & 0xFF
+        self.sequences[uid] = (sequence + 1) & 0xFF
+        return sequence
+
+    def send(self, batch):
+        hops = self.api.hopsForTarget(0, batch.uid)
+        self.api.xrfThread.rfSetExtParameter(XRF_X_DALI, 0, batch.uid, batch.payload(), hops)
+        self.stats['frames'] += 1
+        return
+
+    def run(self):
+        self.running = True
+        self.api.dali = self
+        self.api.registerMetrics('dali', self.getStats)
+        while self.running:
+            now = time.time()
+            toSend = list()
+            failed = list()
+            self.cond.acquire()
+
+            # retry or give up on overdue batches
+            for batch in list(self.batches):
+                if batch.due is None or batch.due > now:
+                    continue
+                if batch.attempts > self.maxRetries:
+                    failed.append((batch, batch.unanswered()))
+                    self.finish(batch)
+                else:
+                    toSend.append(batch)
+
+            # start new batches where the window allows
+            inflightPerUid = dict()
+            for batch in self.batches:
+                inflightPerUid[batch.uid] = inflightPerUid.get(batch.uid, 0) + 1
+            for uid, queue in self.queues.items():
+                while queue and inflightPerUid.get(uid, 0) < self.window:
+                    commands = [queue.popleft() for i in range(min(BATCH_CAPACITY, len(queue)))]
+                    batch = DaliBatch(uid, commands)
+                    self.batches.add(batch)
+                    inflightPerUid[uid] = inflightPerUid.get(uid, 0) + 1
+                    toSend.append(batch)
+                if not queue:
+                    del self.queues[uid]
+
+            for batch in toSend:
+                sequence = self.nextSequence(batch.uid)
+                batch.sent = (sequence, batch.unanswered())
+                batch.sequences.append(sequence)
+                self.inflight[(batch.uid, sequence)] = (batch, batch.sent[1])
+                batch.due = None        # set once it has been sent
+                if batch.attempts > 0:
+                    self.stats['retries'] += 1
+                batch.attempts += 1
+
+            if not toSend and not failed:
+                dues = [batch.due for batch in self.batches if batch.due is not None]
+                self.cond.wait(max(0, min(dues) - now) if dues else None)
+            self.cond.release()
+
+            # replies arrive with deviceLock held and then take cond, so the
+            # hopcount lookup must not happen under cond
+            for batch in toSend:
+                timeout = self.api.rtt.timeout(batch.uid, self.api.deviceHopcount(batch.uid), batch.attempts - 1)
+                try:
+                    self.send(batch)
+                except Exception:
+                    log.exception('DALI batch to %s failed', batch.uid)
+                self.cond.acquire()
+                if batch.due is None:
+                    batch.due = time.time() + timeout
+                self.cond.release()
+            for batch, commands in failed:
+                log.debug('DALI batch to %s unanswered', batch.uid)
+                self.api.escalateHops(batch.uid)
+                for command in commands:
+                    command.complete(None)
+                self.stats['failed'] += len(commands)
+        return
+
+    def stop(self):
+        self.running = False
+        self.cond.acquire()
+        self.cond.notify()
+        self.cond.release()
+        return
+
+    def getStats(self):
+        self.cond.acquire()
+        stats = dict(self.stats)
+        stats['queued'] = sum(len(queue) for queue in self.queues.values())
+        stats['inflight'] = len(self.batches)
+        self.cond.release()
+        stats['commandsPerFrame'] = float(stats['commands']) / stats['frames'] if stats['frames'] else 0.0
+        return stats
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+Duplicate suppression for mesh-relayed XRF packets
+"""
+import time
+from collections import OrderedDict
+
+
+class DuplicateCache(object):
+    """ Time-bounded LRU of recently seen packet keys.
+
+    The same report is often heard several times through different relays,
+    with only the hop count differing. Callers build a key from the bytes
+    that identify the packet and ask whether it has been seen within the
+    last ttl seconds. Only used from the thread that parses RX packets.
+    """
+
+    def __init__(self, maxEntries=1024, ttl=2.0):
+        self.maxEntries = maxEntries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def seen(self, key, now=None):
+        """ Return True if key was seen recently, otherwise remember it """
+        if now is None:
+            now = time.time()
+
+        # expire from the old end; entries are kept in arrival order
+        while self.entries:
+            oldest, stamp = next(self.entries.iteritems())
+            if now - stamp < self.ttl and len(self.entries) < self.maxEntries:
+                break
+            del self.entries[oldest]
+
+        stamp = self.entries.get(key)
+        if stamp is not None:
+            self.hits += 1
+            return True
+
+        self.entries[key] = now
+        self.misses += 1
+        return False
+
+    def getStats(self):
+        """ Return hit/miss counters as a dictionary """
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
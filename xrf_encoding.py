@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Compact response encodings for the REST API
+
+JSON is always available. CBOR is encoded here, so it needs nothing extra;
+MessagePack is offered when the msgpack package is installed. In the binary
+encodings fixture uids are sent as raw 8-byte strings instead of 16 hex
+characters. Bodies can also be gzip or deflate compressed.
+"""
+import re
+import struct
+import threading
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+MIMETYPE_JSON = 'application/json'
+MIMETYPE_CBOR = 'application/cbor'
+MIMETYPE_MSGPACK = 'application/msgpack'
+
+UID_PATTERN = re.compile(r'^[0-9a-f]{16}$')
+UID_KEYS = ('uid',)
+
+
+def mimetypes():
+    """ Response types this gateway can produce, preferred first """
+    types = [MIMETYPE_JSON, MIMETYPE_CBOR]
+    if msgpack is not None:
+        types += [MIMETYPE_MSGPACK, 'application/x-msgpack']
+    return types
+
+
+def prepareBinary(obj, key=None):
+    """ Copy of obj for msgpack: text as unicode, byte strings as str, uids as raw bytes """
+    if isinstance(obj, dict):
+        return dict((prepareBinary(k), prepareBinary(v, k)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return [prepareBinary(item) for item in obj]
+    if isinstance(obj, str):
+        if key in UID_KEYS and UID_PATTERN.match(obj):
+            return obj.decode('hex')
+        return obj.decode('utf-8')
+    if isinstance(obj, bytearray):
+        return bytes(obj)
+    return obj
+
+
+CBOR_HEADS = [struct.Struct('>B'), struct.Struct('>BB'), struct.Struct('>BH'),
+              struct.Struct('>BI'), struct.Struct('>BQ')]
+
+
+def cborHead(major, value):
+    """ CBOR initial byte and argument """
+    major <<= 5
+    if value < 24:
+        return chr(major | value)
+    if value < 0x100:
+        return CBOR_HEADS[1].pack(major | 24, value)
+    if value < 0x10000:
+        return CBOR_HEADS[2].pack(major | 25, value)
+    if value < 0x100000000:
+        return CBOR_HEADS[3].pack(major | 26, value)
+    return CBOR_HEADS[4].pack(major | 27, value)
+
+
+def cborAppend(obj, out, key=None):
+    """ Append the CBOR encoding of a JSON-style object to the list out.
+    str is UTF-8 text, except uids, which become 8-byte strings, and
+    bytearray is a byte string. """
+    kind = type(obj)
+    if kind is str:
+        if key in UID_KEYS and len(obj) == 16 and UID_PATTERN.match(obj):
+            out.append('\x48')     # byte string of length 8
+            out.append(obj.decode('hex'))
+        else:
+            out.append(cborHead(3, len(obj)))
+            out.append(obj)
+    elif kind is dict:
+        out.append(cborHead(5, len(obj)))
+        for key, value in obj.iteritems():
+            cborAppend(key, out)
+            cborAppend(value, out, key)
+    elif kind is list or kind is tuple:
+        out.append(cborHead(4, len(obj)))
+        for item in obj:
+            cborAppend(item, out)
+    elif kind is bool:
+        out.append('\xf5' if obj else '\xf4')
+    elif kind is int or kind is long:
+        out.append(cborHead(0, obj) if obj >= 0 else cborHead(1, -1 - obj))
+    elif kind is float:
+        out.append(CBOR_FLOAT.pack(0xFB, obj))
+    elif kind is unicode:
+        data = obj.encode('utf-8')
+        out.append(cborHead(3, len(data)))
+        out.append(data)
+    elif kind is bytearray:
+        out.append(cborHead(2, len(obj)))
+        out.append(bytes(obj))
+    elif obj is None:
+        out.append('\xf6')
+    else:
+        raise TypeError('cannot encode %r as CBOR' % (obj,))
+    return
+
+
+CBOR_FLOAT = struct.Struct('>Bd')
+
+
+def cborEncode(obj):
+    """ CBOR (RFC 7049) encoding of a JSON-style object """
+    out = list()
+    cborAppend(obj, out)
+    return ''.join(out)
+
+
+def encodeBinary(obj, mimetype):
+    """ Encode a JSON-style object as CBOR or MessagePack """
+    if mimetype == MIMETYPE_CBOR:
+        return cborEncode(obj)
+    return msgpack.packb(prepareBinary(obj), use_bin_type=True)
+
+
+def compress(data, encoding):
+    """ gzip or deflate (zlib) compressed body """
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    return zlib.compress(data, 6)
+
+
+class ResponseCache(object):
+    """ Encoded response bodies for the current version of the device registry.
+
+    Entries are keyed by (request, mimetype, content encoding) and all
+    dropped when the version changes, so a busy poller of an idle fleet
+    is served without re-encoding anything. Safe to share between the
+    threads of a threaded HTTP server.
+    """
+    maxEntries = 64
+
+    def __init__(self):
+        self.version = None
+        self.entries = dict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, version, key):
+        self.lock.acquire()
+        if version != self.version:
+            self.version = version
+            self.entries = dict()
+        body = self.entries.get(key)
+        if body is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        self.lock.release()
+        return body
+
+    def put(self, version, key, body):
+        self.lock.acquire()
+        if version == self.version:
+            if len(self.entries) >= self.maxEntries:
+                self.entries = dict()
+            self.entries[key] = body
+        self.lock.release()
+        return
+
+    def getStats(self):
+        self.lock.acquire()
+        stats = {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+        self.lock.release()
+        return stats
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Fleet energy and lamp lifetime analytics
+
+Operating lifetime counters (XRF_PARAM_SVC_TIMES) and long-term PWM averages
+(XRF_X_PWMAVG) are kept in per-fixture columns (one array per quantity, one
+row per fixture) so fleet reports work on whole columns at once.
+"""
+import operator
+import threading
+from array import array
+from bisect import bisect_right
+from itertools import compress, imap, repeat
+
+
+# positions in the decoded svctimes list (hours)
+SVC_POWERED_HOURS = 0
+SVC_LAMP_HOURS = 1
+
+# rated full-output power per model, in watts
+MODEL_WATTS = {
+    'Athena': 40.0,
+    'AthenaX': 60.0,
+    'Artemis': 100.0,
+    'Artemis XL': 150.0,
+}
+DEFAULT_WATTS = 50.0
+
+COLUMNS = ('lamphours', 'poweredhours', 'duty', 'kwh')
+
+
+def percentile(ordered, pct):
+    """ Linearly interpolated percentile of a sorted sequence """
+    if not ordered:
+        return None
+    rank = (len(ordered) - 1) * pct / 100.0
+    lo = int(rank)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (rank - lo)
+
+
+class EnergyColumns(object):
+    """ Column store of lifetime counters, PWM duty, group and model per fixture """
+
+    def __init__(self):
+        self.rows = dict()          # uid -> row number
+        self.uids = list()
+        self.lampHours = array('d')
+        self.poweredHours = array('d')
+        self.duty = array('d')      # long-term average PWM, 0.0 - 1.0
+        self.watts = array('d')
+        self.groups = array('i')
+        self.models = list()
+        self.reported = array('b')  # 1 once lifetime counters have been received
+        self.lock = threading.Lock()
+
+    def row(self, uid):
+        """ Row for a fixture, adding one if needed (lock held) """
+        row = self.rows.get(uid)
+        if row is None:
+            row = self.rows[uid] = len(self.uids)
+            self.uids.append(uid)
+            self.lampHours.append(0.0)
+            self.poweredHours.append(0.0)
+            self.duty.append(0.0)
+            self.watts.append(DEFAULT_WATTS)
+            self.groups.append(-1)
+            self.models.append(None)
+            self.reported.append(0)
+        return row
+
+    def recordField(self, uid, field, value, timestamp=None):
+        """ XrfAPI field listener for svctimes, pwmavg, group and model """
+        if field not in ('svctimes', 'pwmavg', 'group', 'model'):
+            return
+        self.lock.acquire()
+        row = self.row(uid)
+        if field == 'svctimes':
+            if len(value) > SVC_POWERED_HOURS:
+                self.poweredHours[row] = value[SVC_POWERED_HOURS]
+            if len(value) > SVC_LAMP_HOURS:
+                self.lampHours[row] = value[SVC_LAMP_HOURS]
+            self.reported[row] = 1
+        elif field == 'pwmavg':
+            if value:
+                self.duty[row] = value[0] / 255.0
+        elif field == 'group':
+            self.groups[row] = value
+        elif field == 'model':
+            self.models[row] = value
+            self.watts[row] = MODEL_WATTS.get(value, DEFAULT_WATTS)
+        self.lock.release()
+        return
+
+    def forget(self, uid):
+        """ Drop a fixture's row, moving the last row into its place """
+        self.lock.acquire()
+        row = self.rows.pop(uid, None)
+        if row is not None:
+            last = len(self.uids) - 1
+            for column in (self.uids, self.lampHours, self.poweredHours, self.duty,
+                           self.watts, self.groups, self.models, self.reported):
+                column[row] = column[last]
+                column.pop()
+            if row != last:
+                self.rows[self.uids[row]] = row
+        self.lock.release()
+        return
+
+    def column(self, name):
+        """ A column by name, for fixtures that have reported lifetime counters (lock held) """
+        if name == 'lamphours':
+            values = self.lampHours
+        elif name == 'poweredhours':
+            values = self.poweredHours
+        elif name == 'duty':
+            values = self.duty
+        elif name == 'kwh':
+            # watts * duty * lamp hours / 1000, element-wise
+            power = imap(operator.mul, self.watts, self.duty)
+            values = imap(operator.mul, power, imap(operator.mul, self.lampHours, repeat(0.001)))
+        else:
+            raise KeyError(name)
+        return array('d', compress(values, self.reported))
+
+    def energyBy(self, key):
+        """ Estimated kWh per group or per model, with fleet total.
+
+        Rows are ordered by key and each run of equal keys, found by
+        bisection, is summed as a slice of the kWh column, so the Python
+        work beyond the sort is per key rather than per fixture.
+        """
+        self.lock.acquire()
+        kwh = self.column('kwh')
+        keys = list(compress(self.groups if key == 'group' else self.models, self.reported))
+        self.lock.release()
+
+        order = sorted(xrange(len(keys)), key=keys.__getitem__)
+        kwh = array('d', imap(kwh.__getitem__, order))
+        keys = map(keys.__getitem__, order)
+        groups = list()
+        start = 0
+        while start < len(keys):
+            name = keys[start]
+            end = bisect_right(keys, name, start)
+            groups.append({key: name, 'kwh': sum(kwh[start:end]), 'devices': end - start})
+            start = end
+        return {'by': key, 'total': sum(kwh), 'devices': len(kwh), 'kwh': groups}
+
+    def percentiles(self, name, pcts):
+        """ Percentiles of a column across the fleet """
+        for pct in pcts:
+            if not 0 <= pct <= 100:
+                raise ValueError('percentiles must be between 0 and 100')
+        self.lock.acquire()
+        ordered = sorted(self.column(name))
+        self.lock.release()
+        return dict((str(pct), percentile(ordered, pct)) for pct in pcts)
+
+    def outliers(self, name, threshold=3.5):
+        """ Fixtures whose modified z-score (median/MAD) exceeds threshold """
+        self.lock.acquire()
+        values = self.column(name)
+        uids = list(compress(self.uids, self.reported))
+        self.lock.release()
+        if not values:
+            return list()
+
+        median = percentile(sorted(values), 50)
+        deviations = array('d', imap(abs, imap(operator.sub, values, repeat(median))))
+        mad = percentile(sorted(deviations), 50)
+        if not mad:
+            return list()
+        scale = 0.6745 / mad
+        return [{'uid': uid, name: value, 'score': deviation * scale}
+                for uid, value, deviation in zip(uids, values, deviations)
+                if deviation * scale > threshold]
+
+    def getStats(self):
+        return {'devices': len(self.uids), 'reporting': sum(self.reported)}
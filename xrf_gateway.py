@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-process gateway support
+
+One process owns the dongle and the device table. API worker processes read
+the device table from a shared memory segment and send RF commands to the
+radio-owner process over a local IPC channel.
+"""
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from multiprocessing.managers import BaseManager
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+log = logging.getLogger(__name__)
+
+
+TABLE_HEADER = struct.Struct('<QI')     # sequence number, payload length
+TABLE_SIZE = 8 * 1024 * 1024            # room for roughly 20k fixtures
+
+
+def make_ipc_dir():
+    """ New directory for the IPC socket and device table that only this
+    user can enter (mkdtemp creates it 0700). Fixed names under /tmp could
+    be created or replaced by another local user before the gateway starts.
+    In shared memory when there is any. """
+    return tempfile.mkdtemp(prefix='xrf-gateway-', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+
+
+def default_table_path(directory):
+    """ Shared memory file for the device table """
+    return os.path.join(directory, 'devices')
+
+
+def default_ipc_address(directory):
+    """ Unix socket for commands from API workers to the radio-owner process """
+    return os.path.join(directory, 'gateway.sock')
+
+
+class DeviceTableWriter(object):
+    """ Publishes the device list into shared memory.
+
+    Uses a sequence lock: the sequence number is odd while a write is in
+    progress, so readers never need a lock shared with the writer.
+    """
+
+    def __init__(self, path, size=TABLE_SIZE):
+        self.path = path
+        self.size = size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.seq = 0
+        self.map[0:TABLE_HEADER.size] = TABLE_HEADER.pack(self.seq, 0)
+
+    def publish(self, devices):
+        """ Write a new version of the device list """
+        data = pickle.dumps(devices, pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.size - TABLE_HEADER.size:
+            log.error('device table too large for shared memory (%d bytes)', len(data))
+            return False
+        self.seq += 1
+        self.map[0:TABLE_HEADER.size] = TABLE_HEADER.pack(self.seq, 0)
+        self.map[TABLE_HEADER.size:TABLE_HEADER.size + len(data)] = data
+        self.seq += 1
+        self.map[0:TABLE_HEADER.size] = TABLE_HEADER.pack(self.seq, len(data))
+        return True
+
+    def close(self):
+        self.map.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class DeviceTableReader(object):
+    """ Reads the device list published by a DeviceTableWriter """
+
+    def __init__(self, path, size=TABLE_SIZE):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            self.map = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        self.seq = None
+        self.devices = list()
+
+    def read(self):
+        """ Return the latest device list, only unpickling when it has changed """
+        while True:
+            seq, length = TABLE_HEADER.unpack(self.map[0:TABLE_HEADER.size])
+            if seq == self.seq:
+                return self.devices
+            if seq & 1:
+                time.sleep(0)
+                continue
+            data = self.map[TABLE_HEADER.size:TABLE_HEADER.size + length]
+            if TABLE_HEADER.unpack(self.map[0:TABLE_HEADER.size])[0] != seq:
+                continue
+            self.devices = pickle.loads(data) if length else list()
+            self.seq = seq
+            return self.devices
+
+
+class GatewayManager(BaseManager):
+    """ IPC channel between API workers and the radio-owner process """
+    pass
+
+
+class GatewayClient(object):
+    """ Stand-in for XrfAPI in API worker processes """
+
+    def __init__(self, address, authkey, tablePath):
+        GatewayManager.register('get_api')
+        manager = GatewayManager(address=address, authkey=authkey)
+        while True:
+            try:
+                manager.connect()
+                break
+            except (IOError, OSError):
+                time.sleep(0.5)     # radio owner not up yet
+        self.api = manager.get_api()
+        self.table = DeviceTableReader(tablePath)
+
+    def getDevices(self):
+        """ Device list from shared memory (no IPC round trip) """
+        return [dict(device) for device in self.table.read()]
+
+    def getStatus(self):
+        return self.api.getStatus()
+
+    def getVersion(self):
+        """ Sequence number of the shared device table """
+        self.table.read()
+        return self.table.seq
+
+    def getDevice(self, uid):
+        for device in self.table.read():
+            if device['uid'] == uid:
+                return dict(device)
+        return None
+
+    def queryDevices(self, equals=None, ranges=None, motion=None, fields=None, cursor=None, limit=None):
+        return self.api.queryDevices(equals, ranges, motion, fields, cursor, limit)
+
+    def setChannel(self, channel):
+        return self.api.setChannel(channel)
+
+    def IDRequestAll(self, group):
+        return self.api.IDRequestAll(group)
+
+    def setPWMLevels(self, group, uid, levels):
+        return self.api.setPWMLevels(group, uid, levels)
+
+    def getPWMLevels(self, group, uid):
+        return self.api.getPWMLevels(group, uid)
+
+    def getSnapshot(self, uid):
+        return self.api.getSnapshot(uid)
+
+    def getMetrics(self):
+        return self.api.getMetrics()
+
+    def getTimeSeries(self, metric, uid, start, end, window=None):
+        return self.api.getTimeSeries(metric, uid, start, end, window)
+
+    def getFleetTimeSeries(self, metric, start, end, window):
+        return self.api.getFleetTimeSeries(metric, start, end, window)
+
+    def setDesired(self, uid, param, xparam, values):
+        return self.api.setDesired(uid, param, xparam, values)
+
+    def getShadow(self, uid):
+        return self.api.getShadow(uid)
+
+    def setScene(self, name, levels, fade=None, groups=None):
+        return self.api.setScene(name, levels, fade, groups)
+
+    def getScene(self, name):
+        return self.api.getScene(name)
+
+    def getScenes(self):
+        return self.api.getScenes()
+
+    def deleteScene(self, name):
+        return self.api.deleteScene(name)
+
+    def recallScene(self, name):
+        return self.api.recallScene(name)
+
+    def startTimeSync(self, group, syncTime=True, rtcOn=None, rtcOff=None):
+        return self.api.startTimeSync(group, syncTime, rtcOn, rtcOff)
+
+    def getTimeSync(self):
+        return self.api.getTimeSync()
+
+    def daliTransact(self, uid, commands, timeout=30.0):
+        return self.api.daliTransact(uid, commands, timeout)
+
+    def getUtilization(self):
+        return self.api.getUtilization()
+
+    def getTraces(self, limit=50, name=None):
+        return self.api.getTraces(limit, name)
+
+    def getLogging(self):
+        return self.api.getLogging()
+
+    def setLogging(self, levels=None, packets=None):
+        return self.api.setLogging(levels, packets)
+
+    def getPacketLog(self, limit=100):
+        return self.api.getPacketLog(limit)
+
+    def profile(self, seconds=5.0, interval=0.01):
+        return self.api.profile(seconds, interval)
+
+    def getThreadStats(self):
+        return self.api.getThreadStats()
+
+    def getEnergy(self, by):
+        return self.api.getEnergy(by)
+
+    def getLifetime(self, column, percentiles, threshold):
+        return self.api.getLifetime(column, percentiles, threshold)
+
+
+class RadioOwner(object):
+    """ Serves an XrfAPI instance to API worker processes """
+    publishInterval = 0.2
+
+    def __init__(self, api, address, authkey, tablePath):
+        self.api = api
+        self.address = address
+        self.writer = DeviceTableWriter(tablePath)
+        self.writer.publish(list())
+        if os.path.exists(address):
+            os.unlink(address)
+        GatewayManager.register('get_api', callable=lambda: api)
+        self.manager = GatewayManager(address=address, authkey=authkey)
+        self.server = self.manager.get_server()
+
+    def start(self):
+        """ Start the IPC server and device table publisher threads """
+        ipc = threading.Thread(target=self.server.serve_forever, name='GatewayIPC')
+        ipc.daemon = True
+        ipc.start()
+        publisher = threading.Thread(target=self.publish, name='GatewayTable')
+        publisher.daemon = True
+        publisher.start()
+        return
+
+    def publish(self):
+        """ Copy the device table into shared memory whenever it changes """
+        version = None
+        while True:
+            if self.api.version != version:
+                version = self.api.version
+                self.writer.publish(self.api.getDevices())
+            time.sleep(self.publishInterval)
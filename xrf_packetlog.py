@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Packet trace ring and runtime log level control
+
+Packets are recorded raw into a preallocated ring and only formatted when
+someone reads them, so tracing every packet costs a copy and a couple of
+comparisons instead of a hex dump.
+"""
+import binascii
+import itertools
+import logging
+import time
+
+
+LEVELS = ('CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG', 'NOTSET')
+
+PACKET_KINDS = ('R', 'W', 'T', 'C')     # received, written to dongle, TX echo, dongle command
+
+
+def setLogLevels(levels):
+    """ Set logger levels from {logger name: level name}; 'root' is the root logger """
+    levels = dict((name, str(level).upper()) for name, level in levels.items())
+    for level in levels.values():
+        if level not in LEVELS:
+            raise ValueError('unknown log level %s' % level)
+    for name, level in levels.items():
+        logging.getLogger(None if name in ('', 'root') else name).setLevel(level)
+    return
+
+
+def getLogLevels():
+    """ Effective levels of the root logger and the gateway's module loggers """
+    levels = {'root': logging.getLevelName(logging.getLogger().level)}
+    for name, logger in logging.Logger.manager.loggerDict.items():
+        if not isinstance(logger, logging.Logger):
+            continue
+        if name.startswith('xrf') or logger.level != logging.NOTSET:
+            levels[name] = logging.getLevelName(logger.getEffectiveLevel())
+    return levels
+
+
+class PacketLog(object):
+    """ Fixed-size ring of raw packets, formatted on demand.
+
+    record() stores (sequence, time, kind, payload bytes) in the next slot
+    without taking a lock; the sequence number orders the ring when it is
+    read. Recording can be narrowed to some uids, XRF message types or
+    packet kinds, and thinned to one in every sampleEvery matching packets.
+    Frames are laid out as [length, header, hops, group or uid...] when
+    sent and [length, header, hops, group, uid...] when received.
+    """
+
+    def __init__(self, capacity=4096, describe=None):
+        self.capacity = capacity
+        self.slots = [None] * capacity
+        self.sequence = itertools.count()
+        self.describe = describe        # (kind, data) -> dict of decoded fields
+        self.enabled = True
+        self.uids = None                # set of uid strings, or None for all
+        self.types = None               # set of XRF message types, or None for all
+        self.kinds = None               # set of PACKET_KINDS, or None for all
+        self.sampleEvery = 1
+        self.matched = 0
+        self.recorded = 0
+
+    def record(self, kind, payload):
+        """ Keep a packet if it passes the filters """
+        if not self.enabled:
+            return
+        if self.uids is not None or self.types is not None or self.kinds is not None:
+            if not self.matches(kind, payload):
+                return
+        if self.sampleEvery > 1:
+            self.matched += 1
+            if self.matched % self.sampleEvery:
+                return
+        index = next(self.sequence)
+        self.slots[index % self.capacity] = (index, time.time(), kind, bytes(payload))
+        self.recorded += 1
+        return
+
+    def matches(self, kind, payload):
+        if self.kinds is not None and kind not in self.kinds:
+            return False
+        if kind == 'C':
+            return self.uids is None and self.types is None
+        if len(payload) < 4:
+            return False
+        if self.types is not None and (payload[1] & 0x70) >> 4 not in self.types:
+            return False
+        if self.uids is not None:
+            if kind == 'R':
+                uid = payload[4:12]
+            elif payload[1] & 0x80:
+                uid = payload[3:11]
+            else:
+                return False
+            if binascii.hexlify(bytes(uid)) not in self.uids:
+                return False
+        return True
+
+    def configure(self, enabled=None, uids=None, types=None, kinds=None, sampleEvery=None):
+        """ Change the filters; an empty list clears a filter """
+        if kinds:
+            for kind in kinds:
+                if kind not in PACKET_KINDS:
+                    raise ValueError('unknown packet kind %s' % kind)
+        if sampleEvery is not None and int(sampleEvery) < 1:
+            raise ValueError('sampleEvery must be at least 1')
+        if enabled is not None:
+            self.enabled = bool(enabled)
+        if uids is not None:
+            self.uids = set(str(uid).lower() for uid in uids) or None
+        if types is not None:
+            self.types = set(int(msgtype) for msgtype in types) or None
+        if kinds is not None:
+            self.kinds = set(kinds) or None
+        if sampleEvery is not None:
+            self.sampleEvery = int(sampleEvery)
+        return
+
+    def getConfig(self):
+        return {'enabled': self.enabled, 'capacity': self.capacity,
+                'uids': sorted(self.uids) if self.uids else [],
+                'types': sorted(self.types) if self.types else [],
+                'kinds': sorted(self.kinds) if self.kinds else [],
+                'sampleEvery': self.sampleEvery, 'recorded': self.recorded}
+
+    def dump(self, limit=100):
+        """ The most recent packets, oldest first, formatted for display """
+        slots = sorted(slot for slot in list(self.slots) if slot is not None)
+        if limit:
+            slots = slots[-limit:]
+        packets = list()
+        for index, timestamp, kind, data in slots:
+            packet = {'seq': index, 'time': timestamp, 'kind': kind,
+                      'hex': binascii.hexlify(data)}
+            if self.describe and kind != 'C':
+                packet.update(self.describe(kind, bytearray(data)))
+            packets.append(packet)
+        return packets
+
+    def clear(self):
+        self.slots = [None] * self.capacity
+        return
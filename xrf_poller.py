@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Background fleet telemetry poller
+"""
+import logging
+import random
+import threading
+import time
+
+from xrf import (XRF_PARAM_DECODERS, XRF_PARAM_EXTENDED, XRF_PARAM_LIGHT, XRF_PARAM_PWRSTAT,
+                 XRF_PARAM_SVC_TIMES, XRF_PARAM_TEMP, XRF_X_DECODERS, XRF_X_PWMAVG, frameAirtime)
+
+
+log = logging.getLogger(__name__)
+
+
+class TelemetryPoller(threading.Thread):
+    """ Polls temperature, light and power status from every fixture.
+
+    Each cycle gives every (fixture, parameter) poll its own slot, evenly
+    spaced across the interval with jitter. Polls are interleaved across
+    mesh regions (group and hop count) so consecutive frames don't pile up
+    in one part of the mesh, and are never sent closer together than the
+    airtime budget allows (scaled down by the channel's measured load); if
+    the fleet doesn't fit, the cycle stretches.
+    A poll is skipped when the fixture has reported that value recently.
+    Lifetime counters change slowly, so they are only read every
+    lifetimeEvery cycles.
+    """
+    params = [(XRF_PARAM_TEMP, None), (XRF_PARAM_LIGHT, None), (XRF_PARAM_PWRSTAT, None)]
+    lifetimeParams = [(XRF_PARAM_SVC_TIMES, None), (XRF_PARAM_EXTENDED, XRF_X_PWMAVG)]
+    lifetimeEvery = 12      # cycles between lifetime counter reads
+    airtimeShare = 0.05     # fraction of channel airtime the poller may use
+    getLength = 12          # unicast GET frame bytes
+    ackLength = 18          # typical GETACK frame bytes
+    jitter = 0.2            # +/- fraction of a slot
+    freshness = 0.5         # skip if the value arrived within this fraction of the interval
+
+    def __init__(self, api, interval=300, name="XrfPoller"):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.api = api
+        self.interval = interval
+        self.running = False
+        self.stats = {'cycles': 0, 'polls': 0, 'skipped': 0, 'lastCycleTime': 0.0,
+                      'slot': 0.0, 'airtime': 0.0}
+
+    def airtime(self, hopcount):
+        """ Estimated seconds of airtime for one GET and its GETACK, including relays """
+        return frameAirtime(self.getLength, hopcount) + frameAirtime(self.ackLength, hopcount)
+
+    def planCycle(self, cycle=0):
+        """ Ordered list of (uid, param, xparam, hopcount) polls for one cycle """
+        regions = dict()
+        for device in self.api.getDevices():
+            region = (device.get('group'), device.get('hopcount'))
+            regions.setdefault(region, list()).append(device)
+
+        # round-robin across regions so neighbouring slots hit different parts of the mesh
+        queues = [list(devices) for region, devices in sorted(regions.items())]
+        devices = list()
+        while queues:
+            for queue in queues:
+                devices.append(queue.pop(0))
+            queues = [queue for queue in queues if queue]
+
+        params = list(self.params)
+        if cycle % self.lifetimeEvery == 0:
+            params += self.lifetimeParams
+        plan = list()
+        for param, xparam in params:
+            for device in devices:
+                plan.append((device['uid'], param, xparam, device.get('hopcount')))
+        return plan
+
+    def run(self):
+        self.running = True
+        self.api.registerMetrics('poller', self.getStats)
+        while self.running:
+            plan = self.planCycle(self.stats['cycles'])
+            if not plan:
+                time.sleep(min(self.interval, 10))
+                continue
+
+            start = time.time()
+            slot = self.interval / float(len(plan))
+            self.stats['slot'] = slot
+            lastSend = 0
+            lastAirtime = 0
+            for index, (uid, param, xparam, hopcount) in enumerate(plan):
+                if not self.running:
+                    break
+                if xparam is None:
+                    field = XRF_PARAM_DECODERS[param][0]
+                else:
+                    field = XRF_X_DECODERS[xparam][0]
+                if time.time() - self.api.lastUpdate(uid, field) < self.interval * self.freshness:
+                    self.stats['skipped'] += 1
+                    continue
+
+                due = start + (index + random.uniform(-self.jitter, self.jitter)) * slot
+                # leave more room on a channel that is already busy
+                share = self.airtimeShare * max(0.1, 1.0 - self.api.channelLoad())
+                due = max(due, lastSend + lastAirtime / share)
+                delay = due - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+                hops = self.api.hopsForTarget(0, uid)
+                if xparam is None:
+                    self.api.xrfThread.rfGetParameter(param, 0, uid, None, hops, background=True)
+                else:
+                    self.api.xrfThread.rfGetExtParameter(xparam, 0, uid, hops, background=True)
+                lastSend = time.time()
+                lastAirtime = self.airtime(hopcount)
+                self.stats['polls'] += 1
+                self.stats['airtime'] += lastAirtime
+
+            elapsed = time.time() - start
+            self.stats['cycles'] += 1
+            self.stats['lastCycleTime'] = elapsed
+            if elapsed > self.interval * 1.1:
+                log.debug('telemetry cycle took %.0fs, over its %ds interval (airtime budget)',
+                              elapsed, self.interval)
+            if elapsed < self.interval:
+                time.sleep(self.interval - elapsed)
+        return
+
+    def stop(self):
+        self.running = False
+        return
+
+    def getStats(self):
+        return dict(self.stats)
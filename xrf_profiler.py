@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+Built-in profiling: on-demand stack sampling and per-thread CPU accounting
+
+The sampler reads every thread's Python stack at a fixed interval for a
+few seconds and counts identical stacks, giving the collapsed format that
+flamegraph.pl and speedscope read. Nothing runs between profiles.
+
+CPU time and wakeups per thread come from /proc/self/task on Linux. A
+wakeup is a voluntary context switch: the thread blocked (sleep, select,
+a queue or lock) and was woken again. Kernel thread ids are matched to
+Python thread names by a hook that runs as each thread starts, which also
+gives the kernel thread that name, so top -H and ps -L show it too.
+"""
+import os
+import platform
+import re
+import sys
+import threading
+import time
+
+try:
+    import ctypes
+    libc = ctypes.CDLL(None, use_errno=True)
+except (ImportError, OSError):
+    libc = None
+
+
+TASK_PATH = '/proc/self/task'
+PR_SET_NAME = 15
+SYS_GETTID = {'x86_64': 186, 'aarch64': 178, 'i386': 224, 'i686': 224,
+              'armv6l': 224, 'armv7l': 224}.get(platform.machine())
+
+# kernel thread id -> Python thread name, filled in as threads start
+threadNames = dict()
+
+
+def gettid():
+    """ Kernel thread id of the calling thread, or None if it can't be had """
+    if libc is None or SYS_GETTID is None:
+        return None
+    tid = libc.syscall(SYS_GETTID)
+    return tid if tid > 0 else None
+
+
+def registerThread(name=None):
+    """ Record the calling thread's kernel id under its (or the given) name """
+    name = name or threading.current_thread().name
+    tid = gettid()
+    if tid is None:
+        return
+    threadNames[tid] = name
+    if tid != os.getpid():      # renaming the main thread would rename the process
+        libc.prctl(PR_SET_NAME, ctypes.c_char_p(name[:15]), 0, 0, 0)
+    return
+
+
+def _threadStarted(frame, event, arg):
+    """ Profile hook run once at the start of each new thread """
+    sys.setprofile(None)
+    registerThread()
+    return
+
+
+def installThreadNames():
+    """ Name the calling thread and every thread started from now on """
+    registerThread()
+    threading.setprofile(_threadStarted)
+    return
+
+
+class ProfilerBusy(Exception):
+    """ Raised when a profile is requested while another is running """
+    pass
+
+
+class StackSampler(object):
+    """ Wall-clock sampling profiler across all Python threads.
+
+    Each sample takes sys._current_frames() and keeps the code objects of
+    every stack, which are only turned into text once the profile is over.
+    The sampling thread leaves itself out. Thread names ending in -N (the
+    per-request threads of the HTTP servers) are merged into one.
+    """
+    maxSeconds = 60.0
+    minInterval = 0.001
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {'profiles': 0, 'samples': 0, 'lastProfile': None}
+
+    def profile(self, seconds=5.0, interval=0.01):
+        """ Sample for seconds; returns {'stacks': {collapsed stack: count}, ...} """
+        seconds = float(seconds)
+        interval = float(interval)
+        if not 0 < seconds <= self.maxSeconds:
+            raise ValueError('seconds must be between 0 and %g' % self.maxSeconds)
+        if interval < self.minInterval:
+            raise ValueError('interval must be at least %g' % self.minInterval)
+        if not self.lock.acquire(False):
+            raise ProfilerBusy('a profile is already running')
+        try:
+            return self.sample(seconds, interval)
+        finally:
+            self.lock.release()
+
+    def sample(self, seconds, interval):
+        me = threading.current_thread().ident
+        names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+        counts = dict()
+        samples = 0
+        started = time.time()
+        deadline = started + seconds
+        due = started
+        while True:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                codes = list()
+                while frame is not None:
+                    codes.append(frame.f_code)
+                    frame = frame.f_back
+                key = (ident, tuple(codes))
+                counts[key] = counts.get(key, 0) + 1
+                if ident not in names:
+                    names.update((thread.ident, thread.name) for thread in threading.enumerate())
+            samples += 1
+            due += interval
+            now = time.time()
+            if due >= deadline:
+                break
+            if due > now:
+                time.sleep(due - now)
+        elapsed = time.time() - started
+
+        stacks = dict()
+        for (ident, codes), count in counts.items():
+            thread = re.sub(r'-\d+$', '', names.get(ident, 'thread-%d' % ident))
+            frames = ['%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+                      for code in reversed(codes)]
+            stack = ';'.join([thread] + frames)
+            stacks[stack] = stacks.get(stack, 0) + count
+        self.stats['profiles'] += 1
+        self.stats['samples'] += samples
+        self.stats['lastProfile'] = started
+        return {'started': started, 'seconds': elapsed, 'interval': interval,
+                'samples': samples, 'stacks': stacks}
+
+    def getStats(self):
+        return dict(self.stats)
+
+
+def collapse(stacks):
+    """ Collapsed stack text (one 'frame;frame;... count' per line), busiest first """
+    lines = ['%s %d\n' % (stack, count)
+             for stack, count in sorted(stacks.items(), key=lambda item: (-item[1], item[0]))]
+    return ''.join(lines)
+
+
+class ThreadAccounting(object):
+    """ CPU time and wakeups of each of the process's threads.
+
+    Counters are read from /proc when asked for, so this costs nothing in
+    between. Totals are since each thread started; rates are over the time
+    since an earlier reading at least window seconds old (the first
+    reading has none).
+    """
+    window = 10.0
+
+    def __init__(self, taskPath=TASK_PATH):
+        self.taskPath = taskPath
+        self.available = os.path.isdir(taskPath)
+        self.ticks = float(os.sysconf('SC_CLK_TCK')) if self.available else 100.0
+        self.lock = threading.Lock()
+        self.baseline = None        # (time, counters) of the latest reading kept
+        self.previous = None        # (time, counters) of the one before it
+
+    def readTask(self, tid):
+        """ Counters of one kernel thread, or None if it has exited """
+        path = os.path.join(self.taskPath, str(tid))
+        try:
+            with open(os.path.join(path, 'stat')) as f:
+                stat = f.read()
+            with open(os.path.join(path, 'status')) as f:
+                status = f.read()
+        except (IOError, OSError):
+            return None
+        comm = stat[stat.index('(') + 1:stat.rindex(')')]
+        fields = stat[stat.rindex(')') + 2:].split()
+        counters = {'name': threadNames.get(tid, comm),
+                    'user': int(fields[11]) / self.ticks,
+                    'system': int(fields[12]) / self.ticks}
+        for line in status.splitlines():
+            if line.startswith('voluntary_ctxt_switches:'):
+                counters['wakeups'] = int(line.split()[1])
+            elif line.startswith('nonvoluntary_ctxt_switches:'):
+                counters['preemptions'] = int(line.split()[1])
+        counters['cpu'] = counters['user'] + counters['system']
+        return counters
+
+    def read(self):
+        """ {tid: counters} for every live thread """
+        if not self.available:
+            return dict()
+        threads = dict()
+        for entry in os.listdir(self.taskPath):
+            counters = self.readTask(int(entry))
+            if counters is not None:
+                threads[int(entry)] = counters
+        for tid in list(threadNames):
+            if tid not in threads:
+                threadNames.pop(tid, None)
+        return threads
+
+    def getStats(self):
+        """ Per-thread totals and rates, busiest first """
+        self.lock.acquire()
+        now = time.time()
+        threads = self.read()
+        if self.baseline is None or now - self.baseline[0] >= self.window:
+            self.previous, self.baseline = self.baseline, (now, threads)
+        reference = self.previous or self.baseline
+        self.lock.release()
+
+        elapsed = now - reference[0]
+        return {'available': self.available, 'period': elapsed,
+                'threads': self.compare(reference[1], threads, elapsed)}
+
+    def compare(self, before, after, elapsed):
+        """ Per-thread totals from after, with rates since before, busiest first """
+        report = list()
+        for tid, counters in after.items():
+            entry = dict(counters)
+            entry['tid'] = tid
+            previous = before.get(tid)
+            if elapsed > 0 and previous is not None and previous['name'] == counters['name']:
+                entry['cpuPercent'] = 100.0 * (counters['cpu'] - previous['cpu']) / elapsed
+                entry['wakeupsPerSecond'] = (counters.get('wakeups', 0) - previous.get('wakeups', 0)) / elapsed
+            report.append(entry)
+        report.sort(key=lambda entry: (-entry.get('cpuPercent', 0), -entry['cpu'], entry['tid']))
+        return report
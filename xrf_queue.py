@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Bounded packet queues with per-class capacity and overload policy
+"""
+import Queue
+import threading
+import time
+from collections import deque
+
+
+POLICY_REJECT = 'reject'            # refuse the new packet (the REST layer answers 503)
+POLICY_DROP_OLDEST = 'drop-oldest'  # discard the oldest queued packet of the same class
+POLICY_COALESCE = 'coalesce'        # replace a queued packet with the same key, else reject
+POLICY_DROP_BACKGROUND = 'drop-background'  # discard the oldest queued background packet, else reject
+
+# class name: (capacity, policy)
+TX_QUEUE_CLASSES = {
+    'command': (16, POLICY_REJECT),         # dongle commands
+    'set': (64, POLICY_COALESCE),           # SETs; a newer value supersedes a queued one
+    'get': (64, POLICY_DROP_BACKGROUND),    # GETs and ID requests; polls give way to callers
+}
+RX_QUEUE_CLASSES = {
+    'rx': (1024, POLICY_DROP_OLDEST),
+}
+
+
+class QueueOverload(Queue.Full):
+    """ Raised when a packet is refused because its class is at capacity """
+
+    def __init__(self, packetClass):
+        Queue.Full.__init__(self, packetClass)
+        self.packetClass = packetClass
+
+    def __str__(self):
+        return 'queue full for %s packets' % self.packetClass
+
+
+class BoundedPacketQueue(object):
+    """ FIFO of packets with a capacity and overload policy per packet class.
+
+    Packets are classified by their txClass attribute (or defaultClass), and
+    may carry a coalesceKey used by the coalesce policy and a background
+    flag used by the drop-background policy. A discarded packet's onDrop
+    hook is called so whoever is waiting on it can give up straight away.
+    Presents the subset of the Queue.Queue interface used by the comms
+    threads.
+    """
+
+    def __init__(self, classes, defaultClass=None):
+        self.classes = classes
+        self.defaultClass = defaultClass or sorted(classes.keys())[0]
+        self.items = deque()
+        self.cond = threading.Condition()
+        self.stats = dict()
+        for name in classes:
+            self.stats[name] = {'queued': 0, 'highWater': 0, 'dropped': 0,
+                                'rejected': 0, 'coalesced': 0}
+
+    def classOf(self, pkt):
+        name = getattr(pkt, 'txClass', None)
+        if name not in self.classes:
+            name = self.defaultClass
+        return name
+
+    def put(self, pkt, block=True, timeout=None):
+        """ Queue a packet, applying the class's overload policy when it is full """
+        name = self.classOf(pkt)
+        capacity, policy = self.classes[name]
+        stats = self.stats[name]
+        dropped = None
+        self.cond.acquire()
+        try:
+            if policy == POLICY_COALESCE:
+                key = getattr(pkt, 'coalesceKey', None)
+                if key is not None:
+                    for i, queued in enumerate(self.items):
+                        if getattr(queued, 'coalesceKey', None) == key:
+                            # the newer packet goes to the back, behind anything queued since
+                            del self.items[i]
+                            self.items.append(pkt)
+                            stats['coalesced'] += 1
+                            self.cond.notify()
+                            return
+
+            if stats['queued'] >= capacity:
+                if policy == POLICY_DROP_OLDEST:
+                    for queued in self.items:
+                        if self.classOf(queued) == name:
+                            dropped = queued
+                            break
+                elif policy == POLICY_DROP_BACKGROUND:
+                    for queued in self.items:
+                        if self.classOf(queued) == name and getattr(queued, 'background', False):
+                            dropped = queued
+                            break
+                    if dropped is None and getattr(pkt, 'background', False):
+                        stats['dropped'] += 1
+                        dropped = pkt
+                        return
+                if dropped is None:
+                    stats['rejected'] += 1
+                    raise QueueOverload(name)
+                self.items.remove(dropped)
+                stats['queued'] -= 1
+                stats['dropped'] += 1
+
+            self.items.append(pkt)
+            stats['queued'] += 1
+            stats['highWater'] = max(stats['highWater'], stats['queued'])
+            self.cond.notify()
+        finally:
+            self.cond.release()
+            if dropped is not None and getattr(dropped, 'onDrop', None):
+                dropped.onDrop(dropped)
+        return
+
+    def get(self, block=True, timeout=None):
+        """ Remove and return the oldest packet """
+        self.cond.acquire()
+        try:
+            if block:
+                deadline = None if timeout is None else time.time() + timeout
+                while not self.items:
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+            if not self.items:
+                raise Queue.Empty
+            pkt = self.items.popleft()
+            self.stats[self.classOf(pkt)]['queued'] -= 1
+            return pkt
+        finally:
+            self.cond.release()
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def empty(self):
+        return not self.items
+
+    def qsize(self):
+        return len(self.items)
+
+    def getStats(self):
+        """ Return per-class depth, high-water mark and drop counters """
+        self.cond.acquire()
+        stats = dict((name, dict(values)) for name, values in self.stats.items())
+        self.cond.release()
+        return stats
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""
+Bounded registry of discovered fixtures
+"""
+import bisect
+import heapq
+import logging
+import sys
+import time
+from collections import OrderedDict
+
+
+log = logging.getLogger(__name__)
+
+
+STATE_ACTIVE = 'active'     # heard from within staleAfter
+STATE_STALE = 'stale'       # not heard from for a while; kept until evicted
+
+# fields kept in a tombstone, enough to address the fixture again
+TOMBSTONE_FIELDS = ('model', 'group', 'channel', 'hopcount', 'fwversion')
+
+# fields with an equality index, which setField() keeps up to date
+INDEXED_FIELDS = ('model', 'group', 'channel', 'hopcount', 'state')
+
+
+class DeviceRegistry(object):
+    """ Discovered fixtures keyed by uid string, with aging and eviction.
+
+    Every frame from a fixture calls observe(), which stamps 'lastseen'.
+    A periodic sweep marks fixtures not heard from for staleAfter seconds
+    as stale and evicts them after evictAfter. Fixtures heard only once,
+    from an unsolicited report (a neighbouring building, a mis-decoded
+    uid), are dropped outright after probation; one that has answered an
+    ID request, GET or SET is confirmed and never treated that way. If the registry is over maxDevices or its estimated
+    size is over maxBytes, the least recently seen fixtures are evicted.
+
+    An evicted fixture leaves a small tombstone of its addressing fields,
+    so if it is heard from again it comes back with its model, group and
+    channel rather than as a blank entry. Tombstones are capped at
+    maxTombstones, oldest dropped first.
+
+    INDEXED_FIELDS and motion times are indexed so query() costs in
+    proportion to its result rather than the fleet, and uids are kept
+    sorted so an unfiltered page doesn't sort the fleet either; indexed
+    fields must be written with setField(). Reads mirror a dict of uid -> device dict. All
+    access must hold the owner's device lock.
+    """
+    staleAfter = 3600.0             # seconds unheard before a fixture is stale
+    evictAfter = 7 * 86400.0        # seconds unheard before a fixture is evicted
+    probation = 3600.0              # seconds before a fixture heard only once is dropped
+    maxDevices = 20000
+    maxBytes = 64 * 1024 * 1024     # estimated size of the device dicts
+    maxTombstones = 100000
+    sweepInterval = 60.0
+    sizeSample = 64                 # devices measured to estimate the registry size
+
+    def __init__(self, onEvict=None, onRestore=None, onCreate=None):
+        self.devices = dict()
+        self.tombstones = OrderedDict()     # uid -> tuple of TOMBSTONE_FIELDS values
+        self.probationary = set()           # uids heard from only once
+        self.onEvict = onEvict              # onEvict(uid, device), called as devices leave
+        self.onRestore = onRestore          # onRestore(uid, device), called as devices come back
+        self.onCreate = onCreate            # onCreate(uid, device), called as new devices appear
+        self.indexes = dict((field, dict()) for field in INDEXED_FIELDS)    # field -> value -> set of uids
+        self.motion = OrderedDict()         # uid -> time of last motion, oldest first
+        self.uids = list()                  # every uid in devices, sorted
+        self.nextSweep = 0
+        self.stats = {'created': 0, 'reinstated': 0, 'evicted': 0, 'ghosts': 0,
+                      'stale': 0, 'estimatedBytes': 0}
+
+    def get(self, uid, default=None):
+        return self.devices.get(uid, default)
+
+    def __contains__(self, uid):
+        return uid in self.devices
+
+    def __len__(self):
+        return len(self.devices)
+
+    def __iter__(self):
+        return iter(self.devices)
+
+    def keys(self):
+        return self.devices.keys()
+
+    def values(self):
+        return self.devices.values()
+
+    def items(self):
+        return self.devices.items()
+
+    def observe(self, uid, now=None, confirmed=False):
+        """ The device for a fixture just heard from, created or reinstated as
+        needed. confirmed is True for replies to the gateway's own requests. """
+        if now is None:
+            now = time.time()
+        device = self.devices.get(uid)
+        if device is None:
+            device = self.devices[uid] = dict()
+            bisect.insort(self.uids, uid)
+            tombstone = self.tombstones.pop(uid, None)
+            if tombstone is None:
+                log.debug('Discovered new device %s', uid)
+                if not confirmed:
+                    self.probationary.add(uid)
+                self.stats['created'] += 1
+                if self.onCreate:
+                    self.onCreate(uid, device)
+            else:
+                log.debug('Reinstated device %s', uid)
+                for field, value in zip(TOMBSTONE_FIELDS, tombstone):
+                    if value is not None:
+                        self.setField(uid, device, field, value)
+                self.stats['reinstated'] += 1
+                if self.onRestore:
+                    self.onRestore(uid, device)
+        else:
+            log.debug('Discovered existing device %s', uid)
+            if self.probationary:
+                self.probationary.discard(uid)
+        device['lastseen'] = now
+        if device.get('state') != STATE_ACTIVE:
+            self.setField(uid, device, 'state', STATE_ACTIVE)
+        if now >= self.nextSweep:
+            self.sweep(now)
+        return device
+
+    def setField(self, uid, device, field, value):
+        """ Set a device field, keeping its index current """
+        index = self.indexes.get(field)
+        if index is not None:
+            old = device.get(field)
+            if old == value and field in device:
+                return
+            if field in device:
+                self.unindex(index, old, uid)
+            index.setdefault(value, set()).add(uid)
+        device[field] = value
+        return
+
+    def unindex(self, index, value, uid):
+        uids = index.get(value)
+        if uids is not None:
+            uids.discard(uid)
+            if not uids:
+                del index[value]
+        return
+
+    def motionAt(self, uid, timestamp):
+        """ Record that a fixture reported motion """
+        self.motion.pop(uid, None)
+        self.motion[uid] = timestamp
+        return
+
+    def evict(self, uid, tombstone=True):
+        """ Remove a device, leaving a tombstone unless it never proved real """
+        device = self.devices.pop(uid)
+        del self.uids[bisect.bisect_left(self.uids, uid)]
+        self.probationary.discard(uid)
+        for field, index in self.indexes.items():
+            if field in device:
+                self.unindex(index, device[field], uid)
+        self.motion.pop(uid, None)
+        if tombstone:
+            self.tombstones[uid] = tuple(device.get(field) for field in TOMBSTONE_FIELDS)
+            while len(self.tombstones) > self.maxTombstones:
+                self.tombstones.popitem(last=False)
+            self.stats['evicted'] += 1
+        else:
+            self.stats['ghosts'] += 1
+        if self.onEvict:
+            self.onEvict(uid, device)
+        return
+
+    def estimateBytes(self):
+        """ Approximate size of the device dicts, from a sample """
+        if not self.devices:
+            return 0
+        sample = list()
+        for device in self.devices.itervalues():
+            sample.append(sys.getsizeof(device) + sum(sys.getsizeof(value) for value in device.itervalues()))
+            if len(sample) >= self.sizeSample:
+                break
+        return sum(sample) * len(self.devices) // len(sample)
+
+    def sweep(self, now=None):
+        """ Age, expire and cap the registry """
+        if now is None:
+            now = time.time()
+        self.nextSweep = now + self.sweepInterval
+        staleBefore = now - self.staleAfter
+        evictBefore = now - self.evictAfter
+        ghostBefore = now - self.probation
+
+        stale = 0
+        for uid, device in self.devices.items():
+            lastseen = device.get('lastseen', 0)
+            if uid in self.probationary and lastseen < ghostBefore:
+                self.evict(uid, False)
+            elif lastseen < evictBefore:
+                self.evict(uid)
+            elif lastseen < staleBefore:
+                self.setField(uid, device, 'state', STATE_STALE)
+                stale += 1
+
+        size = self.estimateBytes()
+        excess = len(self.devices) - self.maxDevices
+        if size > self.maxBytes:
+            excess = max(excess, len(self.devices) - self.maxBytes * len(self.devices) // size)
+        if excess > 0:
+            oldest = heapq.nsmallest(excess, self.devices.iteritems(),
+                                     key=lambda item: item[1].get('lastseen', 0))
+            for uid, device in oldest:
+                if device['state'] == STATE_STALE:
+                    stale -= 1
+                self.evict(uid)
+            size = self.estimateBytes()
+        self.stats['stale'] = stale
+        self.stats['estimatedBytes'] = size
+        return
+
+    def query(self, equals=None, ranges=None, motion=None):
+        """ Sorted uids of devices matching every condition.
+
+        equals maps an indexed field to the values it may take, ranges maps
+        an indexed field to inclusive (low, high) bounds (None for open) and
+        motion is a (since, until) range of last motion times. With no
+        conditions the registry's own sorted list is returned, which callers
+        must not change.
+        """
+        candidates = list()
+        for field, values in (equals or {}).items():
+            index = self.indexes[field]
+            candidates.append(set().union(*[index.get(value, ()) for value in values]))
+        for field, (low, high) in (ranges or {}).items():
+            index = self.indexes[field]
+            candidates.append(set().union(*[uids for value, uids in index.items()
+                                            if (low is None or value >= low) and
+                                               (high is None or value <= high)]))
+        if motion is not None:
+            since, until = motion
+            moved = set()
+            for uid in reversed(self.motion):
+                timestamp = self.motion[uid]
+                if since is not None and timestamp < since:
+                    break
+                if until is None or timestamp <= until:
+                    moved.add(uid)
+            candidates.append(moved)
+
+        if not candidates:
+            return self.uids
+        candidates.sort(key=len)
+        uids = candidates[0].intersection(*candidates[1:])
+        return sorted(uids)
+
+    def page(self, uids, cursor=None, limit=None):
+        """ Slice of sorted uids after cursor, and the cursor of the next page """
+        if limit is not None and limit < 1:
+            raise ValueError('limit must be at least 1')
+        start = bisect.bisect_right(uids, cursor) if cursor else 0
+        if limit is None or start + limit >= len(uids):
+            return uids[start:], None
+        return uids[start:start + limit], uids[start + limit - 1]
+
+    def snapshot(self):
+        """ Copies of the devices, tombstones and motion times, for saving """
+        return (dict((uid, dict(device)) for uid, device in self.devices.iteritems()),
+                self.tombstones.items(), self.motion.items())
+
+    def restore(self, devices, tombstones, motion=()):
+        """ Load saved devices as stale (until heard from again), their motion
+        times and saved tombstones, keeping any entries already learnt since
+        startup """
+        restored = 0
+        before = set(self.devices)
+        for uid, saved in devices.items():
+            if uid in self.devices:
+                continue
+            device = self.devices[uid] = dict()
+            for field, value in saved.items():
+                self.setField(uid, device, field, value)
+            self.setField(uid, device, 'state', STATE_STALE)
+            restored += 1
+            if self.onRestore:
+                self.onRestore(uid, device)
+        if restored:
+            self.uids = sorted(self.devices)
+            times = [(timestamp, uid) for uid, timestamp in motion if uid in self.devices and uid not in before]
+            times.extend((timestamp, uid) for uid, timestamp in self.motion.items())
+            self.motion = OrderedDict((uid, timestamp) for timestamp, uid in sorted(times))
+        for uid, tombstone in tombstones:
+            if uid not in self.devices:
+                self.tombstones[uid] = tuple(tombstone)
+        while len(self.tombstones) > self.maxTombstones:
+            self.tombstones.popitem(last=False)
+        self.nextSweep = 0
+        return restored
+
+    def getStats(self):
+        stats = dict(self.stats)
+        stats['devices'] = len(self.devices)
+        stats['probationary'] = len(self.probationary)
+        stats['tombstones'] = len(self.tombstones)
+        return stats
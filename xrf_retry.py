@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Round trip time estimation and retry timing for XRF requests
+"""
+import random
+import threading
+
+
+class RttEstimator(object):
+    """ Smoothed RTT and RTT variance (Jacobson/Karels, as in RFC 6298) """
+    alpha = 0.125
+    beta = 0.25
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.samples = 0
+
+    def sample(self, rtt):
+        """ Fold a new round trip measurement into the estimate """
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2.0
+        else:
+            self.rttvar = (1 - self.beta) * self.rttvar + self.beta * abs(self.srtt - rtt)
+            self.srtt = (1 - self.alpha) * self.srtt + self.alpha * rtt
+        self.samples += 1
+        return
+
+    def rto(self):
+        """ Retransmission timeout, or None if nothing has been measured yet """
+        if self.srtt is None:
+            return None
+        return self.srtt + 4 * self.rttvar
+
+
+class RttTable(object):
+    """ RTT estimators kept per fixture and per hop-count bucket.
+
+    A fixture's own estimator is used once it has samples; until then the
+    estimator for its hop distance stands in, and failing that the initial
+    timeout. Each retry doubles the timeout up to maxTimeout and adds jitter
+    so that retries to many fixtures don't line up on the air.
+    """
+
+    def __init__(self, initialTimeout=1.0, minTimeout=0.2, maxTimeout=5.0, jitter=0.1):
+        self.initialTimeout = initialTimeout
+        self.minTimeout = minTimeout
+        self.maxTimeout = maxTimeout
+        self.jitter = jitter
+        self.devices = dict()
+        self.buckets = dict()
+        self.lock = threading.Lock()
+
+    def sample(self, uid, hopcount, rtt):
+        """ Record a round trip time measured to a fixture """
+        self.lock.acquire()
+        self.devices.setdefault(uid, RttEstimator()).sample(rtt)
+        self.buckets.setdefault(hopcount, RttEstimator()).sample(rtt)
+        self.lock.release()
+        return
+
+    def forget(self, uid):
+        """ Drop the estimator for a fixture """
+        self.lock.acquire()
+        self.devices.pop(uid, None)
+        self.lock.release()
+        return
+
+    def baseTimeout(self, uid, hopcount):
+        """ Timeout for a first attempt, before backoff """
+        self.lock.acquire()
+        rto = None
+        estimator = self.devices.get(uid)
+        if estimator is not None:
+            rto = estimator.rto()
+        if rto is None:
+            estimator = self.buckets.get(hopcount)
+            if estimator is not None:
+                rto = estimator.rto()
+        self.lock.release()
+        if rto is None:
+            rto = self.initialTimeout
+        return max(self.minTimeout, min(rto, self.maxTimeout))
+
+    def timeout(self, uid, hopcount, attempt=0):
+        """ Timeout for the given attempt with capped exponential backoff and jitter """
+        timeout = min(self.baseTimeout(uid, hopcount) * (2 ** attempt), self.maxTimeout)
+        return timeout * (1 + random.uniform(0, self.jitter))
+
+    def getStats(self):
+        """ Return the per hop-count estimates as a dictionary """
+        self.lock.acquire()
+        buckets = dict()
+        for hopcount, estimator in self.buckets.items():
+            buckets[str(hopcount)] = {'srtt': estimator.srtt,
+                                      'rttvar': estimator.rttvar,
+                                      'rto': estimator.rto(),
+                                      'samples': estimator.samples}
+        stats = {'buckets': buckets, 'devices': len(self.devices)}
+        self.lock.release()
+        return stats
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Lighting scenes compiled into minimal broadcast/group/unicast frame plans
+"""
+import threading
+import time
+
+from xrf import XRF_PARAM_EXTENDED, XRF_PARAM_PWM, XRF_UNIVERSAL_GROUP, XRF_X_FADETIMES
+
+
+PWM_KEYS = ('occMains', 'occBatt', 'unoccMains', 'unoccBatt')
+
+
+def mostCommon(values):
+    """ Most frequent value (ties broken by value, so plans are deterministic) """
+    counts = dict()
+    for value in values:
+        counts[value] = counts.get(value, 0) + 1
+    return max(counts.items(), key=lambda item: (item[1], item[0]))[0]
+
+
+def planAssignments(values, groups, targets=()):
+    """ Fewest frames that leave every fixture in values at its value.
+
+    values maps uid to a value and groups maps group number to the set of
+    known member uids. The registry only knows the fixtures it has heard
+    from, so a broadcast or group frame could reach fixtures outside the
+    scene; they are only sent for the groups in targets, which the scene
+    addresses as a whole (XRF_UNIVERSAL_GROUP for every fixture). Each takes
+    the most common value of its members in the scene, and unicasts fix up
+    whatever is still wrong. Returns (group, uid, value) in send order; uid
+    is None for broadcast and group frames.
+    """
+    frames = list()
+    effective = dict()
+    if XRF_UNIVERSAL_GROUP in targets and values:
+        base = mostCommon(values.values())
+        frames.append((XRF_UNIVERSAL_GROUP, None, base))
+        effective = dict.fromkeys(values, base)
+
+    for group in sorted(targets):
+        members = [uid for uid in groups.get(group, ()) if uid in values]
+        if group == XRF_UNIVERSAL_GROUP or not members:
+            continue
+        value = mostCommon(values[uid] for uid in members)
+        frames.append((group, None, value))
+        for uid in members:
+            effective[uid] = value
+
+    for uid in sorted(values):
+        if effective.get(uid) != values[uid]:
+            frames.append((0, uid, values[uid]))
+    return frames
+
+
+class SceneEngine(object):
+    """ Stores scenes and recalls them from cached frame plans.
+
+    A scene sets PWM levels on a set of fixtures and optionally their fade
+    times. It may also name groups (XRF_UNIVERSAL_GROUP for every fixture)
+    it addresses as a whole, which are set with one frame each; other
+    fixtures are only ever sent unicasts. Plans depend on group membership,
+    so the cache is dropped whenever a fixture's group changes or a new
+    fixture appears.
+    """
+
+    def __init__(self, api):
+        self.api = api
+        self.scenes = dict()        # name -> {'levels': {uid: (4 levels)}, 'fade': (up, down) or None,
+                                    #          'groups': [group numbers addressed as a whole]}
+        self.compiled = dict()      # name -> list of frames
+        self.lock = threading.Lock()
+        self.stats = {'compiles': 0, 'recalls': 0, 'frames': 0, 'invalidations': 0}
+
+    def install(self):
+        """ Attach to the XrfAPI instance """
+        self.api.scenes = self
+        self.api.addFieldListener(self.recordField)
+        self.api.registerMetrics('scenes', self.getStats)
+        return
+
+    def recordField(self, uid, field, value, timestamp=None):
+        """ XrfAPI field listener: new fixtures and group changes invalidate plans """
+        if field in ('group', 'discovered'):
+            self.lock.acquire()
+            if self.compiled:
+                self.compiled.clear()
+                self.stats['invalidations'] += 1
+            self.lock.release()
+        return
+
+    def setScene(self, name, levels, fade=None, groups=None):
+        """ Store a scene: levels maps uid to a dict of PWM levels, fade is {'up': ms, 'down': ms}
+        and groups lists the groups (255 for all fixtures) it addresses as a whole """
+        groups = sorted(set(int(group) for group in groups or ()))
+        if groups and not 1 <= groups[0] <= groups[-1] <= XRF_UNIVERSAL_GROUP:
+            raise ValueError('groups must be between 1 and %d' % XRF_UNIVERSAL_GROUP)
+        scene = {'levels': dict((uid, tuple(int(pwm.get(key, 255)) for key in PWM_KEYS))
+                                for uid, pwm in levels.items()),
+                 'fade': (int(fade.get('up', 0)), int(fade.get('down', 0))) if fade else None,
+                 'groups': groups}
+        self.lock.acquire()
+        self.scenes[name] = scene
+        self.compiled.pop(name, None)
+        self.lock.release()
+        return
+
+    def deleteScene(self, name):
+        self.lock.acquire()
+        found = self.scenes.pop(name, None) is not None
+        self.compiled.pop(name, None)
+        self.lock.release()
+        return found
+
+    def membership(self):
+        """ group -> set of uids for known fixtures """
+        groups = dict()
+        for device in self.api.getDevices():
+            if device.get('group') is not None:
+                groups.setdefault(device['group'], set()).add(device['uid'])
+        return groups
+
+    def compile(self, name):
+        """ Frame plan for a scene, from the cache when membership hasn't changed """
+        self.lock.acquire()
+        scene = self.scenes.get(name)
+        frames = self.compiled.get(name)
+        invalidations = self.stats['invalidations']
+        self.lock.release()
+        if scene is None or frames is not None:
+            return frames
+
+        groups = self.membership()
+        frames = list()
+        if scene['fade']:
+            up, down = scene['fade']
+            fade = (up >> 8, up & 0xFF, down >> 8, down & 0xFF)
+            for group, uid, value in planAssignments(dict.fromkeys(scene['levels'], fade), groups,
+                                                     scene['groups']):
+                frames.append({'param': XRF_PARAM_EXTENDED, 'xparam': XRF_X_FADETIMES,
+                               'group': group, 'uid': uid, 'values': list(value)})
+        for group, uid, value in planAssignments(scene['levels'], groups, scene['groups']):
+            frames.append({'param': XRF_PARAM_PWM, 'xparam': None,
+                           'group': group, 'uid': uid, 'values': list(value)})
+
+        self.lock.acquire()
+        if self.stats['invalidations'] == invalidations and name in self.scenes:
+            self.compiled[name] = frames
+        self.stats['compiles'] += 1
+        self.lock.release()
+        return frames
+
+    def recall(self, name):
+        """ Send a scene's frames, returning the count and time taken, or None if unknown """
+        start = time.time()
+        frames = self.compile(name)
+        if frames is None:
+            return None
+        xrfThread = self.api.xrfThread
+        for frame in frames:
+            hops = self.api.hopsForTarget(frame['group'], frame['uid'])
+            values = bytearray(frame['values'])
+            if frame['xparam'] is None:
+                xrfThread.rfSetParameter(frame['param'], frame['group'], frame['uid'], values, hops)
+            else:
+                xrfThread.rfSetExtParameter(frame['xparam'], frame['group'], frame['uid'], values, hops)
+
+        # keep the shadow from "correcting" fixtures back to their old levels
+        shadow = self.api.shadow
+        if shadow:
+            for uid, levels in self.scenes.get(name, {}).get('levels', {}).items():
+                shadow.expect(uid, XRF_PARAM_PWM, None, levels)
+
+        self.stats['recalls'] += 1
+        self.stats['frames'] += len(frames)
+        return {'frames': len(frames), 'elapsed': time.time() - start}
+
+    def getScene(self, name):
+        """ A scene with its compiled plan, or None """
+        frames = self.compile(name)
+        self.lock.acquire()
+        scene = self.scenes.get(name)
+        self.lock.release()
+        if scene is None:
+            return None
+        levels = dict((uid, dict(zip(PWM_KEYS, pwm))) for uid, pwm in scene['levels'].items())
+        fade = {'up': scene['fade'][0], 'down': scene['fade'][1]} if scene['fade'] else None
+        return {'name': name, 'levels': levels, 'fade': fade, 'groups': scene['groups'], 'plan': frames}
+
+    def getScenes(self):
+        self.lock.acquire()
+        names = sorted(self.scenes)
+        self.lock.release()
+        return names
+
+    def getStats(self):
+        self.lock.acquire()
+        stats = dict(self.stats)
+        stats['scenes'] = len(self.scenes)
+        stats['compiled'] = len(self.compiled)
+        self.lock.release()
+        return stats
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+"""
+Device shadow: desired vs. reported parameter values, reconciled over RF
+"""
+import heapq
+import logging
+import threading
+import time
+
+from xrf import XRF_PARAM_DECODERS, XRF_PARAM_EXTENDED, XRF_X_DECODERS, decodeParameter, frameAirtime
+
+
+log = logging.getLogger(__name__)
+
+
+STATE_SYNCED = 'synced'     # reported value matches desired
+STATE_PENDING = 'pending'   # differs; waiting for a send slot
+STATE_SENT = 'sent'         # SET or verifying GET in flight
+
+
+class ShadowEntry(object):
+    """ Desired and last reported value of one parameter on one fixture """
+
+    def __init__(self, param, xparam, field):
+        self.param = param
+        self.xparam = xparam
+        self.field = field
+        self.desired = None         # raw SET payload (after the xparam byte)
+        self.desiredValue = None    # decoded form, compared with reported values
+        self.reported = None
+        self.reportedAt = 0
+        self.state = STATE_SYNCED
+        self.attempts = 0
+        self.due = 0
+        self.token = None           # identifies the entry's current item in the reconciler's heap
+
+    def asDict(self):
+        return {'param': self.param, 'xparam': self.xparam, 'desired': self.desiredValue,
+                'reported': self.reported, 'reportedAt': self.reportedAt,
+                'state': self.state, 'attempts': self.attempts}
+
+
+class DeviceShadow(threading.Thread):
+    """ Keeps fixtures at their desired parameter values.
+
+    setDesired() records a value and does nothing on air if the fixture
+    already reports it. Otherwise the reconciler sends a SET, and the entry
+    is synced once a SETACK, GETACK or report carries the desired value.
+    Unconfirmed entries alternate between resending the SET and reading the
+    value back with a GET, backing off with the fixture's RTT timeout; after
+    maxAttempts they are parked for stragglerDelay and tried again. Reported
+    values that later drift from the desired value are corrected the same
+    way. Sends are spaced to stay within airtimeShare of the channel, less
+    on a channel that is already busy.
+    """
+    airtimeShare = 0.05     # fraction of channel airtime the reconciler may use
+    setLength = 16          # typical unicast SET frame bytes
+    ackLength = 18          # typical SETACK/GETACK frame bytes
+    maxAttempts = 6         # SET/GET rounds before parking a straggler
+    stragglerDelay = 300.0  # seconds before retrying a parked straggler
+
+    def __init__(self, api, name="XrfShadow"):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.api = api
+        self.entries = dict()       # (uid, field) -> ShadowEntry
+        self.fields = dict()        # uid -> set of fields with entries
+        self.queue = list()         # heap of (due, token, (uid, field)) for unsynced entries
+        self.tokens = 0
+        self.cond = threading.Condition()
+        self.running = False
+        self.stats = {'sets': 0, 'gets': 0, 'confirmed': 0, 'drifted': 0,
+                      'unchanged': 0, 'stragglers': 0, 'airtime': 0.0}
+
+    def setDesired(self, uid, param, xparam, values):
+        """ Record the desired raw value of a (possibly extended) parameter """
+        values = bytearray(values)
+        data = values if xparam is None else bytearray([xparam]) + values
+        field, desiredValue = decodeParameter(param, data)
+        if field is None:
+            raise ValueError('parameter %d/%s cannot be shadowed' % (param, xparam))
+
+        self.api.deviceLock.acquire()
+        current = self.api.discoveredDevices.get(uid, {}).get(field)
+        self.api.deviceLock.release()
+
+        self.cond.acquire()
+        entry = self.entries.get((uid, field))
+        if entry is None:
+            entry = self.entries[(uid, field)] = ShadowEntry(param, xparam, field)
+            self.fields.setdefault(uid, set()).add(field)
+            entry.reported = current
+        entry.desired = values
+        entry.desiredValue = desiredValue
+        if entry.reported == desiredValue:
+            entry.state = STATE_SYNCED
+            self.stats['unchanged'] += 1
+        else:
+            entry.state = STATE_PENDING
+            entry.attempts = 0
+            entry.due = 0
+            self.schedule((uid, field), entry)
+            self.cond.notify()
+        self.cond.release()
+        return
+
+    def expect(self, uid, param, xparam, values):
+        """ Update the desired value of an existing entry that was set by other
+        means (e.g. a group frame), without sending or verifying anything """
+        values = bytearray(values)
+        data = values if xparam is None else bytearray([xparam]) + values
+        field, desiredValue = decodeParameter(param, data)
+        self.cond.acquire()
+        entry = self.entries.get((uid, field))
+        if entry is not None:
+            entry.desired = values
+            entry.desiredValue = desiredValue
+            entry.state = STATE_SYNCED
+            entry.attempts = 0
+        self.cond.release()
+        return
+
+    def recordField(self, uid, field, value, timestamp=None):
+        """ XrfAPI field listener: compare reported values with desired ones """
+        self.cond.acquire()
+        if field == 'setack':
+            # an ack without a decodable value; confirm it with a GET right away
+            param, xparam = value
+            if param != XRF_PARAM_EXTENDED:
+                fields = [XRF_PARAM_DECODERS.get(param, (None,))[0]]
+            elif xparam is not None:
+                fields = [XRF_X_DECODERS.get(xparam, (None,))[0]]
+            else:
+                fields = [decoder[0] for decoder in XRF_X_DECODERS.values()]
+            for field in fields:
+                entry = self.entries.get((uid, field))
+                if entry is not None and entry.state == STATE_SENT:
+                    entry.attempts |= 1
+                    entry.due = 0
+                    self.schedule((uid, field), entry)
+                    self.cond.notify()
+            self.cond.release()
+            return
+
+        entry = self.entries.get((uid, field))
+        if entry is not None:
+            entry.reported = value
+            entry.reportedAt = timestamp or time.time()
+            if value == entry.desiredValue:
+                if entry.state != STATE_SYNCED:
+                    entry.state = STATE_SYNCED
+                    entry.attempts = 0
+                    self.stats['confirmed'] += 1
+            elif entry.state == STATE_SYNCED:
+                entry.state = STATE_PENDING
+                entry.due = 0
+                self.schedule((uid, field), entry)
+                self.stats['drifted'] += 1
+                self.cond.notify()
+        self.cond.release()
+        return
+
+    def schedule(self, key, entry):
+        """ Queue an entry for its due time, superseding any earlier item for it (cond held) """
+        self.tokens += 1
+        entry.token = self.tokens
+        heapq.heappush(self.queue, (entry.due, entry.token, key))
+        return
+
+    def nextDue(self, now):
+        """ Take the most overdue unsynced entry, or (None, seconds until one is due) (cond held).
+
+        Items left behind by a rescheduled, synced or forgotten entry are
+        discarded as they reach the top of the heap.
+        """
+        while self.queue:
+            due, token, key = self.queue[0]
+            entry = self.entries.get(key)
+            if entry is None or entry.state == STATE_SYNCED or entry.token != token:
+                heapq.heappop(self.queue)
+                continue
+            if due > now:
+                return None, due - now
+            heapq.heappop(self.queue)
+            return (key, entry), 0
+        return None, None
+
+    def send(self, uid, entry):
+        """ Send the SET (even attempts) or verifying GET (odd attempts) for an entry """
+        hops = self.api.hopsForTarget(0, uid)
+        if entry.attempts % 2 == 0:
+            if entry.xparam is None:
+                self.api.xrfThread.rfSetParameter(entry.param, 0, uid, entry.desired, hops)
+            else:
+                self.api.xrfThread.rfSetExtParameter(entry.xparam, 0, uid, entry.desired, hops)
+            self.stats['sets'] += 1
+        else:
+            if entry.xparam is None:
+                self.api.xrfThread.rfGetParameter(entry.param, 0, uid, None, hops, background=True)
+            else:
+                self.api.xrfThread.rfGetExtParameter(entry.xparam, 0, uid, hops, background=True)
+            self.stats['gets'] += 1
+        return
+
+    def run(self):
+        self.running = True
+        self.api.shadow = self
+        self.api.addFieldListener(self.recordField)
+        self.api.registerMetrics('shadow', self.getStats)
+        nextSlot = 0
+        while self.running:
+            now = time.time()
+            if now < nextSlot:
+                time.sleep(nextSlot - now)
+                continue
+
+            self.cond.acquire()
+            best, wait = self.nextDue(now)
+            if best is None:
+                self.cond.wait(wait)
+                self.cond.release()
+                continue
+            (uid, field), entry = best
+            attempt = entry.attempts
+            entry.state = STATE_SENT
+            self.cond.release()
+
+            try:
+                self.send(uid, entry)
+            except Exception:
+                log.exception('shadow update of %s on %s failed', field, uid)
+
+            hopcount = self.api.deviceHopcount(uid)
+            airtime = frameAirtime(self.setLength, hopcount) + frameAirtime(self.ackLength, hopcount)
+            self.stats['airtime'] += airtime
+            share = self.airtimeShare * max(0.1, 1.0 - self.api.channelLoad())
+            nextSlot = time.time() + airtime / share
+
+            self.cond.acquire()
+            if entry.state == STATE_SENT and entry.attempts == attempt:
+                entry.attempts += 1
+                if entry.attempts >= self.maxAttempts:
+                    log.debug('%s on %s unconfirmed after %d attempts', field, uid, entry.attempts)
+                    entry.attempts = 0
+                    entry.due = time.time() + self.stragglerDelay
+                    self.stats['stragglers'] += 1
+                else:
+                    entry.due = time.time() + self.api.rtt.timeout(uid, hopcount, entry.attempts)
+                self.schedule((uid, field), entry)
+            self.cond.release()
+        return
+
+    def forget(self, uid):
+        """ Drop the entries of a fixture evicted from the registry """
+        self.cond.acquire()
+        for field in self.fields.pop(uid, ()):
+            self.entries.pop((uid, field), None)
+        self.cond.release()
+        return
+
+    def stop(self):
+        self.running = False
+        self.cond.acquire()
+        self.cond.notify()
+        self.cond.release()
+        return
+
+    def getShadow(self, uid):
+        """ Desired and reported values of every shadowed parameter of a fixture """
+        self.cond.acquire()
+        shadow = dict((field, entry.asDict()) for (entryUid, field), entry in self.entries.items()
+                      if entryUid == uid)
+        self.cond.release()
+        return shadow
+
+    def getStats(self):
+        self.cond.acquire()
+        stats = dict(self.stats)
+        for state in (STATE_SYNCED, STATE_PENDING, STATE_SENT):
+            stats[state] = 0
+        for entry in self.entries.values():
+            stats[entry.state] += 1
+        self.cond.release()
+        return stats
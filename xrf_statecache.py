@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of the device registry, so a restarted gateway can answer
+with the fleet it knew before the dongle has heard from anyone
+"""
+import logging
+import os
+import threading
+import time
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+log = logging.getLogger(__name__)
+
+STATE_FORMAT = 1
+STATE_DIR = '/var/lib/xrf-api'
+
+
+def default_state_path():
+    """ File the device registry is saved to between runs: under STATE_DIR
+    if it can be written, otherwise next to the gateway. Never the temp
+    directory, which is often tmpfs and wiped by a power cycle. """
+    if os.access(STATE_DIR, os.W_OK) or os.access(os.path.dirname(STATE_DIR), os.W_OK):
+        return os.path.join(STATE_DIR, 'state.pickle')
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'xrf-state.pickle')
+
+
+class StateCache(threading.Thread):
+    """ Restores the device registry when started, then saves it when it
+    has changed, at most every interval seconds. The API reports itself as
+    starting until the restore is done, and nothing is saved before then so
+    a half-loaded registry never replaces the saved one. Restored devices
+    are marked stale until they are heard from. Files are replaced
+    atomically so a power cut mid-save leaves the previous copy intact.
+    """
+    interval = 60.0
+
+    def __init__(self, api, path=None, name="XrfStateCache"):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.api = api
+        self.path = path or default_state_path()
+        self.savedVersion = None
+        self.restored = False
+        self.lock = threading.Lock()
+        self.running = False
+        self.stats = {'saves': 0, 'restored': 0, 'lastSave': None, 'lastError': None}
+
+    def restore(self):
+        """ Load the saved registry, if any; returns the number of devices restored """
+        try:
+            return self.load()
+        finally:
+            self.restored = True
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                state = pickle.load(f)
+        except IOError:
+            return 0
+        except Exception as err:
+            log.warning('ignoring unreadable state cache %s: %s', self.path, err)
+            return 0
+        if state.get('format') != STATE_FORMAT:
+            return 0
+        restored = self.api.restoreDevices(state['devices'], state['tombstones'], state.get('motion', ()))
+        self.savedVersion = self.api.getVersion()
+        self.stats['restored'] = restored
+        log.info('restored %d devices saved at %s', restored, time.ctime(state['saved']))
+        return restored
+
+    def save(self):
+        """ Write the registry to disk """
+        self.lock.acquire()
+        try:
+            return self.write()
+        finally:
+            self.lock.release()
+
+    def write(self):
+        version = self.api.getVersion()
+        devices, tombstones, motion = self.api.snapshotDevices()
+        state = {'format': STATE_FORMAT, 'saved': time.time(),
+                 'devices': devices, 'tombstones': tombstones, 'motion': motion}
+        temp = self.path + '.tmp'
+        directory = os.path.dirname(self.path)
+        try:
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(temp, 'wb') as f:
+                pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(temp, self.path)
+        except (IOError, OSError) as err:
+            log.warning('could not save state cache %s: %s', self.path, err)
+            self.stats['lastError'] = str(err)
+            return False
+        self.savedVersion = version
+        self.stats['saves'] += 1
+        self.stats['lastSave'] = state['saved']
+        return True
+
+    def run(self):
+        self.running = True
+        self.api.registerMetrics('stateCache', self.getStats)
+        try:
+            self.restore()
+        finally:
+            self.api.restoring = False
+        self.api.markStartup('restored')
+        while self.running:
+            time.sleep(self.interval)
+            if self.api.getVersion() != self.savedVersion:
+                self.save()
+        return
+
+    def start(self):
+        """ Start the restore, reporting the API as starting from now on """
+        self.api.restoring = True
+        threading.Thread.start(self)
+        return
+
+    def stop(self):
+        """ Stop saving, after a final save if anything changed since the restore """
+        self.running = False
+        if self.restored and self.api.getVersion() != self.savedVersion:
+            self.save()
+        return
+
+    def getStats(self):
+        return dict(self.stats)
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+In-process time-series store for fixture telemetry
+
+Each (metric, fixture) pair gets a fixed-size ring buffer backed by two
+typed arrays (uint32 timestamps, float32 values), so memory is bounded by
+maxDevices * len(METRICS) * capacity * 8 bytes. Range and window queries
+work on array slices rather than per-sample Python objects.
+"""
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+
+METRICS = ('motion', 'light', 'temperature', 'pwm', 'power')
+
+
+def hottest(temperatures):
+    """ Highest of a fixture's temperature sensors """
+    return max(temperatures) if temperatures else None
+
+
+def occupiedLevel(pwmlevels):
+    """ PWM level a fixture runs at when occupied on mains power """
+    return pwmlevels.get('occMains')
+
+
+# device field: (metric, value extractor) for fields recorded from the RX path
+TIMESERIES_FIELDS = {
+    'motion': ('motion', lambda kind: 1),
+    'light': ('light', lambda light: light),
+    'temperatures': ('temperature', hottest),
+    'pwmlevels': ('pwm', occupiedLevel),
+    'pwrstat': ('power', lambda pwrstat: pwrstat.get('status')),
+}
+
+
+class RingSeries(object):
+    """ Fixed-size ring of (timestamp, value) samples """
+
+    def __init__(self, capacity):
+        self.times = array('I', [0]) * capacity
+        self.values = array('f', [0.0]) * capacity
+        self.capacity = capacity
+        self.head = 0           # next slot to write
+        self.count = 0
+
+    def append(self, timestamp, value):
+        self.times[self.head] = int(timestamp)
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        return
+
+    def ordered(self):
+        """ (times, values) arrays in time order """
+        if self.count < self.capacity:
+            return self.times[:self.count], self.values[:self.count]
+        return (self.times[self.head:] + self.times[:self.head],
+                self.values[self.head:] + self.values[:self.head])
+
+    def range(self, start, end):
+        """ (times, values) arrays for start <= t <= end """
+        times, values = self.ordered()
+        lo = bisect_left(times, start)
+        hi = bisect_right(times, end)
+        return times[lo:hi], values[lo:hi]
+
+
+def window_aggregates(times, values, start, end, window):
+    """ Per-window (start, min, max, sum, count) over time-ordered arrays """
+    windows = list()
+    lo = 0
+    while lo < len(times):
+        # jump straight to the window holding the next sample
+        windowStart = start + (times[lo] - start) // window * window
+        if windowStart > end:
+            break
+        hi = bisect_left(times, windowStart + window, lo)
+        chunk = values[lo:hi]
+        windows.append((windowStart, min(chunk), max(chunk), sum(chunk), hi - lo))
+        lo = hi
+    return windows
+
+
+class TimeSeriesStore(object):
+    """ Ring buffers per metric and fixture, evicting the least recently
+    written fixture once maxDevices is reached """
+
+    def __init__(self, capacity=64, maxDevices=10000):
+        self.capacity = capacity
+        self.maxDevices = maxDevices
+        self.devices = OrderedDict()    # uid -> {metric: RingSeries}
+        self.lock = threading.Lock()
+        self.evicted = 0
+
+    def record(self, metric, uid, value, timestamp=None):
+        """ Append a sample for a fixture """
+        if timestamp is None:
+            timestamp = time.time()
+        self.lock.acquire()
+        series = self.devices.pop(uid, None)
+        if series is None:
+            series = dict()
+            if len(self.devices) >= self.maxDevices:
+                self.devices.popitem(last=False)
+                self.evicted += 1
+        self.devices[uid] = series
+        ring = series.get(metric)
+        if ring is None:
+            ring = series[metric] = RingSeries(self.capacity)
+        ring.append(timestamp, value)
+        self.lock.release()
+        return
+
+    def forget(self, uid):
+        """ Drop every series of a fixture """
+        self.lock.acquire()
+        self.devices.pop(uid, None)
+        self.lock.release()
+        return
+
+    def query(self, metric, uid, start, end):
+        """ Raw samples for one fixture as a list of [timestamp, value] """
+        self.lock.acquire()
+        ring = self.devices.get(uid, {}).get(metric)
+        times, values = ring.range(start, end) if ring else ([], [])
+        self.lock.release()
+        return [[t, v] for t, v in zip(times, values)]
+
+    def aggregate(self, metric, uid, start, end, window):
+        """ min/max/mean/count per window for one fixture """
+        self.lock.acquire()
+        ring = self.devices.get(uid, {}).get(metric)
+        times, values = ring.range(start, end) if ring else ([], [])
+        self.lock.release()
+        return [{'start': w, 'min': lo, 'max': hi, 'mean': total / count, 'count': count}
+                for w, lo, hi, total, count in window_aggregates(times, values, start, end, window)]
+
+    def rollup(self, metric, start, end, window):
+        """ Fleet-wide min/max/mean/count per window, plus devices reporting """
+        self.lock.acquire()
+        ranges = [series[metric].range(start, end) for series in self.devices.values() if metric in series]
+        self.lock.release()
+
+        merged = dict()
+        for times, values in ranges:
+            if not times:
+                continue
+            for w, lo, hi, total, count in window_aggregates(times, values, start, end, window):
+                agg = merged.get(w)
+                if agg is None:
+                    merged[w] = [lo, hi, total, count, 1]
+                else:
+                    agg[0] = min(agg[0], lo)
+                    agg[1] = max(agg[1], hi)
+                    agg[2] += total
+                    agg[3] += count
+                    agg[4] += 1
+        return [{'start': w, 'min': agg[0], 'max': agg[1], 'mean': agg[2] / agg[3],
+                 'count': agg[3], 'devices': agg[4]} for w, agg in sorted(merged.items())]
+
+    def recordField(self, uid, field, value, timestamp=None):
+        """ XrfAPI field listener recording the fields in TIMESERIES_FIELDS """
+        entry = TIMESERIES_FIELDS.get(field)
+        if entry is None:
+            return
+        metric, extract = entry
+        sample = extract(value)
+        if sample is not None:
+            self.record(metric, uid, sample, timestamp)
+        return
+
+    def getStats(self):
+        self.lock.acquire()
+        rings = sum(len(series) for series in self.devices.values())
+        stats = {'devices': len(self.devices), 'series': rings, 'evicted': self.evicted,
+                 'bytes': rings * self.capacity * 8}
+        self.lock.release()
+        return stats
+
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Fleet-wide RTC time sync and calendar distribution
+"""
+import logging
+import math
+import random
+import threading
+import time
+
+from xrf import XRF_PARAM_EXTENDED, XRF_UNIVERSAL_GROUP, XRF_X_RTC_OFF, XRF_X_RTC_ON, XRF_X_RTC_TIME
+
+
+log = logging.getLogger(__name__)
+
+
+def sampleSize(population, margin=0.1, z=1.96, p=0.5):
+    """ Cochran's sample size with finite population correction """
+    if population <= 0:
+        return 0
+    n0 = z * z * p * (1 - p) / (margin * margin)
+    return min(population, int(math.ceil(n0 / (1 + (n0 - 1) / population))))
+
+
+def encodeUint32(value):
+    return bytearray([(value >> 24) & 0xFF, (value >> 16) & 0xFF, (value >> 8) & 0xFF, value & 0xFF])
+
+
+def stampTime(pkt):
+    """ onSend hook: fill in the RTC time as the frame is written to the dongle """
+    pkt.payload[-4:] = encodeUint32(int(round(time.time())))
+    return
+
+
+class TimeSyncBusy(Exception):
+    """ Raised when a time sync is requested while another is running """
+    pass
+
+
+class TimeSyncJob(threading.Thread):
+    """ Pushes the RTC time and on/off calendar to a group by broadcast.
+
+    The time is stamped into the frame as it is written to the dongle, not
+    when it is queued, so time spent behind TX pacing doesn't age it. The
+    RTC has one second resolution and the mesh adds only tens of
+    milliseconds per hop, so one broadcast serves every hop count. A random
+    sample of fixtures (sized for the margin of error and stratified by hop
+    count) is then read back. Fixtures that are wrong are corrected by
+    unicast, and the broadcast is repeated if too many of the sample were
+    wrong.
+    """
+    tolerance = 2               # seconds of clock error accepted
+    margin = 0.1                # sampling margin of error (95% confidence)
+    rebroadcastRate = 0.2       # failure rate in the sample that triggers another broadcast
+    maxRounds = 2
+    settleTime = 1.0            # seconds between broadcasting and sampling
+
+    def __init__(self, api, group=XRF_UNIVERSAL_GROUP, syncTime=True, rtcOn=None, rtcOff=None,
+                 name="XrfTimeSync"):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.api = api
+        self.group = group
+        self.syncTime = syncTime
+        self.rtcOn = bytearray(rtcOn) if rtcOn is not None else None
+        self.rtcOff = bytearray(rtcOff) if rtcOff is not None else None
+        self.status = {'state': 'queued', 'group': group, 'rounds': 0, 'broadcasts': 0,
+                       'fixtures': 0, 'sampled': 0, 'failed': 0, 'unanswered': 0,
+                       'corrected': 0, 'started': None, 'finished': None}
+
+    def fixtures(self):
+        """ Known fixtures in the target group as {uid: hopcount} """
+        return dict((device['uid'], device.get('hopcount') or 1) for device in self.api.getDevices()
+                    if self.group == XRF_UNIVERSAL_GROUP or device.get('group') == self.group)
+
+    def broadcast(self):
+        """ Broadcast the calendar and the time """
+        xrfThread = self.api.xrfThread
+        maxHops = self.api.hopsForTarget(self.group, None)
+        if self.rtcOn is not None:
+            xrfThread.rfSetExtParameter(XRF_X_RTC_ON, self.group, None, self.rtcOn, maxHops)
+            self.status['broadcasts'] += 1
+        if self.rtcOff is not None:
+            xrfThread.rfSetExtParameter(XRF_X_RTC_OFF, self.group, None, self.rtcOff, maxHops)
+            self.status['broadcasts'] += 1
+        if self.syncTime:
+            xrfThread.rfSetExtParameter(XRF_X_RTC_TIME, self.group, None, encodeUint32(0), maxHops,
+                                        stampTime)
+            self.status['broadcasts'] += 1
+        return
+
+    def sample(self, fixtures):
+        """ Random sample of fixtures, stratified by hop count """
+        strata = dict()
+        for uid, hopcount in fixtures.items():
+            strata.setdefault(hopcount, list()).append(uid)
+        size = sampleSize(len(fixtures), self.margin)
+        chosen = list()
+        for hopcount, uids in sorted(strata.items()):
+            share = int(math.ceil(size * len(uids) / float(len(fixtures))))
+            chosen += random.sample(uids, min(share, len(uids)))
+        return chosen
+
+    def verify(self, uid):
+        """ True if a fixture holds the pushed values, False if not, None if it didn't answer """
+        if self.syncTime:
+            rtctime = self.api.getParameter(uid, XRF_PARAM_EXTENDED, XRF_X_RTC_TIME)
+            if rtctime is None:
+                return None
+            if abs(rtctime - self.api.lastUpdate(uid, 'rtctime')) > self.tolerance:
+                return False
+        for xparam, value in ((XRF_X_RTC_ON, self.rtcOn), (XRF_X_RTC_OFF, self.rtcOff)):
+            if value is not None:
+                reported = self.api.getParameter(uid, XRF_PARAM_EXTENDED, xparam)
+                if reported is None:
+                    return None
+                if reported != list(value):
+                    return False
+        return True
+
+    def correct(self, uid):
+        """ Unicast the pushed values to one fixture """
+        xrfThread = self.api.xrfThread
+        hops = self.api.hopsForTarget(0, uid)
+        if self.rtcOn is not None:
+            xrfThread.rfSetExtParameter(XRF_X_RTC_ON, 0, uid, self.rtcOn, hops)
+        if self.rtcOff is not None:
+            xrfThread.rfSetExtParameter(XRF_X_RTC_OFF, 0, uid, self.rtcOff, hops)
+        if self.syncTime:
+            xrfThread.rfSetExtParameter(XRF_X_RTC_TIME, 0, uid, encodeUint32(0), hops, stampTime)
+        self.status['corrected'] += 1
+        return
+
+    def run(self):
+        self.status['state'] = 'running'
+        self.status['started'] = time.time()
+        try:
+            fixtures = self.fixtures()
+            self.status['fixtures'] = len(fixtures)
+            for attempt in range(self.maxRounds):
+                self.status['rounds'] += 1
+                self.broadcast()
+                time.sleep(self.settleTime)
+
+                sample = self.sample(fixtures)
+                failed = list()
+                for uid in sample:
+                    result = self.verify(uid)
+                    if result is None:
+                        self.status['unanswered'] += 1
+                    elif not result:
+                        failed.append(uid)
+                self.status['sampled'] += len(sample)
+                self.status['failed'] += len(failed)
+
+                for uid in failed:
+                    self.correct(uid)
+                if not sample or len(failed) <= self.rebroadcastRate * len(sample):
+                    break
+                log.debug('time sync: %d of %d sampled fixtures wrong, broadcasting again',
+                              len(failed), len(sample))
+            self.status['state'] = 'done'
+        except Exception:
+            log.exception('time sync failed')
+            self.status['state'] = 'failed'
+        self.status['finished'] = time.time()
+        return
+
+    def getStatus(self):
+        return dict(self.status)
+
+
+class TimeSync(object):
+    """ Runs time sync jobs one at a time for the API """
+
+    def __init__(self, api):
+        self.api = api
+        self.job = None
+        self.lock = threading.Lock()
+
+    def install(self):
+        """ Attach to the XrfAPI instance """
+        self.api.timeSync = self
+        return
+
+    def start(self, group=XRF_UNIVERSAL_GROUP, syncTime=True, rtcOn=None, rtcOff=None):
+        """ Start a job and return its status (raises TimeSyncBusy if one is running) """
+        self.lock.acquire()
+        try:
+            if self.job is not None and self.job.is_alive():
+                raise TimeSyncBusy('a time sync is already running')
+            self.job = TimeSyncJob(self.api, group, syncTime, rtcOn, rtcOff)
+            self.job.start()
+            job = self.job
+        finally:
+            self.lock.release()
+        return job.getStatus()
+
+    def getStatus(self):
+        """ Status of the latest job, or None """
+        job = self.job
+        return job.getStatus() if job else None
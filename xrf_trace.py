@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Sampled end-to-end latency traces for outgoing packets
+
+A trace follows one REST request (or one background packet) through the
+gateway. Each packet it sends is a span stamped as it is queued, written to
+the serial port, echoed by the dongle ('T') and acknowledged by the fixture.
+"""
+import itertools
+import random
+import threading
+import time
+from collections import deque
+
+
+# stage names in the order they happen
+STAGES = ('received', 'queued', 'written', 'echoed', 'acked', 'responded')
+
+
+class TraceSpan(object):
+    """ Stage timestamps of one packet """
+
+    def __init__(self, trace):
+        self.trace = trace
+        self.stamps = dict()
+
+    def asDict(self):
+        stamps = self.stamps
+        span = {'stamps': dict(stamps)}
+        # time spent in each stage, named after the stage it ends
+        previous = None
+        for stage in ('queued', 'written', 'echoed', 'acked'):
+            if stage in stamps:
+                if previous is not None:
+                    span[stage] = stamps[stage] - stamps[previous]
+                previous = stage
+        return span
+
+
+class Trace(object):
+    """ A sampled request and the packets it sent """
+
+    def __init__(self, traceId, name, start):
+        self.traceId = traceId
+        self.name = name
+        self.stamps = {'received': start}
+        self.spans = list()
+        self.expires = start + Tracer.maxAge
+
+    def asDict(self):
+        received = self.stamps.get('received')
+        responded = self.stamps.get('responded')
+        spans = [span.asDict() for span in self.spans]
+        trace = {'id': self.traceId, 'name': self.name, 'stamps': dict(self.stamps), 'packets': spans}
+        if received is not None and responded is not None:
+            trace['total'] = responded - received
+        queued = [span.stamps['queued'] for span in self.spans if 'queued' in span.stamps]
+        if received is not None and queued:
+            trace['handler'] = min(queued) - received
+        acked = [span.stamps['acked'] for span in self.spans if 'acked' in span.stamps]
+        if responded is not None and acked:
+            trace['response'] = responded - max(acked)
+        return trace
+
+
+class Tracer(object):
+    """ Samples traces and matches packets to their TX echoes and acks.
+
+    begin()/end() bracket a REST request on the calling thread. Packets
+    queued from that thread join its trace; packets queued elsewhere start a
+    trace of their own with probability backgroundRate. Finished traces are
+    kept in a ring of the last maxTraces. In multi-process mode the REST
+    stages happen in a worker, so only background sampling applies.
+    """
+    requestRate = 0.1       # fraction of REST requests traced
+    backgroundRate = 0.01   # fraction of other packets traced
+    maxTraces = 256         # finished traces kept
+    maxAge = 30.0           # seconds before an unfinished trace is closed
+
+    def __init__(self):
+        self.local = threading.local()
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.active = dict()        # traceId -> Trace
+        self.finished = deque(maxlen=self.maxTraces)
+        self.written = deque()      # spans awaiting their TX echo, as (payload bytes, span)
+        self.awaitingAck = dict()   # ack key -> span
+
+    def begin(self, name):
+        """ Start a trace for the current thread's request, if sampled """
+        self.local.trace = None
+        if random.random() >= self.requestRate:
+            return None
+        now = time.time()
+        self.lock.acquire()
+        trace = Trace(next(self.ids), name, now)
+        self.active[trace.traceId] = trace
+        self.lock.release()
+        self.local.trace = trace
+        return trace.traceId
+
+    def end(self):
+        """ Finish the current thread's trace, if any """
+        trace = getattr(self.local, 'trace', None)
+        self.local.trace = None
+        if trace is not None:
+            self.lock.acquire()
+            trace.stamps['responded'] = time.time()
+            self.finish(trace)
+            self.lock.release()
+        return
+
+    def finish(self, trace):
+        """ Move a trace to the finished ring (lock held) """
+        if self.active.pop(trace.traceId, None) is not None:
+            self.finished.append(trace)
+        return
+
+    def packetQueued(self, pkt):
+        """ Attach a span to a packet being queued, if its trace is sampled """
+        trace = getattr(self.local, 'trace', None)
+        if trace is None and random.random() >= self.backgroundRate:
+            return
+        now = time.time()
+        self.lock.acquire()
+        if trace is None:
+            trace = Trace(next(self.ids), 'background', now)
+            del trace.stamps['received']
+            self.active[trace.traceId] = trace
+        span = TraceSpan(trace)
+        span.stamps['queued'] = now
+        trace.spans.append(span)
+        pkt.trace = span
+        self.expire(now)
+        self.lock.release()
+        return
+
+    def packetWritten(self, pkt):
+        """ A traced packet has been written to the dongle """
+        span = pkt.trace
+        self.lock.acquire()
+        span.stamps['written'] = time.time()
+        self.written.append((bytes(pkt.payload), span))
+        if pkt.ackKey is not None:
+            self.awaitingAck[pkt.ackKey] = span
+        self.lock.release()
+        return
+
+    def echoed(self, payload):
+        """ The dongle reports it transmitted a frame """
+        if not self.written:
+            return
+        data = bytes(payload)
+        self.lock.acquire()
+        for index, (written, span) in enumerate(self.written):
+            if written == data:
+                del self.written[index]
+                span.stamps['echoed'] = time.time()
+                break
+        self.lock.release()
+        return
+
+    def acked(self, key):
+        """ A fixture acknowledged the request identified by key """
+        if not self.awaitingAck:
+            return
+        self.lock.acquire()
+        span = self.awaitingAck.pop(key, None)
+        if span is not None:
+            span.stamps['acked'] = time.time()
+            if 'received' not in span.trace.stamps:
+                self.finish(span.trace)     # background traces end at the ack
+        self.lock.release()
+        return
+
+    def expire(self, now):
+        """ Close traces and forget spans older than maxAge (lock held) """
+        for trace in [trace for trace in self.active.values() if trace.expires < now]:
+            self.finish(trace)
+        while self.written and self.written[0][1].trace.expires < now:
+            self.written.popleft()
+        for key in [key for key, span in self.awaitingAck.items() if span.trace.expires < now]:
+            del self.awaitingAck[key]
+        return
+
+    def getTraces(self, limit=50, name=None):
+        """ Most recent finished traces, newest first """
+        self.lock.acquire()
+        self.expire(time.time())
+        traces = [trace for trace in reversed(self.finished) if name is None or trace.name == name]
+        self.lock.release()
+        return [trace.asDict() for trace in traces[:limit]]
+
+    def getStats(self):
+        self.lock.acquire()
+        stats = {'active': len(self.active), 'finished': len(self.finished),
+                 'awaitingEcho': len(self.written), 'awaitingAck': len(self.awaitingAck)}
+        self.lock.release()
+        return stats
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Per-channel RF utilization estimated from the traffic the dongle observes
+"""
+import threading
+import time
+from collections import deque
+
+from xrf import frameAirtime
+
+
+class ChannelMonitor(object):
+    """ Rolling airtime utilization, packet rates and duplicate ratio per channel.
+
+    Every received frame (R) and dongle transmission (T echo) adds its
+    airtime to a one-second bucket of the current channel. Rates and
+    utilization are divided by the time actually spent listening to each
+    channel within the window, so they stay meaningful while hopping.
+    Relays the dongle can't hear aren't counted, so utilization is a lower
+    bound on how busy the mesh is.
+    """
+    window = 60             # seconds of history
+
+    def __init__(self, api):
+        self.api = api
+        self.buckets = dict()       # channel -> deque of [second, airtime, rx, tx, duplicates, hops]
+        self.dwells = deque()       # [channel, start, end or None]
+        self.lock = threading.Lock()
+
+    def install(self):
+        """ Attach to the XrfAPI instance """
+        self.dwells.append([self.api.currentChannel, time.time(), None])
+        self.api.utilization = self
+        self.api.addRadioListener(self.recordRadio)
+        return
+
+    def bucket(self, channel, now):
+        """ Current bucket for a channel, dropping expired ones (lock held) """
+        second = int(now)
+        buckets = self.buckets.setdefault(channel, deque())
+        while buckets and buckets[0][0] <= second - self.window:
+            buckets.popleft()
+        if not buckets or buckets[-1][0] != second:
+            buckets.append([second, 0.0, 0, 0, 0, 0])
+        return buckets[-1]
+
+    def recordRadio(self, kind, payload, channel, duplicate):
+        """ XrfAPI radio listener """
+        now = time.time()
+        self.lock.acquire()
+        if kind == 'channel':
+            if self.dwells[-1][0] != channel:
+                self.dwells[-1][2] = now
+                self.dwells.append([channel, now, None])
+            while len(self.dwells) > 1 and self.dwells[0][2] < now - self.window:
+                self.dwells.popleft()
+        elif kind in ('R', 'T'):
+            bucket = self.bucket(channel, now)
+            bucket[1] += frameAirtime(len(payload))
+            if kind == 'T':
+                bucket[3] += 1
+            else:
+                bucket[2] += 1
+                bucket[5] += payload[2] if len(payload) > 2 else 0
+                if duplicate:
+                    bucket[4] += 1
+        self.lock.release()
+        return
+
+    def listenTime(self, channel, now):
+        """ Seconds spent on a channel within the window (lock held) """
+        start = now - self.window
+        total = 0.0
+        for dwellChannel, begin, end in self.dwells:
+            if dwellChannel == channel:
+                total += max(0.0, min(end or now, now) - max(begin, start))
+        return total
+
+    def channelStats(self, channel, now):
+        """ Utilization and rates for one channel (lock held) """
+        airtime = rx = tx = duplicates = hops = 0
+        for second, bucketAirtime, bucketRx, bucketTx, bucketDuplicates, bucketHops in self.buckets.get(channel, ()):
+            if second > now - self.window:
+                airtime += bucketAirtime
+                rx += bucketRx
+                tx += bucketTx
+                duplicates += bucketDuplicates
+                hops += bucketHops
+        listened = self.listenTime(channel, now)
+        return {'utilization': min(1.0, airtime / listened) if listened > 0 else 0.0,
+                'rxRate': rx / listened if listened > 0 else 0.0,
+                'txRate': tx / listened if listened > 0 else 0.0,
+                'duplicateRatio': float(duplicates) / rx if rx else 0.0,
+                'meanHops': float(hops) / rx if rx else 0.0,
+                'listened': listened, 'rx': rx, 'tx': tx}
+
+    def load(self, channel):
+        """ Airtime utilization of a channel over the window """
+        now = time.time()
+        self.lock.acquire()
+        stats = self.channelStats(channel, now)
+        self.lock.release()
+        return stats['utilization']
+
+    def getStats(self):
+        now = time.time()
+        self.lock.acquire()
+        channels = set(self.buckets) | set(dwell[0] for dwell in self.dwells)
+        stats = dict((str(channel), self.channelStats(channel, now)) for channel in channels)
+        self.lock.release()
+        return stats